@@ -0,0 +1,85 @@
+"""
+Startup time of every subcommand and the import time its module adds once it runs.
+The startup (interpreter, mgyminer.cli and argument parsing up to --help) is checked
+against a budget, and no heavy third party module may be imported before the command
+runs. Exits with status 1 if a subcommand breaks either check, so the script can guard
+CI runs.
+
+    python benchmarks/bench_cli_startup.py --budget 150
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from mgyminer.cli import COMMANDS
+
+HEAVY_MODULES = ["numpy", "pandas", "plotly", "Bio", "mysql", "hmmer", "yaml"]
+
+STARTUP = """
+import sys
+from mgyminer.cli import create_parser
+try:
+    create_parser().parse_args([{command!r}, "--help"])
+except SystemExit:
+    pass
+heavy = sorted({{name.split(".")[0] for name in sys.modules}} & set({heavy!r}))
+print(",".join(heavy), file=sys.stderr)
+"""
+
+LOAD = """
+import time
+start = time.perf_counter()
+from mgyminer.cli import load_command
+load_command({command!r})
+print(time.perf_counter() - start)
+"""
+
+
+def run(code: str):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    return process, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--budget", type=float, default=150, help="startup budget per subcommand in ms"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = []
+    print(f"{'command':<16}{'startup ms':>12}{'run import ms':>15}  heavy imports")
+    for command in COMMANDS:
+        timings = []
+        for _ in range(args.repeats):
+            process, seconds = run(STARTUP.format(command=command, heavy=HEAVY_MODULES))
+            timings.append(seconds * 1000)
+        if process.returncode != 0:
+            raise RuntimeError(f"{command} failed to start:\n{process.stderr}")
+        heavy = process.stderr.rstrip("\n").rpartition("\n")[2]
+        startup = statistics.median(timings)
+
+        process, _ = run(LOAD.format(command=command))
+        if process.returncode == 0:
+            load = f"{float(process.stdout) * 1000:>15.0f}"
+        else:
+            # the command's dependencies are not installed in this environment
+            load = f"{'unavailable':>15}"
+        print(f"{command:<16}{startup:>12.0f}{load}  {heavy or '-'}")
+        if startup > args.budget or heavy:
+            failed.append(command)
+
+    if failed:
+        print(f"over budget or importing heavy modules at startup: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Memory and time of hit table operations keyed on MGYP accession strings versus the
+int64 MGYP numbers.
+
+    python benchmarks/bench_mgyp_keys.py --rows 10000000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from mgyminer.annotation import mgyp_accessions, mgyp_numbers
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--proteins", type=int, default=3_000_000_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    numbers = rng.integers(1, args.proteins, size=args.rows)
+    # one row per domain: about half of the proteins have a second domain
+    numbers[1::2] = numbers[::2][: len(numbers[1::2])]
+    accessions, render = timed(lambda: pd.Series(mgyp_accessions(numbers)))
+    parsed, parse = timed(mgyp_numbers, accessions)
+    assert (parsed == numbers).all()
+    keys = pd.Series(parsed)
+    matches = rng.choice(numbers, size=len(numbers) // 10)
+
+    print(f"{args.rows} rows{'accessions':>18}{'int64':>13}")
+    print(
+        f"{'memory':<14}{accessions.memory_usage(deep=True) / 1e6:>10.0f} MB"
+        f"{keys.memory_usage(deep=True) / 1e6:>10.0f} MB"
+    )
+    print(f"{'render/parse':<14}{render:>10.2f} s {parse:>10.2f} s")
+    operations = {
+        "dedup": lambda column, _: pd.unique(column),
+        "sort": lambda column, _: column.sort_values(),
+        "join": lambda column, other: pd.merge(
+            column.rename("key").to_frame(),
+            pd.DataFrame({"key": other, "value": 1}).drop_duplicates("key"),
+            on="key",
+        ),
+        "lookup": lambda column, other: column.isin(other),
+    }
+    for name, operation in operations.items():
+        _, strings = timed(operation, accessions, mgyp_accessions(matches))
+        _, integers = timed(operation, keys, matches)
+        print(f"{name:<14}{strings:>10.2f} s {integers:>10.2f} s")
+
+
+if __name__ == "__main__":
+    main()
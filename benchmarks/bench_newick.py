@@ -0,0 +1,76 @@
+"""
+Compare parsing and layout of large Newick trees between the Bio.Phylo path and arrayTree.
+
+    python benchmarks/bench_newick.py --leaves 100000
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from Bio import Phylo
+from generators import random_newick
+
+from mgyminer.newick import arrayTree
+from mgyminer.phylplot import get_x_coordinates, get_y_coordinates
+
+
+def biophylo_layout(tree_file: Path, dist: float = 1.3):
+    """Layout as plot_tree did it with Bio.Phylo clades as dict keys"""
+    tree = Phylo.read(tree_file, "newick")
+    xcoords = tree.depths()
+    maxheight = tree.count_terminals()
+    ycoords = dict(
+        (leaf, maxheight - i * dist)
+        for i, leaf in enumerate(reversed(tree.get_terminals()))
+    )
+
+    def calc_row(clade):
+        for subclade in clade:
+            if subclade not in ycoords:
+                calc_row(subclade)
+        ycoords[clade] = (ycoords[clade.clades[0]] + ycoords[clade.clades[-1]]) / 2
+
+    calc_row(tree.root)
+    return xcoords, ycoords
+
+
+def array_layout(tree_file: Path):
+    tree = arrayTree.read(tree_file)
+    return get_x_coordinates(tree), get_y_coordinates(tree)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    try:
+        function(*args)
+    except RecursionError:
+        return None
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--leaves", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--caterpillar",
+        action="store_true",
+        help="benchmark maximally deep instead of random trees",
+    )
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(10000)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for leaves in args.leaves:
+            tree_file = Path(tmpdir) / f"{leaves}.tree"
+            tree_file.write_text(random_newick(leaves, args.caterpillar))
+            bio = timed(biophylo_layout, tree_file)
+            array = timed(array_layout, tree_file)
+            bio = "RecursionError" if bio is None else f"{bio:.2f}s"
+            print(f"{leaves:>8} leaves  Bio.Phylo: {bio:>14}  arrayTree: {array:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Wall time of the filter -> residue -> domain stages run by the pipeline subcommand in
+one process versus the separate subcommands, which write and re-read the hit table and
+alignments.json between the stages.
+
+    python benchmarks/bench_pipeline.py --hits 30000
+    python benchmarks/bench_pipeline.py --search phmmer.out --sqlite arch.db \
+        --residue 40 include A C --arch PF00001
+
+Without --search a synthetic search and architecture database from generators.py are
+used.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+
+from generators import architecture_database, search_results
+
+from mgyminer.annotation import mgyp_numbers
+from mgyminer.filter import domain_filter, filter, parse_domtable, residue_filter
+from mgyminer.pipeline import searchPipeline
+
+
+def separate(search: Path, workdir: Path, args) -> float:
+    start = time.perf_counter()
+    filter(
+        Namespace(
+            input=search,
+            eval=args.eval,
+            coverage=None,
+            sort=["identity", "eval"],
+            output=workdir / "filter.csv",
+        )
+    )
+    residue_filter(
+        Namespace(
+            input=workdir / "filter.csv",
+            residue=[args.residue],
+            output=workdir / "residue.csv",
+        )
+    )
+    domain_filter(
+        Namespace(
+            input=workdir / "residue.csv",
+            arch=args.arch,
+            strict=False,
+            exclude=[],
+            strategy="auto",
+            sqlite=args.sqlite,
+            local_index=None,
+            db_metrics=False,
+            output=workdir / "domain.csv",
+        )
+    )
+    return time.perf_counter() - start
+
+
+def pipeline(search: Path, workdir: Path, args) -> float:
+    config = {
+        "search": search,
+        "output": workdir,
+        "write": ["domain"],
+        "stages": {
+            "filter": {
+                "eval": args.eval,
+                "coverage": None,
+                "sort": ["identity", "eval"],
+            },
+            "residue": {"residue": [args.residue]},
+            "domain": {
+                "arch": args.arch,
+                "strict": False,
+                "exclude": [],
+                "strategy": "auto",
+                "sqlite": args.sqlite,
+                "local_index": None,
+                "db_metrics": False,
+            },
+        },
+    }
+    start = time.perf_counter()
+    searchPipeline(config).run()
+    return time.perf_counter() - start
+
+
+def compare(args):
+    timings = {"separate": [], "pipeline": []}
+    for _ in range(args.repeats):
+        for name, run in [("separate", separate), ("pipeline", pipeline)]:
+            # fresh copy of the search output, an existing alignments.json is copied
+            # along so that both runs start from the same cache state
+            with tempfile.TemporaryDirectory() as tmp:
+                workdir = Path(tmp)
+                search = workdir / args.search.name
+                shutil.copy(args.search, search)
+                for sidecar in ["dom_tbl.txt", "alignments.json"]:
+                    if args.search.with_name(sidecar).is_file():
+                        shutil.copy(args.search.with_name(sidecar), workdir)
+                timings[name].append(run(search, workdir, args))
+    for name, times in timings.items():
+        print(f"{name:<10}{min(times):>8.2f} s (best of {args.repeats})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--search",
+        type=Path,
+        help="phmmer output, dom_tbl.txt next to it",
+    )
+    parser.add_argument("--sqlite", type=Path)
+    parser.add_argument(
+        "--residue", nargs="+", default=["150", "include", "A", "C", "D", "E", "F"]
+    )
+    parser.add_argument("--arch", nargs="+", default=["PF00001"])
+    parser.add_argument("--eval", type=float, default=None)
+    parser.add_argument("--hits", type=int, default=20000, help="synthetic targets")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data:
+        if args.search is None:
+            args.search = search_results(Path(data) / "search", args.hits)
+            args.sqlite = architecture_database(
+                Path(data) / "architectures.db",
+                mgyp_numbers(
+                    parse_domtable(args.search.with_name("dom_tbl.txt"))["target_name"]
+                ),
+            )
+        elif args.sqlite is None:
+            parser.error("--sqlite is required with --search")
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
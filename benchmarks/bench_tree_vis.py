@@ -0,0 +1,74 @@
+"""
+Render time and HTML size of tree_vis for the shape based and the batched WebGL renderer,
+with and without a cached layout.
+
+    python benchmarks/bench_tree_vis.py --leaves 1000 10000 50000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+
+from generators import filter_table, random_newick
+
+from mgyminer.phylplot import plot_tree, treeLayout
+
+
+def render(tree_file: Path, filter_file: Path, output: Path, webgl: bool) -> float:
+    start = time.perf_counter()
+    plot_tree(
+        Namespace(
+            tree=tree_file,
+            filter=filter_file,
+            min=None,
+            max=None,
+            param=None,
+            reference=None,
+            clade=None,
+            webgl=webgl,
+            collapse=None,
+            collapse_threshold=None,
+            output=output,
+        )
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--leaves", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument(
+        "--shapes-max-leaves",
+        type=int,
+        default=10000,
+        help="skip the shape based renderer above this tree size",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for leaves in args.leaves:
+            tree_file = Path(tmpdir) / f"{leaves}.tree"
+            filter_file = Path(tmpdir) / f"{leaves}.csv"
+            output = Path(tmpdir) / "tree_vis.html"
+            tree_file.write_text(random_newick(leaves))
+            filter_table(leaves).to_csv(filter_file, index=False)
+            for webgl in (False, True):
+                if not webgl and leaves > args.shapes_max_leaves:
+                    continue
+                # first run computes and caches the layout, the second one reuses it
+                treeLayout.cache_file(tree_file).unlink(missing_ok=True)
+                cold = render(tree_file, filter_file, output, webgl)
+                warm = render(tree_file, filter_file, output, webgl)
+                size = os.path.getsize(output) / 1e6
+                renderer = "webgl" if webgl else "shapes"
+                print(
+                    f"{leaves:>8} leaves  {renderer:>6}: {cold:8.2f}s "
+                    f"(cached layout {warm:6.2f}s) {size:8.1f} MB"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Deterministic synthetic inputs for the benchmarks. Every generator is seeded and sized by
+its arguments, so the same call yields the same files on every machine and commit. No
+HMMER binaries or MySQL server are needed: search output is written in the phmmer text
+and --domtblout formats the parsers read, and the architecture database is SQLite.
+"""
+
+import random
+from pathlib import Path
+from typing import Dict, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from mgyminer.annotation import mgyp_accessions
+from mgyminer.database import create_sqlite_database, proteinDB
+from mgyminer.localindex import localArchitectureIndex
+
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+PFAMS = [f"PF{i:05d}" for i in range(1, 501)]
+QUERY_NAME = "query"
+QUERY_LENGTH = 300
+# columns are matches, inserts in the target (query ".") or deletions (target "-")
+MATCH, INSERT, DELETE = 0, 1, 2
+
+
+def random_newick(leaves: int, caterpillar: bool = False, seed: int = 0) -> str:
+    """
+    Random binary tree with leaves named like tree_vis node labels. A caterpillar tree
+    is as deep as it has leaves, the worst case for recursive traversals.
+    """
+    rng = random.Random(seed)
+    nodes = [f"MGYP{i:012d}/1-100:{rng.random():.4f}" for i in range(leaves)]
+    while len(nodes) > 1:
+        i = 0 if caterpillar else rng.randrange(len(nodes) - 1)
+        nodes[i] = f"({nodes[i]},{nodes.pop(i + 1)}):{rng.random():.4f}"
+    return nodes[0] + ";"
+
+
+def filter_table(leaves: int, seed: int = 0) -> pd.DataFrame:
+    """Filter + domain output matching the leaves of random_newick(), last leaf is the query"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(leaves - 1):
+        architecture = rng.choices(PFAMS[:5], k=rng.randint(1, 4))
+        rows.append(
+            {
+                "target_name": f"MGYP{i:012d}",
+                "query_name": f"MGYP{leaves - 1:012d}/1-100",
+                "ndom": 1,
+                "env_from": 1,
+                "env_to": 100,
+                "coverage_hit": round(rng.random(), 2),
+                "coverage_query": round(rng.random(), 2),
+                "similarity": round(rng.random() * 100, 2),
+                "identity": round(rng.random() * 100, 2),
+                "Pfams": "-".join(architecture),
+                "domain_names": "~".join(f"domain_{pfam}" for pfam in architecture),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def mgyp_sample(n: int, seed: int = 0) -> np.ndarray:
+    """n distinct, sorted MGYP numbers spread over the MGnify protein id range"""
+    rng = np.random.default_rng(seed)
+    numbers = np.unique(rng.integers(1, 3_000_000_000, size=n + n // 10 + 10))
+    return np.sort(rng.permutation(numbers)[:n])
+
+
+def _text(row: np.ndarray) -> str:
+    return row.astype(np.uint8).tobytes().decode()
+
+
+def _domain_alignment(rng, query: np.ndarray, hmm_from: int, columns: int):
+    """
+    Aligned query, consensus and target rows of one domain starting at query position
+    hmm_from, with about 40% identical and 10% similar match columns
+    """
+    states = rng.choice(3, size=columns, p=[0.9, 0.05, 0.05])
+    states[0] = states[-1] = MATCH
+    on_query = states != INSERT
+    query_positions = hmm_from - 1 + np.cumsum(on_query) - 1
+    query_row = np.where(on_query, query[query_positions], ord("."))
+    identical = (rng.random(columns) < 0.4) & (states == MATCH)
+    similar = ~identical & (rng.random(columns) < 0.15) & (states == MATCH)
+    target_row = np.where(
+        identical, query_row, AMINO_ACIDS[rng.integers(0, 20, size=columns)]
+    )
+    target_row = np.where(states == INSERT, target_row + 32, target_row)  # lowercase
+    target_row = np.where(states == DELETE, ord("-"), target_row)
+    consensus = np.where(identical, query_row, ord(" "))
+    consensus = np.where(similar, ord("+"), consensus)
+    hmm_to = hmm_from + int(on_query.sum()) - 1
+    residues = int((states != DELETE).sum())
+    return _text(query_row), _text(consensus), _text(target_row), hmm_to, residues
+
+
+def search_results(
+    directory: Union[Path, str], hits: int, max_domains: int = 3, seed: int = 0
+) -> Path:
+    """
+    Write a phmmer search of a random query against `hits` MGnify proteins: phmmer.out
+    (text output with the domain alignments) and dom_tbl.txt (--domtblout) with
+    matching coordinates, as the phmmer subcommand leaves them
+    :param directory: output directory
+    :param hits: number of target proteins
+    :param max_domains: upper bound of domains per target
+    :param seed: random seed
+    :return: Path to phmmer.out
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    query = AMINO_ACIDS[rng.integers(0, 20, size=QUERY_LENGTH)]
+    targets = mgyp_accessions(mgyp_sample(hits, seed))
+    width = max(len(QUERY_NAME), 16)
+
+    domtbl = [
+        "# target name        accession   tlen query name           accession"
+        "   qlen   E-value  score  bias   #  of  c-Evalue  i-Evalue  score  bias"
+        "  from    to  from    to  from    to  acc description of target"
+    ]
+    text = [
+        "# phmmer :: search a protein sequence against a protein database",
+        f"Query:       {QUERY_NAME}  [L={QUERY_LENGTH}]",
+        "Domain annotation for each sequence (and alignments):",
+    ]
+    for target in targets:
+        domains = int(rng.integers(1, max_domains + 1))
+        tlen = domains * 200 + 100
+        digits = len(str(max(tlen, QUERY_LENGTH)))
+        evalue = 10.0 ** -rng.uniform(1, 50)
+        score = rng.uniform(20, 500)
+        text.append(f">> {target}  synthetic protein")
+        blocks = []
+        for domain in range(1, domains + 1):
+            columns = int(rng.integers(30, 150))
+            hmm_from = int(rng.integers(1, QUERY_LENGTH - columns + 1))
+            ali_from = (domain - 1) * 200 + int(rng.integers(1, 40))
+            query_row, consensus, target_row, hmm_to, residues = _domain_alignment(
+                rng, query, hmm_from, columns
+            )
+            ali_to = ali_from + residues - 1
+            dom_evalue = 10.0 ** -rng.uniform(1, 50)
+            dom_score = rng.uniform(20, 500)
+            domtbl.append(
+                f"{target} - {tlen} {QUERY_NAME} - {QUERY_LENGTH} {evalue:.2e}"
+                f" {score:.1f} 0.1 {domain} {domains} {dom_evalue:.2e}"
+                f" {dom_evalue:.2e} {dom_score:.1f} 0.1 {hmm_from} {hmm_to}"
+                f" {ali_from} {ali_to} {ali_from} {ali_to} 0.90 synthetic protein"
+            )
+            text.append(
+                f"  {domain:>2} ! {dom_score:6.1f}   0.1 {dom_evalue:9.2e}"
+                f" {dom_evalue:9.2e} {hmm_from:>7} {hmm_to:>7} .. {ali_from:>7}"
+                f" {ali_to:>7} .. {ali_from:>7} {ali_to:>7} .. 0.90"
+            )
+            # names and start coordinates share their column widths, the consensus
+            # starts where the sequences do
+            prefix = " " * (2 + width + 1 + digits + 1)
+            blocks += [
+                f"  == domain {domain}  score: {dom_score:.1f} bits;"
+                f"  conditional E-value: {dom_evalue:.2e}",
+                f"  {QUERY_NAME:>{width}} {hmm_from:>{digits}} {query_row} {hmm_to}",
+                f"{prefix}{consensus}",
+                f"  {target:>{width}} {ali_from:>{digits}} {target_row} {ali_to}",
+                f"{prefix}{'9' * len(target_row)} PP",
+                "",
+            ]
+        text += ["", "  Alignments for each domain:"] + blocks
+    text.append("//")
+
+    (directory / "dom_tbl.txt").write_text("\n".join(domtbl) + "\n")
+    output = directory / "phmmer.out"
+    output.write_text("\n".join(text) + "\n")
+    return output
+
+
+def aligned_sequences(
+    names: Sequence[str], length: int = 300, seed: int = 0
+) -> Dict[str, str]:
+    """
+    Multiple sequence alignment of mutated copies of one ancestor, about 10% gaps
+    :param names: sequence names
+    :param length: alignment columns
+    :param seed: random seed
+    :return: {name: aligned sequence}
+    """
+    rng = np.random.default_rng(seed)
+    ancestor = AMINO_ACIDS[rng.integers(0, 20, size=length)]
+    alignment = {}
+    for name in names:
+        mutated = rng.random(length) < rng.uniform(0.05, 0.6)
+        row = np.where(mutated, AMINO_ACIDS[rng.integers(0, 20, size=length)], ancestor)
+        row = np.where(rng.random(length) < 0.1, ord("-"), row)
+        alignment[name] = _text(row)
+    return alignment
+
+
+def write_afa(file: Union[Path, str], alignment: Dict[str, str]) -> None:
+    """Write an alignment as aligned FASTA, as esl-reformat afa does"""
+    with open(file, "wt") as fout:
+        for name, seq in alignment.items():
+            fout.write(f">{name}\n{seq}\n")
+
+
+def write_stockholm(file: Union[Path, str], alignment: Dict[str, str]) -> None:
+    """Write an alignment in Stockholm format with a reference annotation line"""
+    width = max(len(name) for name in alignment) + 1
+    rows = np.array(
+        [np.frombuffer(seq.encode(), np.uint8) for seq in alignment.values()]
+    )
+    reference = _text(np.where((rows != ord("-")).any(axis=0), ord("x"), ord(".")))
+    with open(file, "wt") as fout:
+        fout.write("# STOCKHOLM 1.0\n\n")
+        for name, seq in alignment.items():
+            fout.write(f"{name:<{width}}{seq}\n")
+        fout.write(f"{'#=GC RF':<{width}}{reference}\n//\n")
+
+
+def architecture_database(
+    file: Union[Path, str],
+    mgyp: np.ndarray,
+    proteins: int = 0,
+    architectures: int = 5000,
+    seed: int = 0,
+) -> Path:
+    """
+    SQLite architecture database covering the given proteins
+    :param file: Path to the SQLite file, replaced if it exists
+    :param mgyp: MGYP numbers that get an architecture, e.g. the hits of search_results()
+    :param proteins: total number of proteins, filled up with random other MGYP numbers
+    :param architectures: number of distinct architectures of 1-5 Pfams, drawn with
+    Zipf like frequencies of the Pfams and architectures
+    :param seed: random seed
+    :return: Path to the database
+    """
+    file = Path(file)
+    file.unlink(missing_ok=True)
+    rng = np.random.default_rng(seed)
+    pfam_weights = 1 / np.arange(1, len(PFAMS) + 1)
+    pfam_weights /= pfam_weights.sum()
+    rows = []
+    for arch_id in range(1, architectures + 1):
+        pfams = rng.choice(PFAMS, size=int(rng.integers(1, 6)), p=pfam_weights)
+        rows.append(
+            (arch_id, "-".join(pfams), "~".join(f"domain_{pfam}" for pfam in pfams))
+        )
+    background = mgyp_sample(max(proteins - len(mgyp), 0), seed + 1)
+    numbers = np.union1d(np.asarray(mgyp, dtype=np.int64), background)
+    arch_weights = 1 / np.arange(1, architectures + 1)
+    arch_ids = rng.choice(
+        np.arange(1, architectures + 1),
+        size=len(numbers),
+        p=arch_weights / arch_weights.sum(),
+    )
+    create_sqlite_database(file, rows, zip(numbers.tolist(), arch_ids.tolist()))
+    return file
+
+
+def local_index(database: Union[Path, str], directory: Union[Path, str]):
+    """Export a SQLite architecture database into a localArchitectureIndex"""
+    with proteinDB(sqlite=database) as db:
+        return localArchitectureIndex.export(db, directory)
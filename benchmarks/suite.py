@@ -0,0 +1,346 @@
+"""
+Time and peak memory of the hot path of each subcommand on synthetic data from
+generators.py. Results are written as JSON, so runs on different commits can be compared.
+
+    python benchmarks/suite.py --hits 20000 --output before.json
+    python benchmarks/suite.py --hits 20000 --output after.json --compare before.json
+
+Time is the best of --repeats runs, peak memory the tracemalloc peak of one extra run.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+from datetime import datetime, timezone
+from pathlib import Path
+
+from generators import (
+    aligned_sequences,
+    architecture_database,
+    filter_table,
+    local_index,
+    random_newick,
+    search_results,
+    write_afa,
+    write_stockholm,
+)
+
+from mgyminer.annotation import mgyp_numbers
+from mgyminer.chunked import filter_chunked
+from mgyminer.filter import (
+    alignment_table,
+    domain_hits,
+    filter_hits,
+    get_alignment_consensus,
+    load_search,
+    parse_domtable,
+    residue_hits,
+    threshold_expression,
+)
+from mgyminer.phylplot import plot_tree, treeLayout
+from mgyminer.phyltree import place_sequences
+from mgyminer.tables import FORMAT_SUFFIXES, read_table, write_table
+
+# name -> (subcommand, setup), setup(data) returns the function that is measured
+BENCHMARKS = {}
+
+
+def benchmark(name: str, command: str):
+    def register(setup):
+        BENCHMARKS[name] = (command, setup)
+        return setup
+
+    return register
+
+
+@benchmark("parse_domtable", "filter")
+def parse_domtable_case(data):
+    return lambda: parse_domtable(data.dom_tbl_file)
+
+
+@benchmark("alignment_consensus", "filter")
+def alignment_consensus_case(data):
+    return lambda: get_alignment_consensus(data.search)
+
+
+@benchmark("filter_hits", "filter")
+def filter_hits_case(data):
+    return lambda: filter_hits(
+        data.dom_tbl.copy(),
+        data.alignment_dict,
+        evalue=1e-5,
+        sort=["identity", "eval"],
+        table=data.alignment_table,
+    )
+
+
+@benchmark("filter_hits_where", "filter")
+def filter_hits_where_case(data):
+    # thresholds and a filter expression evaluated as one mask
+    return lambda: filter_hits(
+        data.dom_tbl.copy(),
+        data.alignment_dict,
+        evalue=1e-5,
+        coverage="10-90",
+        table=data.alignment_table,
+        where="score >= 100 and (identity >= 30 or similarity >= 50) and ndom <= 2",
+    )
+
+
+@benchmark("filter_chunked", "filter")
+def filter_chunked_case(data):
+    # same work as filter_hits plus parsing, within a 20 MB budget
+    return lambda: filter_chunked(
+        data.search,
+        data.directory / "filter_chunked.csv",
+        evalue=1e-5,
+        sort=["identity", "eval"],
+        memory_budget=20_000_000,
+    )
+
+
+@benchmark("residue_hits", "residue")
+def residue_hits_case(data):
+    filters = [[150, "include", "A", "C", "D", "E", "F", "G", "H", "I", "K", "L"]]
+    return lambda: residue_hits(
+        data.hits, data.alignment_dict, filters, data.alignment_table
+    )
+
+
+@benchmark("domain_sqlite", "domain")
+def domain_sqlite_case(data):
+    def select():
+        return domain_hits(data.hits, ["PF00001"], False, sqlite=data.database)
+
+    # the first call builds the architecture index cache next to the database
+    select()
+    return select
+
+
+@benchmark("domain_local_index", "domain")
+def domain_local_index_case(data):
+    return lambda: domain_hits(
+        data.hits, ["PF00001"], False, local_index=data.local_index
+    )
+
+
+def _read_case(fmt: str, columns=None, where=None):
+    def setup(data):
+        expression = threshold_expression(where=where)
+        return lambda: read_table(data.tables[fmt], columns, where=expression)
+
+    return setup
+
+
+for fmt in FORMAT_SUFFIXES:
+    # residue and domain read the whole table, export only target_name
+    benchmark(f"read_{fmt}", "residue")(_read_case(fmt))
+    benchmark(f"read_{fmt}_target_name", "export")(_read_case(fmt, ["target_name"]))
+    # residue/domain --where, evaluated while reading Parquet and Arrow
+    benchmark(f"read_{fmt}_where", "residue")(
+        _read_case(fmt, where="identity >= 45 and score >= 400")
+    )
+
+
+def _plot(data, cached: bool):
+    args = Namespace(
+        tree=data.tree,
+        filter=data.tree_filter,
+        min=None,
+        max=None,
+        param=None,
+        reference=None,
+        clade=None,
+        webgl=True,
+        collapse=None,
+        collapse_threshold=None,
+        output=data.directory / "tree_vis.html",
+    )
+
+    def run():
+        if not cached:
+            treeLayout.cache_file(data.tree).unlink(missing_ok=True)
+        plot_tree(args)
+
+    return run
+
+
+@benchmark("tree_vis", "tree_vis")
+def tree_vis_case(data):
+    return _plot(data, cached=False)
+
+
+@benchmark("tree_vis_cached_layout", "tree_vis")
+def tree_vis_cached_case(data):
+    plot = _plot(data, cached=True)
+    plot()
+    return plot
+
+
+@benchmark("place_sequences", "tree")
+def place_sequences_case(data):
+    return lambda: place_sequences(
+        data.tree,
+        data.alignment,
+        data.new_sequences,
+        data.directory / "placed.tree",
+    )
+
+
+def generate(directory: Path, args) -> Namespace:
+    """Write all inputs of the benchmarks to directory"""
+    data = Namespace(directory=directory)
+    data.search = search_results(directory / "search", args.hits, seed=args.seed)
+    data.dom_tbl_file = data.search.with_name("dom_tbl.txt")
+    data.dom_tbl, data.alignment_dict = load_search(data.search)
+    data.alignment_table = alignment_table(data.alignment_dict)
+    data.hits = filter_hits(
+        data.dom_tbl.copy(), data.alignment_dict, table=data.alignment_table
+    )
+    data.tables = {}
+    for fmt, suffix in FORMAT_SUFFIXES.items():
+        data.tables[fmt] = directory / f"filter{suffix}"
+        write_table(data.hits, data.tables[fmt], fmt)
+    data.database = architecture_database(
+        directory / "architectures.db",
+        mgyp_numbers(data.dom_tbl["target_name"]),
+        proteins=args.proteins,
+        seed=args.seed,
+    )
+    data.local_index = directory / "local_index"
+    local_index(data.database, data.local_index)
+
+    data.tree = directory / "tree.nwk"
+    data.tree.write_text(random_newick(args.leaves, seed=args.seed))
+    data.tree_filter = directory / "tree_filter.csv"
+    filter_table(args.leaves, seed=args.seed).to_csv(data.tree_filter, index=False)
+    data.new_sequences = [f"new{i}" for i in range(args.new_sequences)]
+    names = [f"MGYP{i:012d}/1-100" for i in range(args.leaves)] + data.new_sequences
+    alignment = aligned_sequences(names, seed=args.seed)
+    data.alignment = directory / "alignment.afa"
+    write_afa(data.alignment, alignment)
+    write_stockholm(data.alignment.with_suffix(".sto"), alignment)
+    return data
+
+
+def measure(function, repeats: int) -> dict:
+    runs = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": min(runs),
+        "median_seconds": statistics.median(runs),
+        "runs": runs,
+        "peak_mb": peak / 1e6,
+    }
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print(
+        f"\n{'benchmark':<26}{'base s':>9}{'new s':>9}{'ratio':>8}"
+        f"{'base MB':>10}{'new MB':>9}  (base {baseline['commit'][:10]})"
+    )
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        print(
+            f"{name:<26}{base['seconds']:>9.3f}{result['seconds']:>9.3f}"
+            f"{result['seconds'] / base['seconds']:>8.2f}"
+            f"{base['peak_mb']:>10.1f}{result['peak_mb']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--hits", type=int, default=20000, help="target proteins")
+    parser.add_argument(
+        "--proteins",
+        type=int,
+        default=1000000,
+        help="proteins in the architecture database",
+    )
+    parser.add_argument("--leaves", type=int, default=5000, help="tree leaves")
+    parser.add_argument(
+        "--new-sequences",
+        type=int,
+        default=100,
+        help="sequences placed into the tree by place_sequences",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="run these benchmarks"
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    results = {
+        "commit": commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            key: getattr(args, key)
+            for key in ["hits", "proteins", "leaves", "new_sequences", "seed"]
+        },
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        data = generate(Path(tmpdir), args)
+        print(f"generated inputs in {time.perf_counter() - start:.1f}s")
+        print(f"{'benchmark':<26}{'command':<10}{'seconds':>9}{'peak MB':>10}")
+        for name, (command, setup) in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            result = {"command": command, **measure(setup(data), args.repeats)}
+            results["results"][name] = result
+            print(
+                f"{name:<26}{command:<10}{result['seconds']:>9.3f}"
+                f"{result['peak_mb']:>10.1f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(results, json.load(fin))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+NODE_COLOR = "rgb(100,100,100)"
+HIGHLIGHT_COLOR = "rgb(0, 200, 20)"
+QUERY_COLOR = "rgb(200,0,0)"
+# hit table columns dom_accessions() reads
+DOM_ACCESSION_COLUMNS = ["target_name", "ndom", "env_from", "env_to"]
+# MGnify protein accessions, hits of these targets are keyed by their numbers
+MGYP_ACCESSION = r"MGYP\d{12}"
+
+
+def dom_accessions(df: pd.DataFrame) -> pd.Series:
+    """
+    Names of the hit domains as used in alignments and trees: the target name, _ndom for
+    all but the first domain and the envelope coordinates, e.g. MGYP000000000001_2/10-120
+    :param df: hit table with target_name, ndom, env_from and env_to columns
+    :return:
+    """
+    domain = df["ndom"].astype(str).radd("_").where(df["ndom"] > 1, "")
+    return (
+        df["target_name"]
+        + domain
+        + "/"
+        + df["env_from"].astype(str)
+        + "-"
+        + df["env_to"].astype(str)
+    )
+
+
+def mgyp_numbers(accessions: pd.Series) -> np.ndarray:
+    """
+    Numeric part of MGYP accessions, e.g. MGYP000000000001 -> 1. Protein accessions
+    are parsed into these int64 keys once, joins, sorts and lookups run on the numbers
+    and accessions are only rendered again for output with mgyp_accessions().
+    """
+    try:
+        return pd.Series(accessions).str[4:].astype(np.int64).to_numpy()
+    except ValueError:
+        check_accessions(accessions)
+        raise
+
+
+def _mgyp_mask(names: pd.Series) -> np.ndarray:
+    return names.str.fullmatch(MGYP_ACCESSION).to_numpy(dtype=bool, na_value=False)
+
+
+def check_accessions(names: Iterable[str], source: Optional[str] = None) -> None:
+    """
+    Raise a ValueError naming the first target that is not an MGnify protein accession,
+    for the commands that look the targets up in MGnify (domain). Called where the names
+    are read, before any work is done on them.
+    :param names: target names
+    :param source: file the names were read from, for the message
+    :return:
+    """
+    names = pd.Series(names)
+    valid = _mgyp_mask(names)
+    if not valid.all():
+        origin = f" in {source}" if source is not None else ""
+        raise ValueError(
+            f"Target {names[~valid].iloc[0]!r}{origin} is not an MGnify protein "
+            "accession (MGYP followed by 12 digits). Only searches against MGnify "
+            "proteins are supported"
+        )
+
+
+def target_keys(names: Iterable[str], numeric: Optional[bool] = None) -> np.ndarray:
+    """
+    Keys hits are joined, sorted and looked up by. MGnify protein accessions are parsed
+    into their int64 numbers (see mgyp_numbers()), targets of other sequence databases
+    keep their names, which are slower to compare.
+    :param names: target names
+    :param numeric: parse the names into numbers, by default if all of them are MGnify
+    protein accessions
+    :return: int64 numbers or object array of names
+    """
+    names = pd.Series(names)
+    if numeric is None:
+        numeric = bool(_mgyp_mask(names).all())
+    return mgyp_numbers(names) if numeric else names.astype(object).to_numpy()
+
+
+def target_names(keys: np.ndarray) -> np.ndarray:
+    """Target names of target_keys(), as object array"""
+    keys = np.asarray(keys)
+    if keys.dtype.kind in "iu":
+        return mgyp_accessions(keys)
+    return keys.astype(object)
+
+
+def mgyp_accessions(numbers: np.ndarray) -> np.ndarray:
+    """MGYP accessions of numbers, zero padded to 12 digits"""
+    digits = np.asarray(numbers, dtype=np.int64).astype("U12")
+    return np.char.add("MGYP", np.char.zfill(digits, 12)).astype(object)
+
+
+def name_index(names: List[Optional[str]]) -> pd.Series:
+    """
+    name -> node position lookup, built once per tree. Unnamed nodes are left out and
+    duplicated names point to their first node.
+    :param names: node names in node order
+    :return:
+    """
+    index = pd.Series(np.arange(len(names)), index=pd.Index(names, dtype=object))
+    index = index[index.index.notna()]
+    return index[~index.index.duplicated()]
+
+
+def node_positions(index: pd.Series, keys: pd.Series) -> np.ndarray:
+    """
+    Positions of the nodes named by keys
+    :param index: name index from name_index()
+    :param keys: node names to look up
+    :return:
+    """
+    positions = index.reindex(keys.to_numpy())
+    missing = positions.index[positions.isna()]
+    if len(missing):
+        raise ValueError(f"{len(missing)} hits not found in tree, e.g. {missing[0]}")
+    return positions.to_numpy(dtype=np.int64)
+
+
+def hover_text(metadata: pd.DataFrame) -> pd.Series:
+    """Hover text of the hit nodes, one entry per metadata row"""
+    return (
+        metadata["dom_acc"]
+        + "<br>Hit Coverage: "
+        + metadata["coverage_hit"].astype(str)
+        + "<br>Query Coverage: "
+        + metadata["coverage_query"].astype(str)
+        + "<br>Similarity: "
+        + metadata["similarity"].astype(str)
+        + "<br>Identity: "
+        + metadata["identity"].astype(str)
+    )
+
+
+def annotate_nodes(
+    names: List[Optional[str]],
+    metadata: pd.DataFrame,
+    of_interest: Iterable[str],
+    query: str,
+):
+    """
+    Join the filter metadata onto the tree nodes as whole columns
+    :param names: node names in node order
+    :param metadata: filter output with a dom_acc column
+    :param of_interest: names of the nodes to highlight
+    :param query: name of the query node
+    :return: hover text list and color array, both in node order
+    """
+    index = name_index(names)
+    positions = node_positions(index, metadata["dom_acc"])
+
+    text = np.array(names, dtype=object)
+    text[positions] = hover_text(metadata).to_numpy()
+
+    color = np.full(len(names), NODE_COLOR, dtype=object)
+    highlight = metadata["dom_acc"].isin(set(of_interest)).to_numpy()
+    color[positions[highlight]] = HIGHLIGHT_COLOR
+    color[node_positions(index, pd.Series([query]))] = QUERY_COLOR
+    return text.tolist(), color
+
+
+def domain_maps(metadata: pd.DataFrame):
+    """
+    Pfam architecture of each hit and the name of each Pfam accession
+    :param metadata: domain filter output with Pfams and domain_names columns
+    :return: {dom_acc: [Pfam accessions]}, {Pfam accession: domain name}
+    """
+    accessions = metadata["Pfams"].str.split("-")
+    domain_names = metadata["domain_names"].str.split("~")
+    pfams = dict(zip(metadata["dom_acc"], accessions))
+    acc_to_name = dict(zip(accessions.explode(), domain_names.explode()))
+    return pfams, acc_to_name
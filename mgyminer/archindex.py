@@ -0,0 +1,160 @@
+from functools import reduce
+from pathlib import Path
+from typing import Iterable, Optional, Sequence, Union
+
+import numpy as np
+
+from mgyminer.database import proteinDB
+
+
+class architectureIndex:
+    """
+    Inverted index from Pfam accession to the architectures containing it.
+    Architectures are stored sorted by id, the postings of each Pfam are the sorted row
+    positions of its architectures (CSR layout: postings[offsets[i]:offsets[i + 1]]
+    belong to tokens[i]). Strict and loose selections become intersections and unions of
+    postings instead of LIKE/REGEXP scans over the architecture table.
+    """
+
+    def __init__(self, ids, pfams, names, tokens, offsets, postings, signature=()):
+        self.ids = ids
+        self.pfams = pfams
+        self.names = names
+        self.tokens = tokens
+        self.offsets = offsets
+        self.postings = postings
+        self.signature = tuple(signature)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple], signature: Sequence = ()):
+        """
+        Build the index from architecture table rows
+        :param rows: (id, pfams, names) rows, pfams joined by "-" and names by "~".
+        Rows without pfams or names are left out as they never appear in selections.
+        :param signature: (row count, max id) of the table the rows were read from
+        :return:
+        """
+        rows = sorted(row for row in rows if row[1] is not None and row[2] is not None)
+        postings = {}
+        for position, (_, pfams, _) in enumerate(rows):
+            for pfam in set(pfams.split("-")):
+                postings.setdefault(pfam, []).append(position)
+        tokens = sorted(postings)
+        lengths = [len(postings[token]) for token in tokens]
+        return cls(
+            np.array([row[0] for row in rows], dtype=np.int64),
+            np.array([row[1] for row in rows], dtype=str),
+            np.array([row[2] for row in rows], dtype=str),
+            np.array(tokens, dtype=str),
+            np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+            np.array(
+                [position for token in tokens for position in postings[token]],
+                dtype=np.int64,
+            ),
+            signature,
+        )
+
+    @classmethod
+    def load(cls, db: proteinDB, file: Optional[Union[Path, str]] = None):
+        """
+        Load the index cached in file, build and cache it if it is missing or the
+        architecture table changed since it was built
+        :param db: database with the architecture table
+        :param file: cache location, db.index_file by default
+        :return:
+        """
+        file = Path(db.index_file if file is None else file)
+        signature = tuple(
+            int(value or 0)
+            for value in db.execute(
+                "SELECT COUNT(*), MAX(id) FROM architecture",
+                label="architecture_signature",
+            )[0]
+        )
+        if file.is_file():
+            index = cls.read(file)
+            if index.signature == signature:
+                return index
+        rows = db.execute(
+            "SELECT id, pfams, names FROM architecture", label="architecture_index"
+        )
+        index = cls.from_rows(rows, signature)
+        index.save(file)
+        return index
+
+    @classmethod
+    def read(cls, file: Union[Path, str]):
+        """Read an index saved with save()"""
+        with np.load(file) as data:
+            return cls(
+                data["ids"],
+                data["pfams"],
+                data["names"],
+                data["tokens"],
+                data["offsets"],
+                data["postings"],
+                data["signature"].tolist(),
+            )
+
+    def save(self, file: Union[Path, str]) -> None:
+        with open(file, "wb") as fout:
+            np.savez(
+                fout,
+                ids=self.ids,
+                pfams=self.pfams,
+                names=self.names,
+                tokens=self.tokens,
+                offsets=self.offsets,
+                postings=self.postings,
+                signature=np.array(self.signature, dtype=np.int64),
+            )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def positions_of(self, pfam: str) -> np.ndarray:
+        """Sorted row positions of the architectures containing pfam"""
+        i = np.searchsorted(self.tokens, pfam)
+        if i == len(self.tokens) or self.tokens[i] != pfam:
+            return np.empty(0, dtype=np.int64)
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.postings[start:stop]
+
+    def select(
+        self, pfams: Sequence[str], strict: bool, exclude: Sequence[str] = ()
+    ) -> np.ndarray:
+        """
+        Row positions of the architectures containing all (strict) or any of the pfams
+        and none of the excluded ones
+        :param pfams: Pfam accessions
+        :param strict: intersect instead of unite the postings
+        :param exclude: Pfam accessions that must not be part of the architecture
+        :return: sorted row positions
+        """
+        postings = [self.positions_of(pfam) for pfam in pfams]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        combine = np.intersect1d if strict else np.union1d
+        selected = reduce(combine, postings)
+        for pfam in exclude:
+            selected = np.setdiff1d(selected, self.positions_of(pfam))
+        return selected
+
+    def token_lists(self):
+        """
+        Architecture -> Pfam inversion of the postings
+        :return: offsets and token positions, the Pfams of architecture row i are
+        tokens[token_ids[offsets[i]:offsets[i + 1]]]
+        """
+        token_of_posting = np.repeat(np.arange(len(self.tokens)), np.diff(self.offsets))
+        order = np.argsort(self.postings, kind="stable")
+        counts = np.bincount(self.postings, minlength=len(self))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return offsets, token_of_posting[order]
+
+    def rows_of(self, arch_ids: np.ndarray) -> np.ndarray:
+        """Row positions of architecture ids, -1 for ids not in the index"""
+        if not len(self.ids):
+            return np.full(len(arch_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, arch_ids), len(self.ids) - 1)
+        return np.where(self.ids[positions] == arch_ids, positions, -1)
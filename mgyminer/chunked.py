@@ -0,0 +1,356 @@
+import json
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from mgyminer.annotation import target_keys, target_names
+from mgyminer.filter import (
+    ALIGNMENT_KEY,
+    alignment_entries,
+    alignment_index,
+    alignment_targets,
+    calculate_coverage,
+    domtable_chunks,
+    filter_hits,
+    sort_order,
+    threshold_expression,
+)
+from mgyminer.profiling import stage
+from mgyminer.tables import tableWriter
+
+# rows parsed to estimate the memory of a domain table row
+PROBE_ROWS = 10000
+# a chunk is held about this many times while it is parsed, filtered and sorted
+CHUNK_COPIES = 4
+# sorted runs merged at once, more runs are merged in several passes
+MERGE_FAN_IN = 32
+# alignments converted from Python objects to arrays at once
+SCORE_BATCH = 100000
+# byte-wise complement, see _descending_names()
+COMPLEMENT = bytes(range(255, -1, -1))
+
+
+def alignment_scores(
+    hmmer_output_file: Path, alignments_file: Optional[Path] = None
+) -> pd.DataFrame:
+    """
+    alignment_table() streamed from the phmmer output. Only the keys, identity and
+    similarity of the alignments are held, about 40 bytes per domain, not the
+    sequences of the alignment dictionary.
+    :param hmmer_output_file: Path to the phmmer output
+    :param alignments_file: also write the alignments there, entry by entry, in the
+    alignments.json layout of load_search()
+    :return:
+    """
+    parts = []
+    batch = []
+
+    def flush():
+        parts.append(
+            pd.DataFrame(
+                {
+                    "MGYP": alignment_targets([key for key, _ in batch]),
+                    "target_start": np.array(
+                        [entry["target_start"] for _, entry in batch], dtype=np.int64
+                    ),
+                    "target_end": np.array(
+                        [entry["target_end"] for _, entry in batch], dtype=np.int64
+                    ),
+                    "perc_ident": np.array(
+                        [entry["perc_ident"] for _, entry in batch], dtype=np.float64
+                    ),
+                    "perc_sim": np.array(
+                        [entry["perc_sim"] for _, entry in batch], dtype=np.float64
+                    ),
+                }
+            )
+        )
+        batch.clear()
+
+    fout = None
+    if alignments_file is not None:
+        partial = alignments_file.with_name(alignments_file.name + ".partial")
+        fout = open(partial, "w")
+        fout.write("{")
+    try:
+        for i, (key, entry) in enumerate(alignment_entries(hmmer_output_file)):
+            if fout is not None:
+                # same text as json.dump() of the whole dictionary
+                fout.write(f"{', ' if i else ''}{json.dumps(key)}: {json.dumps(entry)}")
+            batch.append((key, entry))
+            if len(batch) == SCORE_BATCH:
+                flush()
+        if batch or not parts:
+            flush()
+    finally:
+        if fout is not None:
+            fout.write("}")
+            fout.close()
+    if fout is not None:
+        # only a complete file replaces the cache
+        os.replace(partial, alignments_file)
+    if any(part["MGYP"].dtype == object for part in parts):
+        # a batch with other targets, all are keyed by name
+        for part in parts:
+            part["MGYP"] = target_names(part["MGYP"])
+    table = pd.concat(parts, ignore_index=True)
+    # like the dictionary, a repeated alignment key keeps its last values
+    return table.drop_duplicates(ALIGNMENT_KEY, keep="last", ignore_index=True)
+
+
+def _descending_names(names: np.ndarray) -> np.ndarray:
+    """Keys that sort names in descending order, as complemented UTF-8 bytes"""
+    # terminated by the largest byte, a name sorts after its extensions
+    return np.array(
+        [name.encode().translate(COMPLEMENT) + b"\xff" for name in names], dtype=object
+    )
+
+
+def _merge_keys(
+    table: pd.DataFrame,
+    columns: List[str],
+    orientation: List[bool],
+    numeric: bool = True,
+):
+    """
+    Sort key arrays of a table that all sort ascending, see sort_order()
+    :param table: sorted block
+    :param columns: sort columns from sort_order()
+    :param orientation: ascending flags from sort_order()
+    :param numeric: target names are MGYP accessions, see hit_keys()
+    :return:
+    """
+    keys = []
+    for column, ascending in zip(columns, orientation):
+        if column != "target_name":
+            values = table[column].to_numpy()
+        elif numeric:
+            values = target_keys(table["target_name"], numeric=True)
+        else:
+            names = target_keys(table["target_name"], numeric=False)
+            keys.append(names if ascending else _descending_names(names))
+            continue
+        keys.append(values if ascending else -values)
+    return keys
+
+
+class _sortedRun:
+    """Reads a run written by _write_blocks() block by block"""
+
+    def __init__(
+        self,
+        file: Path,
+        columns: List[str],
+        orientation: List[bool],
+        numeric: bool = True,
+    ):
+        self._fin = open(file, "rb")
+        self.columns = columns
+        self.orientation = orientation
+        self.numeric = numeric
+        self.block = None
+        self.keys = None
+        self.next_block()
+
+    def next_block(self) -> None:
+        try:
+            self.block = pickle.load(self._fin)
+        except EOFError:
+            self.block = None
+            self._fin.close()
+            return
+        self.keys = _merge_keys(
+            self.block, self.columns, self.orientation, self.numeric
+        )
+
+    def last_key(self) -> tuple:
+        return tuple(key[-1] for key in self.keys)
+
+    def take(self, boundary: tuple):
+        """Remove and return the rows of the current block up to boundary"""
+        low, high = 0, len(self.block)
+        while low < high:
+            middle = (low + high) // 2
+            if tuple(key[middle] for key in self.keys) <= boundary:
+                low = middle + 1
+            else:
+                high = middle
+        rows, keys = self.block.iloc[:low], [key[:low] for key in self.keys]
+        self.block = self.block.iloc[low:]
+        self.keys = [key[low:] for key in self.keys]
+        if self.block.empty:
+            self.next_block()
+        return rows, keys
+
+
+def _write_blocks(fout, table: pd.DataFrame, block_rows: int) -> None:
+    """Append a sorted table to a run as blocks of block_rows rows"""
+    for start in range(0, len(table), block_rows):
+        end = start + block_rows
+        pickle.dump(table.iloc[start:end], fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def merge_runs(
+    runs: List[Path],
+    columns: List[str],
+    orientation: List[bool],
+    numeric: bool = True,
+) -> Iterator[pd.DataFrame]:
+    """
+    k-way merge of sorted runs. Holds one block per run: each round takes the rows of
+    all blocks up to the smallest last key of the blocks, which empties at least one
+    block, and sorts only these rows.
+    :param runs: files of sorted blocks, see _write_blocks()
+    :param columns: sort columns from sort_order()
+    :param orientation: ascending flags from sort_order()
+    :param numeric: target names are MGYP accessions, see hit_keys()
+    :return: generator of sorted blocks
+    """
+    active = [_sortedRun(run, columns, orientation, numeric) for run in runs]
+    active = [run for run in active if run.block is not None]
+    while active:
+        boundary = min(run.last_key() for run in active)
+        pieces = [run.take(boundary) for run in active]
+        rows = pd.concat([piece for piece, _ in pieces])
+        keys = [
+            np.concatenate([piece_keys[i] for _, piece_keys in pieces])
+            for i in range(len(columns))
+        ]
+        # np.lexsort sorts by the last key first
+        yield rows.iloc[np.lexsort(keys[::-1])]
+        active = [run for run in active if run.block is not None]
+
+
+def external_sort(
+    runs: List[Path],
+    columns: List[str],
+    orientation: List[bool],
+    directory: Path,
+    block_rows: int,
+    numeric: bool = True,
+) -> Iterator[pd.DataFrame]:
+    """Merge runs in passes of MERGE_FAN_IN runs until one pass merges all of them"""
+    generation = 0
+    while len(runs) > MERGE_FAN_IN:
+        merged = []
+        for start in range(0, len(runs), MERGE_FAN_IN):
+            group = runs[start:][:MERGE_FAN_IN]
+            run = directory / f"merge{generation}_{start}.pkl"
+            with open(run, "wb") as fout:
+                for block in merge_runs(group, columns, orientation, numeric):
+                    _write_blocks(fout, block, block_rows)
+            for done in group:
+                done.unlink()
+            merged.append(run)
+        runs = merged
+        generation += 1
+    yield from merge_runs(runs, columns, orientation, numeric)
+
+
+def chunk_rows(dom_tbl_file: Path, memory_budget: int, compact: bool = False) -> int:
+    """
+    Domain table rows per chunk within a memory budget, from the size of the first
+    PROBE_ROWS rows
+    :param dom_tbl_file: Path to dom_tbl.txt
+    :param memory_budget: bytes
+    :param compact: whether chunks are parsed into COMPACT_DTYPES
+    :return:
+    """
+    probe = next(domtable_chunks(dom_tbl_file, PROBE_ROWS, compact))
+    if probe.empty:
+        return PROBE_ROWS
+    row_bytes = probe.memory_usage(deep=True).sum() / len(probe)
+    return max(1000, int(memory_budget / (row_bytes * CHUNK_COPIES)))
+
+
+def filter_chunked(
+    hmmer_output_file: Path,
+    output: Union[Path, str],
+    evalue: Optional[float] = None,
+    coverage: Optional[str] = None,
+    sort: Optional[List[str]] = None,
+    memory_budget: int = 1_000_000_000,
+    output_format: Optional[str] = None,
+    compact: bool = False,
+    where: Optional[str] = None,
+) -> int:
+    """
+    Out-of-core filter: the domain table is parsed, extended with coverage, identity and
+    similarity and filtered chunk by chunk, and the hits are streamed to the output.
+    With sort, each chunk is sorted and spilled to a run next to the output, and the
+    runs are merged (external merge sort). The output equals the in-memory filter.
+    :param hmmer_output_file: Path to the phmmer output, with dom_tbl.txt next to it
+    :param output: output Path
+    :param evalue: highest e-value kept
+    :param coverage: query coverage range in percent, e.g. "50-100"
+    :param sort: eval, coverage, similarity and/or identity
+    :param memory_budget: bytes for the hit chunks and merge blocks. The alignment keys
+    and scores (about 40 bytes per domain) are held in addition
+    :param output_format: one of TABLE_FORMATS, chosen by the extension of output if None
+    :param compact: parse the chunks into COMPACT_DTYPES
+    :param where: filter expression over the hit table columns, see filterExpression
+    :return: number of hits written
+    """
+    hmmer_output_file = Path(hmmer_output_file)
+    dom_tbl_file = hmmer_output_file.parent / "dom_tbl.txt"
+    alignments_file = hmmer_output_file.parent / "alignments.json"
+    with stage("alignment scores"):
+        scores = alignment_scores(
+            hmmer_output_file, None if alignments_file.is_file() else alignments_file
+        )
+        index = alignment_index(scores)
+
+    rows = chunk_rows(dom_tbl_file, memory_budget, compact)
+    # parsed once, not per chunk
+    where = threshold_expression(where=where)
+    columns, orientation = sort_order(sort)
+    block_rows = max(1000, rows // MERGE_FAN_IN)
+    with tempfile.TemporaryDirectory(
+        dir=Path(output).parent, prefix=".mgyminer_sort"
+    ) as tmpdir, tableWriter(output, output_format) as writer:
+        runs = []
+        empty = None
+        for number, chunk in enumerate(domtable_chunks(dom_tbl_file, rows, compact)):
+            with stage("coverage"):
+                calculate_coverage(chunk)
+            hits = filter_hits(
+                chunk,
+                None,
+                evalue,
+                coverage,
+                sort,
+                table=scores,
+                index=index,
+                where=where,
+            )
+            if columns is None:
+                with stage("write"):
+                    writer.write(hits)
+            else:
+                empty = hits.iloc[:0]
+                with stage("spill"):
+                    run = Path(tmpdir) / f"run{number}.pkl"
+                    with open(run, "wb") as fout:
+                        _write_blocks(fout, hits, block_rows)
+                    runs.append(run)
+        if columns is not None:
+            with stage("merge"):
+                for block in external_sort(
+                    runs,
+                    columns,
+                    orientation,
+                    Path(tmpdir),
+                    block_rows,
+                    # merged by the same keys the chunks were sorted by
+                    numeric=scores["MGYP"].dtype.kind in "iu",
+                ):
+                    writer.write(block)
+            if writer.rows == 0:
+                # no hit passed, still write the header / schema
+                writer.write(empty)
+    return writer.rows
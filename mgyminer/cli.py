@@ -1,26 +1,52 @@
 #! /usr/bin/env python3
 
 import argparse
+import importlib
+from contextlib import nullcontext
 from pathlib import Path
 
-from mgyminer.phmmer import phmmer
-from mgyminer.phylplot import plot_tree
-from mgyminer.phyltree import build_tree
-from mgyminer.utils import export_sequences
+from mgyminer.options import COLLAPSE_MODES, DOMAIN_STRATEGIES, TABLE_FORMATS
+from mgyminer.profiling import PROFILERS, profiled, stage
 
-from mgyminer.filter import (  # isort:skip
-    domain_filter,
-    filter,
-    plot_residue_histogram,
-    residue_filter,
-)
+# subcommand -> (module, function). The modules pull in pandas, plotly, Bio, mysql and
+# hmmer, so they are only imported once the parsed subcommand runs.
+COMMANDS = {
+    "phmmer": ("mgyminer.phmmer", "phmmer"),
+    "filter": ("mgyminer.filter", "filter"),
+    "residue": ("mgyminer.filter", "residue_filter"),
+    "residue_check": ("mgyminer.filter", "plot_residue_histogram"),
+    "tree": ("mgyminer.phyltree", "build_tree"),
+    "tree_vis": ("mgyminer.phylplot", "plot_tree"),
+    "export": ("mgyminer.utils", "export_sequences"),
+    "domain": ("mgyminer.filter", "domain_filter"),
+    "domain_index": ("mgyminer.filter", "export_domain_index"),
+    "pipeline": ("mgyminer.pipeline", "run_pipeline"),
+    "serve": ("mgyminer.server", "serve"),
+}
+
+
+def load_command(name):
+    """
+    Import the function of a subcommand
+    :param name: subcommand in COMMANDS
+    :return:
+    """
+    module, function = COMMANDS[name]
+    return getattr(importlib.import_module(module), function)
 
 
 def main():
     parser = create_parser()
     args = parser.parse_args()
-    if "func" in dir(args):
-        args.func(args)
+    if "command" in dir(args):
+        if args.profile:
+            profile = profiled(args.command, args.profiler, args.profile_output)
+        else:
+            profile = nullcontext()
+        with profile:
+            with stage("import"):
+                command = load_command(args.command)
+            command(args)
     else:
         parser.print_help()
 
@@ -30,6 +56,26 @@ def create_parser():
     parser.add_argument(
         "--version", "-v", action="version", version="0.0.1", help="show version"
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile the subcommand, print a per stage breakdown and the hottest "
+        "functions to stderr and save the raw profile",
+    )
+    parser.add_argument(
+        "--profiler",
+        default="cprofile",
+        choices=PROFILERS,
+        help="cprofile: deterministic, main thread only. sample: low overhead "
+        "sampling of all threads",
+    )
+    parser.add_argument(
+        "--profile-output",
+        type=Path,
+        metavar="path/to/profile",
+        help="file for the raw profile, mgyminer_<command>.prof (cprofile) or "
+        "mgyminer_<command>.folded (sample, collapsed stacks) by default",
+    )
     subparsers = parser.add_subparsers(help="commands")
 
     # Arguments for sequence search
@@ -41,7 +87,7 @@ def create_parser():
         "--target", "-t", type=Path, help="target sequence database to search against"
     )
     phmmer_parser.add_argument("--output", "-o", type=Path, help="output path")
-    phmmer_parser.set_defaults(func=phmmer)
+    phmmer_parser.set_defaults(command="phmmer")
 
     # Arguments for filter step
     filter_parser = subparsers.add_parser(
@@ -51,7 +97,9 @@ def create_parser():
         "--input",
         type=Path,
         metavar="path/to/search_output.txt",
-        help="Path to sequence search output file",
+        help="Path to sequence search output file. Hits of MGnify proteins (MGYP "
+        "accessions) are joined and sorted by accession number, searches with other "
+        "target names by name, which is slower",
     )
     filter_parser.add_argument(
         "--coverage",
@@ -81,7 +129,58 @@ def create_parser():
         metavar="path/to/filter_output.csv",
         help="Path to the desired output file",
     ),
-    filter_parser.set_defaults(func=filter)
+    filter_parser.add_argument(
+        "--output-format",
+        choices=TABLE_FORMATS,
+        default=None,
+        help="Format of the output file, by default chosen by its extension "
+        "(.parquet, .arrow) and CSV otherwise. Parquet and Arrow keep the column types "
+        "and let downstream commands read only the columns they need",
+    )
+    filter_parser.add_argument(
+        "--compact",
+        default=False,
+        action="store_true",
+        help="Hold the hit table in a compact schema: categorical strings, int32 "
+        "coordinates and float32 scores. Cuts its memory several fold on large searches",
+    )
+    filter_parser.add_argument(
+        "--memory-report",
+        default=False,
+        action="store_true",
+        help="Print the memory footprint of each column of the result to stderr",
+    )
+    filter_parser.add_argument(
+        "--top",
+        "--limit",
+        type=int,
+        required=False,
+        metavar="N",
+        help="Keep only the N best target proteins with all their domains, in --sort "
+        "order. Selects the candidates first and sorts only those",
+    )
+    filter_parser.add_argument(
+        "--memory-budget",
+        type=int,
+        required=False,
+        metavar="MB",
+        help="Out-of-core mode for searches larger than memory: parse, filter and sort "
+        "the hits in chunks within about this much memory and stream them to --output. "
+        "Sorting spills runs next to the output and merges them",
+    )
+    filter_parser.add_argument(
+        "--where",
+        type=str,
+        required=False,
+        metavar='"score >= 50 and not biome in (...)"',
+        help="Keep only the hits matching an expression over any hit table column "
+        "(score, bias, acc, tlen, identity, similarity, biome, ...): comparisons "
+        "(<, <=, >, >=, ==, !=), column in ('a', 'b'), combined with and, or, not and "
+        "parentheses. Strings are quoted, eval and coverage name the e-value and "
+        "coverage_query columns (coverage as a fraction, 0-1). Applied together with "
+        "--eval and --coverage as one mask",
+    )
+    filter_parser.set_defaults(command="filter")
 
     residue_parser = subparsers.add_parser(
         "residue", help="filter target proteins by residue features"
@@ -92,7 +191,9 @@ def create_parser():
         type=Path,
         required=True,
         metavar="path/to/filter_output.csv",
-        help="Path to sequence search output file",
+        help="Path to sequence search output file. Hits of MGnify proteins (MGYP "
+        "accessions) are looked up by accession number, other target names by name, "
+        "which is slower",
     )
     residue_parser.add_argument(
         "--residue",
@@ -111,7 +212,36 @@ def create_parser():
         metavar="path/to/filter_output.csv",
         help="Path to the desired output file",
     )
-    residue_parser.set_defaults(func=residue_filter)
+    residue_parser.add_argument(
+        "--output-format",
+        choices=TABLE_FORMATS,
+        default=None,
+        help="Format of the output file, by default chosen by its extension "
+        "(.parquet, .arrow) and CSV otherwise. Parquet and Arrow keep the column types "
+        "and let downstream commands read only the columns they need",
+    )
+    residue_parser.add_argument(
+        "--compact",
+        default=False,
+        action="store_true",
+        help="Hold the hit table in a compact schema: categorical strings, int32 "
+        "coordinates and float32 scores. Cuts its memory several fold on large searches",
+    )
+    residue_parser.add_argument(
+        "--memory-report",
+        default=False,
+        action="store_true",
+        help="Print the memory footprint of each column of the result to stderr",
+    )
+    residue_parser.add_argument(
+        "--where",
+        type=str,
+        required=False,
+        metavar='"identity >= 40"',
+        help="Keep only the input hits matching a filter expression, see filter "
+        "--where. Parquet and Arrow inputs apply it while reading",
+    )
+    residue_parser.set_defaults(command="residue")
 
     residue_checker_parser = subparsers.add_parser(
         "residue_check",
@@ -140,7 +270,7 @@ def create_parser():
         default=85,
         help="Plot width of the barchart",
     )
-    residue_checker_parser.set_defaults(func=plot_residue_histogram)
+    residue_checker_parser.set_defaults(command="residue_check")
 
     phylogenetic_tree_parser = subparsers.add_parser(
         "tree", help="build a phylogenetic tree"
@@ -148,12 +278,18 @@ def create_parser():
     phylogenetic_tree_parser.add_argument(
         "--input",
         type=Path,
+        nargs="+",
         required=True,
-        help="Path to filter output with sequences for tree building",
+        help="Path(s) to filter output with sequences for tree building. "
+        "Multiple inputs are built in one batch sharing the --threads budget",
     )
 
     phylogenetic_tree_parser.add_argument(
-        "--query", type=Path, required=True, help="Path to query seq"
+        "--query",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="Path to query seq, either one for all inputs or one per input",
     )
 
     phylogenetic_tree_parser.add_argument(
@@ -165,8 +301,21 @@ def create_parser():
     phylogenetic_tree_parser.add_argument(
         "--output", type=Path, required=False, help="Path/Filename of output tree"
     )
+    phylogenetic_tree_parser.add_argument(
+        "--update",
+        default=False,
+        action="store_true",
+        help="Only align hits missing from an existing alignment and place them into "
+        "the existing tree instead of rebuilding both from scratch",
+    )
+    phylogenetic_tree_parser.add_argument(
+        "--threads",
+        type=int,
+        default=3,
+        help="Number of cores shared by all alignment and tree building jobs",
+    )
 
-    phylogenetic_tree_parser.set_defaults(func=build_tree)
+    phylogenetic_tree_parser.set_defaults(command="tree")
 
     tree_vis_parser = subparsers.add_parser(
         "tree_vis", help="visualise phylogenetic tree"
@@ -202,7 +351,54 @@ def create_parser():
         help="Path to filter output with sequences for tree building",
     )
 
-    tree_vis_parser.set_defaults(func=plot_tree)
+    tree_vis_parser.add_argument(
+        "--reference",
+        type=str,
+        required=False,
+        help="Name of the sequence whose tree distance is used for --min/--max "
+        "instead of the query",
+    )
+    tree_vis_parser.add_argument(
+        "--clade",
+        type=str,
+        nargs="+",
+        required=False,
+        help="Only highlight leaves in the smallest clade containing these sequences",
+    )
+
+    tree_vis_parser.add_argument(
+        "--webgl",
+        default=False,
+        action="store_true",
+        help="Draw branches and domains as a few batched WebGL traces instead of one "
+        "shape per branch/domain. Use this for large trees",
+    )
+
+    tree_vis_parser.add_argument(
+        "--collapse",
+        choices=COLLAPSE_MODES,
+        required=False,
+        help="Collapse clades into summary glyphs by depth (edges from the root), size "
+        "(number of leaves) or distance (branch length from clade root to its leaves). "
+        "Implies --webgl",
+    )
+    tree_vis_parser.add_argument(
+        "--collapse-threshold",
+        type=float,
+        nargs="+",
+        default=[10],
+        help="Threshold(s) for --collapse. With several thresholds the plot gets a "
+        "dropdown to switch between the collapse levels",
+    )
+
+    tree_vis_parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("tree_vis.html"),
+        help="Path to the HTML output file",
+    )
+
+    tree_vis_parser.set_defaults(command="tree_vis")
 
     export_parser = subparsers.add_parser(
         "export", help="export Protein sequences from filter results to FASTA file"
@@ -211,7 +407,9 @@ def create_parser():
         "--filter",
         type=Path,
         required=True,
-        help="Path to filter output of which fasta sequences should be acquired",
+        help="Path to filter output of which fasta sequences should be acquired. The "
+        "target names are fetched as they are, so they must be names of the sequence "
+        "database",
     )
     export_parser.add_argument(
         "--output",
@@ -219,7 +417,7 @@ def create_parser():
         required=True,
         help="Output location for protein sequences FASTA",
     )
-    export_parser.set_defaults(func=export_sequences)
+    export_parser.set_defaults(command="export")
 
     domain_parser = subparsers.add_parser(
         "domain", help="filter target proteins by PFAM domains"
@@ -229,7 +427,8 @@ def create_parser():
         type=Path,
         required=True,
         metavar="path/to/filter_output.csv",
-        help="Path to sequence search output file",
+        help="Path to sequence search output file. Domain architectures are only "
+        "known for MGnify proteins, all targets must be MGYP accessions",
     )
     domain_parser.add_argument(
         "--arch", "-a", nargs="+", help="Pfams that should be filtered for"
@@ -247,8 +446,174 @@ def create_parser():
         metavar="path/to/filter_output.csv",
         help="Path to the desired output file",
     )
+    domain_parser.add_argument(
+        "--exclude",
+        "-x",
+        nargs="+",
+        default=[],
+        help="Pfams that must not be part of the architecture",
+    )
+    domain_parser.add_argument(
+        "--local-index",
+        type=Path,
+        required=False,
+        metavar="path/to/domain_index",
+        help="Filter offline with a local index created by domain_index instead of "
+        "querying the database",
+    )
+    domain_parser.add_argument(
+        "--strategy",
+        choices=DOMAIN_STRATEGIES,
+        default="auto",
+        help="How hits are matched to architectures: fetch all proteins with a "
+        "matching architecture and join locally, send the hit IDs in batched IN lists, "
+        "or load them into a temporary table. auto chooses by the number of hits and "
+        "matching proteins",
+    )
+    domain_parser.add_argument(
+        "--sqlite",
+        type=Path,
+        required=False,
+        help="Query a local SQLite database with the architecture/protein_arch schema "
+        "instead of the MySQL server from config.yaml",
+    )
+    domain_parser.add_argument(
+        "--db-metrics",
+        default=False,
+        action="store_true",
+        help="Print query counts and timings to stderr",
+    )
+    domain_parser.add_argument(
+        "--output-format",
+        choices=TABLE_FORMATS,
+        default=None,
+        help="Format of the output file, by default chosen by its extension "
+        "(.parquet, .arrow) and CSV otherwise. Parquet and Arrow keep the column types "
+        "and let downstream commands read only the columns they need",
+    )
+    domain_parser.add_argument(
+        "--compact",
+        default=False,
+        action="store_true",
+        help="Hold the hit table in a compact schema: categorical strings, int32 "
+        "coordinates and float32 scores. Cuts its memory several fold on large searches",
+    )
+    domain_parser.add_argument(
+        "--memory-report",
+        default=False,
+        action="store_true",
+        help="Print the memory footprint of each column of the result to stderr",
+    )
 
-    domain_parser.set_defaults(func=domain_filter)
+    domain_parser.add_argument(
+        "--where",
+        type=str,
+        required=False,
+        metavar='"identity >= 40"',
+        help="Keep only the input hits matching a filter expression, see filter "
+        "--where. Parquet and Arrow inputs apply it while reading",
+    )
+    domain_parser.set_defaults(command="domain")
+
+    domain_index_parser = subparsers.add_parser(
+        "domain_index",
+        help="export the architecture database into a local index for offline domain "
+        "filtering",
+    )
+    domain_index_parser.add_argument(
+        "--output",
+        type=Path,
+        required=True,
+        metavar="path/to/domain_index",
+        help="Directory the index is written to",
+    )
+    domain_index_parser.add_argument(
+        "--sqlite",
+        type=Path,
+        required=False,
+        help="Export a local SQLite database instead of the MySQL server from config.yaml",
+    )
+    domain_index_parser.add_argument(
+        "--db-metrics",
+        default=False,
+        action="store_true",
+        help="Print query counts and timings to stderr",
+    )
+    domain_index_parser.set_defaults(command="domain_index")
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help="run search, filter, residue, domain, tree and tree_vis in one process",
+    )
+    pipeline_parser.add_argument(
+        "--config",
+        type=Path,
+        required=False,
+        metavar="path/to/pipeline.yaml",
+        help="YAML file with the stages to run and their options",
+    )
+    pipeline_parser.add_argument(
+        "--example",
+        default=False,
+        action="store_true",
+        help="Print an example config and exit",
+    )
+    pipeline_parser.set_defaults(command="pipeline")
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="keep search results and architecture data loaded and answer filter, "
+        "residue and domain queries over HTTP",
+    )
+    serve_parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="address to listen on",
+    )
+    serve_parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="port to listen on",
+    )
+    serve_parser.add_argument(
+        "--socket",
+        type=Path,
+        required=False,
+        metavar="path/to/mgyminer.sock",
+        help="listen on this Unix socket instead of host:port. Only your user can "
+        "connect to it, TCP clients need the access token of the server",
+    )
+    serve_parser.add_argument(
+        "--token-file",
+        type=Path,
+        required=False,
+        metavar="path/to/token",
+        help="write the access token of a TCP server here (mode 600), by default to "
+        "~/.mgyminer_serve_<port>.token, where mgyminer.server.query() reads it",
+    )
+    serve_parser.add_argument(
+        "--memory-limit",
+        type=int,
+        default=4096,
+        metavar="MB",
+        help="evict the least recently used datasets above this estimated size",
+    )
+    serve_parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=1800,
+        metavar="SECONDS",
+        help="evict datasets not queried for this long",
+    )
+    serve_parser.add_argument(
+        "--compact",
+        default=False,
+        action="store_true",
+        help="Hold the hit tables in the compact schema of filter --compact",
+    )
+    serve_parser.set_defaults(command="serve")
 
     return parser
 
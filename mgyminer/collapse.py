@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+from mgyminer.annotation import name_index, node_positions
+from mgyminer.newick import arrayTree
+from mgyminer.options import COLLAPSE_MODES
+
+
+def clade_aggregates(
+    tree: arrayTree, metadata: pd.DataFrame, top_architectures: int = 32
+) -> pd.DataFrame:
+    """
+    Per node summary of the clade below it, computed once for all nodes so that any
+    collapse level can be rendered from it without touching the layout again.
+    Subtrees are contiguous ranges in preorder, which turns most aggregates into
+    differences of prefix sums.
+    :param tree: arrayTree
+    :param metadata: filter output with dom_acc, identity and (optionally) Pfams columns
+    :param top_architectures: number of most frequent architectures that are counted
+    individually when looking for the dominant architecture of a clade
+    :return: DataFrame in node order with columns size (nodes in the subtree), leaves,
+    level, height, min_identity, max_identity and architecture
+    """
+    n = len(tree)
+    parent = tree.parent.tolist()
+    depth = tree.depths()
+    positions = node_positions(name_index(tree.names), metadata["dom_acc"])
+
+    identity = np.full(n, np.nan)
+    identity[positions] = metadata["identity"].to_numpy(dtype=np.float64)
+
+    size = [1] * n
+    min_identity = np.where(np.isnan(identity), np.inf, identity).tolist()
+    max_identity = np.where(np.isnan(identity), -np.inf, identity).tolist()
+    max_depth = depth.tolist()
+    # walking the preorder backwards visits all children before their parent
+    for node in range(n - 1, 0, -1):
+        p = parent[node]
+        size[p] += size[node]
+        min_identity[p] = min(min_identity[p], min_identity[node])
+        max_identity[p] = max(max_identity[p], max_identity[node])
+        max_depth[p] = max(max_depth[p], max_depth[node])
+    size = np.array(size, dtype=np.int64)
+    start = np.arange(n)
+    stop = start + size
+
+    leaf_count = np.concatenate([[0], np.cumsum(tree.is_leaf)])
+    unit_depth = tree.depths(unit_branch_lengths=True)
+    aggregates = pd.DataFrame(
+        {
+            "size": size,
+            "leaves": leaf_count[stop] - leaf_count[start],
+            "level": np.rint(unit_depth - unit_depth[0]).astype(np.int64),
+            "height": np.array(max_depth) - depth,
+            "min_identity": np.where(np.isinf(min_identity), np.nan, min_identity),
+            "max_identity": np.where(np.isinf(max_identity), np.nan, max_identity),
+        }
+    )
+
+    if "Pfams" in metadata.columns:
+        architecture = np.full(n, None, dtype=object)
+        architecture[positions] = metadata["Pfams"].to_numpy()
+        codes, uniques = pd.factorize(pd.Series(architecture))
+        # count the most frequent architectures, everything else is "other"
+        frequency = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        top = np.argsort(-frequency, kind="stable")[:top_architectures]
+        labels = list(uniques[top]) + ["other"]
+        column = np.full(len(uniques), len(top), dtype=np.int64)
+        column[top] = np.arange(len(top))
+        counts = np.zeros((n + 1, len(labels)), dtype=np.int32)
+        has_architecture = codes >= 0
+        counts[
+            np.flatnonzero(has_architecture) + 1, column[codes[has_architecture]]
+        ] = 1
+        counts = np.cumsum(counts, axis=0)
+        clade_counts = counts[stop] - counts[start]
+        dominant = np.array(labels, dtype=object)[clade_counts.argmax(axis=1)]
+        dominant[clade_counts.sum(axis=1) == 0] = None
+        aggregates["architecture"] = dominant
+    else:
+        aggregates["architecture"] = None
+    return aggregates
+
+
+def collapsed_clades(
+    tree: arrayTree, aggregates: pd.DataFrame, mode: str, threshold: float
+) -> np.ndarray:
+    """
+    Select the clades to collapse into summary glyphs. All criteria are monotone (if a
+    clade qualifies so do all clades below it), so the collapsed clades are the qualifying
+    internal nodes whose parent does not qualify.
+    :param tree: arrayTree
+    :param aggregates: clade_aggregates() of the tree
+    :param mode: depth (collapse below this many edges from the root), size (collapse
+    clades with at most this many leaves) or distance (collapse clades whose leaves are
+    at most this far from the clade root)
+    :param threshold:
+    :return: boolean mask of the collapsed clade roots in node order
+    """
+    if mode == "depth":
+        qualifies = aggregates["level"].to_numpy() >= threshold
+    elif mode == "size":
+        qualifies = aggregates["leaves"].to_numpy() <= threshold
+    elif mode == "distance":
+        qualifies = aggregates["height"].to_numpy() <= threshold
+    else:
+        raise ValueError(f"Invalid collapse mode. Expected one of: {COLLAPSE_MODES}")
+    qualifies &= ~tree.is_leaf
+    parent_qualifies = np.where(tree.parent == -1, False, qualifies[tree.parent])
+    return qualifies & ~parent_qualifies
+
+
+def visible_nodes(aggregates: pd.DataFrame, collapsed: np.ndarray) -> np.ndarray:
+    """
+    Nodes that stay visible when the given clades are collapsed, i.e. everything but the
+    descendants of collapsed clade roots
+    :return: boolean mask in node order
+    """
+    roots = np.flatnonzero(collapsed)
+    size = aggregates["size"].to_numpy()
+    hidden = np.zeros(len(collapsed) + 1, dtype=np.int64)
+    np.add.at(hidden, roots + 1, 1)
+    np.add.at(hidden, roots + size[roots], -1)
+    return np.cumsum(hidden)[:-1] == 0
@@ -0,0 +1,355 @@
+import atexit
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Union
+
+import mysql.connector
+import yaml
+
+CONFIG_FILE = Path(__file__).parents[1] / "config.yaml"
+# ids per IN list, below the 999 parameters older SQLite versions allow per statement
+BATCH_SIZE = 900
+# rows fetched at once from streaming cursors
+FETCH_SIZE = 100000
+
+SQLITE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS architecture "
+    "(id INTEGER PRIMARY KEY, pfams TEXT, names TEXT)",
+    "CREATE TABLE IF NOT EXISTS protein_arch "
+    "(id INTEGER PRIMARY KEY, arch_id INTEGER)",
+    "CREATE INDEX IF NOT EXISTS protein_arch_arch_id ON protein_arch (arch_id)",
+]
+
+
+def _regexp(pattern: str, value: Optional[str]) -> bool:
+    return value is not None and re.search(pattern, value) is not None
+
+
+class proteinDB:
+    """
+    Shared access to the protein architecture database (tables architecture and
+    protein_arch). The config is read on first use, connections are created lazily,
+    handed out from a bounded pool and reused across queries until close() is called.
+    Every query is timed and counted in metrics.
+
+    Either MySQL (config.yaml "mysql" section, passed to mysql.connector.connect) or a
+    local SQLite file with the same schema (config.yaml "sqlite" entry or the sqlite
+    argument) is used.
+    """
+
+    def __init__(
+        self,
+        config_file: Union[Path, str] = CONFIG_FILE,
+        sqlite: Optional[Union[Path, str]] = None,
+        pool_size: int = 4,
+    ) -> None:
+        self.config_file = Path(config_file)
+        self._sqlite = sqlite
+        self._config = None
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.metrics = defaultdict(lambda: {"queries": 0, "seconds": 0.0, "rows": 0})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def config(self) -> dict:
+        if self._config is None:
+            if self._sqlite is not None:
+                self._config = {"sqlite": str(self._sqlite)}
+            else:
+                with open(self.config_file) as configfile:
+                    self._config = yaml.load(configfile, Loader=yaml.CLoader)
+        return self._config
+
+    @property
+    def backend(self) -> str:
+        return "sqlite" if "sqlite" in self.config else "mysql"
+
+    @property
+    def placeholder(self) -> str:
+        """Parameter placeholder of the backend's DB-API driver"""
+        return "?" if self.backend == "sqlite" else "%s"
+
+    @property
+    def index_file(self) -> Path:
+        """Location of the local architecture index of this database"""
+        if self.backend == "sqlite":
+            return Path(self.config["sqlite"] + ".archindex.npz")
+        default = self.config_file.with_name("architecture_index.npz")
+        return Path(self.config.get("architecture_index", default))
+
+    def _connect(self):
+        if self.backend == "sqlite":
+            connection = sqlite3.connect(self.config["sqlite"], check_same_thread=False)
+            connection.create_function("REGEXP", 2, _regexp)
+            return connection
+        return mysql.connector.connect(**self.config["mysql"])
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool, opening a new one if none is idle and the pool
+        is not full yet, otherwise wait for one to be returned
+        """
+        connection = None
+        while connection is None:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if len(self._connections) < self.pool_size:
+                        connection = self._connect()
+                        self._connections.append(connection)
+                if connection is None:
+                    # None marks a slot freed by close(), try again
+                    connection = self._pool.get()
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                pooled = any(known is connection for known in self._connections)
+            if pooled:
+                self._pool.put(connection)
+            else:
+                # borrowed while close() ran, only now it is no longer in use
+                connection.close()
+                self._pool.put(None)
+
+    @contextmanager
+    def timed(self, label: str):
+        """Record the duration of a block under label in metrics"""
+        start = time.perf_counter()
+        try:
+            yield self.metrics[label]
+        finally:
+            self.metrics[label]["queries"] += 1
+            self.metrics[label]["seconds"] += time.perf_counter() - start
+
+    def execute(
+        self, statement: str, params: Sequence = (), label: str = "query"
+    ) -> List[tuple]:
+        """
+        Run a statement on a pooled connection and fetch all rows
+        :param statement: SQL statement using the backend's placeholder for params
+        :param params: statement parameters
+        :param label: name the query is recorded under in metrics
+        :return: list of row tuples
+        """
+        with self.connection() as connection, self.timed(label) as metrics:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(statement, tuple(params))
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+            metrics["rows"] += len(rows)
+        return rows
+
+    def _cursor(self, connection, streaming: bool = False):
+        if streaming and self.backend == "mysql":
+            # unbuffered: rows stay on the server until they are fetched
+            return connection.cursor(buffered=False)
+        return connection.cursor()
+
+    def stream(
+        self,
+        statement: str,
+        params: Sequence = (),
+        label: str = "query",
+        batch_size: int = FETCH_SIZE,
+    ) -> Iterator[List[tuple]]:
+        """
+        Run a statement on an unbuffered cursor and yield its rows in batches of at most
+        batch_size, so that results larger than memory can be processed. The connection
+        stays borrowed until the generator is exhausted or closed, and the time spent
+        by the consumer between batches is included in metrics.
+        :param statement: SQL statement using the backend's placeholder for params
+        :param params: statement parameters
+        :param label: name the query is recorded under in metrics
+        :param batch_size: rows per batch
+        :return:
+        """
+        with self.connection() as connection, self.timed(label) as metrics:
+            cursor = self._cursor(connection, streaming=True)
+            try:
+                cursor.execute(statement, tuple(params))
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    metrics["rows"] += len(rows)
+                    yield rows
+            finally:
+                # a closed generator leaves unread rows that block the connection
+                if getattr(connection, "unread_result", False):
+                    connection.consume_results()
+                cursor.close()
+
+    def stream_in_batches(
+        self,
+        statement: str,
+        ids: Sequence[int],
+        params: Sequence = (),
+        label: str = "query",
+        batch_size: int = BATCH_SIZE,
+        fetch_size: int = FETCH_SIZE,
+    ) -> Iterator[List[tuple]]:
+        """
+        Run a statement once per batch of ids and stream the rows of all statements
+        :param statement: SQL statement with an {ids} field that is replaced by the
+        placeholder list of a batch, e.g. "... WHERE pa.id IN ({ids}) AND ...". The ids
+        are bound before params, so {ids} has to precede all other placeholders.
+        :param ids: values to ship in IN lists
+        :param params: further statement parameters, bound in every batch
+        :param label: name the queries are recorded under in metrics
+        :param batch_size: ids per statement, bounded by the drivers' parameter limits
+        :param fetch_size: rows per yielded batch
+        :return:
+        """
+        for start in range(0, len(ids), batch_size):
+            stop = start + batch_size
+            batch = list(ids[start:stop])
+            in_list = ", ".join([self.placeholder] * len(batch))
+            yield from self.stream(
+                statement.format(ids=in_list),
+                batch + list(params),
+                label=label,
+                batch_size=fetch_size,
+            )
+
+    def execute_in_batches(
+        self,
+        statement: str,
+        ids: Sequence[int],
+        params: Sequence = (),
+        label: str = "query",
+        batch_size: int = BATCH_SIZE,
+    ) -> List[tuple]:
+        """
+        Run a statement once per batch of ids and collect the rows, see
+        stream_in_batches()
+        :return: list of row tuples
+        """
+        rows = []
+        for chunk in self.stream_in_batches(
+            statement, ids, params, label=label, batch_size=batch_size
+        ):
+            rows.extend(chunk)
+        return rows
+
+    def stream_with_id_table(
+        self,
+        statement: str,
+        ids: Sequence[int],
+        params: Sequence = (),
+        label: str = "query",
+        fetch_size: int = FETCH_SIZE,
+    ) -> Iterator[List[tuple]]:
+        """
+        Load ids into the temporary table hit_ids (column id) and stream the rows of a
+        statement that joins against it. The table only lives on the borrowed connection
+        and is dropped afterwards.
+        :param statement: SQL statement referring to hit_ids
+        :param ids: values loaded into hit_ids, duplicates are removed
+        :param params: statement parameters
+        :param label: name the query is recorded under in metrics
+        :param fetch_size: rows per yielded batch
+        :return:
+        """
+        ids = sorted(set(ids))
+        with self.connection() as connection, self.timed(label) as metrics:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("CREATE TEMPORARY TABLE hit_ids (id BIGINT PRIMARY KEY)")
+                cursor.executemany(
+                    f"INSERT INTO hit_ids VALUES ({self.placeholder})",
+                    [(id,) for id in ids],
+                )
+                rows_cursor = self._cursor(connection, streaming=True)
+                try:
+                    rows_cursor.execute(statement, tuple(params))
+                    while True:
+                        rows = rows_cursor.fetchmany(fetch_size)
+                        if not rows:
+                            break
+                        metrics["rows"] += len(rows)
+                        yield rows
+                finally:
+                    if getattr(connection, "unread_result", False):
+                        connection.consume_results()
+                    rows_cursor.close()
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS hit_ids")
+                connection.commit()
+                cursor.close()
+
+    def report(self) -> str:
+        lines = [f"{'query':<24}{'count':>8}{'seconds':>10}{'rows':>12}"]
+        for label, metrics in self.metrics.items():
+            lines.append(
+                f"{label:<24}{metrics['queries']:>8}{metrics['seconds']:>10.3f}"
+                f"{metrics['rows']:>12}"
+            )
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        """
+        Close the idle connections of the pool. Connections borrowed by running queries
+        are closed when they are returned. Queries after close() open new connections.
+        """
+        with self._lock:
+            while True:
+                try:
+                    connection = self._pool.get_nowait()
+                except queue.Empty:
+                    break
+                if connection is not None:
+                    connection.close()
+            self._connections = []
+
+
+def create_sqlite_database(
+    file: Union[Path, str],
+    architectures: Sequence[tuple] = (),
+    proteins: Sequence[tuple] = (),
+) -> None:
+    """
+    Create a local SQLite stand-in for the architecture database
+    :param file: Path to the SQLite file
+    :param architectures: (id, pfams, names) rows, e.g. (1, "PF00001-PF00002", "7tm_1~GPS")
+    :param proteins: (MGYP number, architecture id) rows
+    :return:
+    """
+    with sqlite3.connect(file) as connection:
+        for statement in SQLITE_SCHEMA:
+            connection.execute(statement)
+        connection.executemany(
+            "INSERT INTO architecture VALUES (?, ?, ?)", architectures
+        )
+        connection.executemany("INSERT INTO protein_arch VALUES (?, ?)", proteins)
+    connection.close()
+
+
+_shared = None
+
+
+def shared_database() -> proteinDB:
+    """Process wide database access, closed when the interpreter exits"""
+    global _shared
+    if _shared is None:
+        _shared = proteinDB()
+        atexit.register(_shared.close)
+    return _shared
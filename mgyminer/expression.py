@@ -0,0 +1,337 @@
+import operator
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# comparison operators of the expression language, "=" is read as "=="
+COMPARISONS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+KEYWORDS = {"and", "or", "not", "in"}
+TOKEN = re.compile(
+    r"""\s*(?:
+    (?P<string>'[^']*'|"[^"]*")
+    |(?P<name>[A-Za-z_][A-Za-z0-9_\-]*)
+    |(?P<number>[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<symbol><=|>=|==|!=|=|<|>|\(|\)|,)
+    )""",
+    re.VERBOSE,
+)
+
+
+def tokenize(text: str) -> List[tuple]:
+    """
+    Split a filter expression into (kind, value) tokens
+    :param text: filter expression
+    :return: tokens, kind is string, name, number, keyword or symbol
+    """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                f"Invalid filter expression at {text[position:].strip()[:20]!r}"
+            )
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1]
+        elif kind == "number":
+            value = float(value) if re.search(r"[.eE]", value) else int(value)
+        elif kind == "name" and value.lower() in KEYWORDS:
+            kind, value = "keyword", value.lower()
+        elif kind == "symbol" and value == "=":
+            value = "=="
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _parser:
+    """
+    Recursive descent parser of the grammar
+
+        expression := term ("or" term)*
+        term       := factor ("and" factor)*
+        factor     := "not" factor | "(" expression ")" | comparison
+        comparison := column operator literal | literal operator column
+                    | column ["not"] "in" "(" literal ("," literal)* ")"
+
+    into nested tuples: ("and", [nodes]), ("or", [nodes]), ("not", node) and the
+    leaves ("compare", column, operator, value) and ("in", column, values)
+    """
+
+    def __init__(self, tokens: List[tuple], aliases: Dict[str, str]) -> None:
+        self.tokens = tokens
+        self.aliases = aliases
+        self.position = 0
+
+    def peek(self, kind: str, value=None) -> bool:
+        if self.position == len(self.tokens):
+            return False
+        token_kind, token_value = self.tokens[self.position]
+        return token_kind == kind and (value is None or token_value == value)
+
+    def take(self, kind: str, value=None):
+        if not self.peek(kind, value):
+            found = (
+                "end of expression"
+                if self.position == len(self.tokens)
+                else repr(self.tokens[self.position][1])
+            )
+            raise ValueError(
+                f"Invalid filter expression: expected {value or kind}, found {found}"
+            )
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def literal(self):
+        if self.peek("string"):
+            return self.take("string")
+        return self.take("number")
+
+    def column(self) -> str:
+        name = self.take("name")
+        return self.aliases.get(name, name)
+
+    def expression(self):
+        nodes = [self.term()]
+        while self.peek("keyword", "or"):
+            self.take("keyword")
+            nodes.append(self.term())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def term(self):
+        nodes = [self.factor()]
+        while self.peek("keyword", "and"):
+            self.take("keyword")
+            nodes.append(self.factor())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def factor(self):
+        if self.peek("keyword", "not"):
+            self.take("keyword")
+            return ("not", self.factor())
+        if self.peek("symbol", "("):
+            self.take("symbol")
+            node = self.expression()
+            self.take("symbol", ")")
+            return node
+        if not self.peek("name"):
+            # literal on the left, e.g. 50 <= identity
+            value = self.literal()
+            op = self.take("symbol")
+            if op not in COMPARISONS:
+                raise ValueError(f"Invalid filter expression: {op!r} is no comparison")
+            return ("compare", self.column(), _flipped(op), value)
+        column = self.column()
+        negated = self.peek("keyword", "not")
+        if negated or self.peek("keyword", "in"):
+            if negated:
+                self.take("keyword")
+            self.take("keyword", "in")
+            self.take("symbol", "(")
+            values = [self.literal()]
+            while self.peek("symbol", ","):
+                self.take("symbol")
+                values.append(self.literal())
+            self.take("symbol", ")")
+            node = ("in", column, values)
+            return ("not", node) if negated else node
+        op = self.take("symbol")
+        if op not in COMPARISONS:
+            raise ValueError(f"Invalid filter expression: {op!r} is no comparison")
+        return ("compare", column, op, self.literal())
+
+
+def _flipped(op: str) -> str:
+    return {"<": ">", "<=": ">=", ">": "<", ">=": "<="}.get(op, op)
+
+
+def _columns(node, found: List[str]) -> List[str]:
+    if node[0] in ("and", "or"):
+        for child in node[1]:
+            _columns(child, found)
+    elif node[0] == "not":
+        _columns(node[1], found)
+    elif node[1] not in found:
+        found.append(node[1])
+    return found
+
+
+def _values(node) -> list:
+    return node[2] if node[0] == "in" else [node[3]]
+
+
+def _check_type(node, numeric: bool) -> None:
+    """Numeric columns are compared with numbers and text columns with strings"""
+    text = [value for value in _values(node) if isinstance(value, str)]
+    if numeric and text:
+        raise ValueError(f"Column {node[1]} holds numbers, compared with {text[0]!r}")
+    if not numeric and len(text) < len(_values(node)):
+        raise ValueError(
+            f"Column {node[1]} holds text, quote the values compared with it"
+        )
+
+
+def _leaf_mask(series: pd.Series, node) -> np.ndarray:
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # evaluated once per category, missing values (code -1) are never kept
+        categories = _leaf_mask(pd.Series(series.cat.categories), node)
+        return np.append(categories, False)[series.cat.codes.to_numpy()]
+    _check_type(node, pd.api.types.is_numeric_dtype(series.dtype))
+    if node[0] == "in":
+        return series.isin(node[2]).to_numpy(dtype=bool)
+    _, _, op, value = node
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        values = series.to_numpy()
+        mask = COMPARISONS[op](values, value)
+        if op == "!=" and values.dtype.kind == "f":
+            # NaN compares unequal to everything, a missing value is still not kept
+            mask &= ~np.isnan(values)
+        return mask
+    mask = COMPARISONS[op](series, value).to_numpy(dtype=bool, na_value=False)
+    return mask & series.notna().to_numpy() if op == "!=" else mask
+
+
+class filterExpression:
+    """
+    Filter over the columns of a hit table, e.g.
+    "score >= 50 and (biome in ('root:Host-associated', 'root:Engineered') or not
+    identity < 30)". A comparison with a missing value is false (and true under not).
+    The expression is evaluated as one boolean mask, so the table is copied once
+    however many conditions it has, and it translates into a pyarrow expression that
+    Parquet and Arrow readers apply while reading (see read_table()).
+    """
+
+    def __init__(self, tree) -> None:
+        self.tree = tree
+
+    @classmethod
+    def parse(
+        cls, text: str, aliases: Optional[Dict[str, str]] = None
+    ) -> "filterExpression":
+        """
+        :param text: filter expression
+        :param aliases: other names of columns, e.g. {"eval": "e-value"}
+        :return:
+        """
+        parser = _parser(tokenize(text), aliases or {})
+        tree = parser.expression()
+        if parser.position != len(parser.tokens):
+            raise ValueError(
+                "Invalid filter expression: unexpected "
+                f"{parser.tokens[parser.position][1]!r}"
+            )
+        return cls(tree)
+
+    @classmethod
+    def all_of(cls, *expressions: Optional["filterExpression"]):
+        """Conjunction of the given expressions, None if none is given"""
+        trees = [expression.tree for expression in expressions if expression]
+        if not trees:
+            return None
+        return cls(trees[0] if len(trees) == 1 else ("and", trees))
+
+    @classmethod
+    def compare(cls, column: str, op: str, value) -> "filterExpression":
+        return cls(("compare", column, op, value))
+
+    @property
+    def columns(self) -> List[str]:
+        """Columns the expression reads, in order of appearance"""
+        return _columns(self.tree, [])
+
+    def _check_columns(self, available) -> None:
+        missing = [column for column in self.columns if column not in available]
+        if missing:
+            raise ValueError(
+                f"Unknown column(s) {missing} in filter expression. "
+                f"Available: {list(available)}"
+            )
+
+    def mask(self, table: pd.DataFrame) -> np.ndarray:
+        """
+        Evaluate the expression on a table. Each comparison is computed on the column
+        array and combined into the mask in place.
+        :param table: hit table
+        :return: boolean array, True for the rows kept
+        """
+        self._check_columns(table.columns)
+        return self._mask(self.tree, table)
+
+    def _mask(self, node, table: pd.DataFrame) -> np.ndarray:
+        if node[0] in ("and", "or"):
+            combine = np.logical_and if node[0] == "and" else np.logical_or
+            mask = self._mask(node[1][0], table)
+            for child in node[1][1:]:
+                combine(mask, self._mask(child, table), out=mask)
+            return mask
+        if node[0] == "not":
+            mask = self._mask(node[1], table)
+            return np.logical_not(mask, out=mask)
+        mask = _leaf_mask(table[node[1]], node)
+        # pandas hands out read-only views, the mask is combined in place
+        return mask if mask.flags.writeable else mask.copy()
+
+    def arrow(self, schema):
+        """
+        The expression as a pyarrow.compute.Expression, for pushdown into Parquet and
+        Arrow datasets. Parquet skips row groups whose statistics exclude a match.
+        :param schema: pyarrow.Schema of the data, to check columns and types
+        :return:
+        """
+        # pyarrow is an optional dependency, only needed for columnar tables
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        self._check_columns(schema.names)
+
+        def convert(node):
+            if node[0] in ("and", "or"):
+                children = [convert(child) for child in node[1]]
+                expression = children[0]
+                for child in children[1:]:
+                    expression = (
+                        expression & child if node[0] == "and" else expression | child
+                    )
+                return expression
+            if node[0] == "not":
+                return ~convert(node[1])
+            field_type = schema.field(node[1]).type
+            if pa.types.is_dictionary(field_type):
+                field_type = field_type.value_type
+            _check_type(
+                node,
+                pa.types.is_integer(field_type) or pa.types.is_floating(field_type),
+            )
+            field = pc.field(node[1])
+            if node[0] == "in":
+                expression = field.isin(node[2])
+            else:
+                expression = COMPARISONS[node[2]](field, node[3])
+            # like mask(): a comparison with a missing value is false, not null
+            return expression & field.is_valid()
+
+        return convert(self.tree)
+
+    def __str__(self) -> str:
+        def text(node) -> str:
+            if node[0] in ("and", "or"):
+                return f" {node[0]} ".join(f"({text(child)})" for child in node[1])
+            if node[0] == "not":
+                return f"not ({text(node[1])})"
+            if node[0] == "in":
+                return f"{node[1]} in ({', '.join(map(repr, node[2]))})"
+            return f"{node[1]} {node[2]} {node[3]!r}"
+
+        return text(self.tree)
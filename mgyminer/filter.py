@@ -1,67 +1,336 @@
 import csv
 import json
+import os
 import re
+import sys
+import tempfile
 from collections import Counter
+from contextlib import nullcontext
 from pathlib import Path
 
-import mysql.connector
 import numpy as np
 import pandas as pd
-import yaml
+
+from mgyminer.annotation import (
+    MGYP_ACCESSION,
+    check_accessions,
+    mgyp_accessions,
+    mgyp_numbers,
+    target_keys,
+    target_names,
+)
+from mgyminer.archindex import architectureIndex
+from mgyminer.database import BATCH_SIZE, proteinDB, shared_database
+from mgyminer.expression import filterExpression
+from mgyminer.options import DOMAIN_STRATEGIES
+from mgyminer.profiling import stage
+from mgyminer.tables import (
+    COMPACT_DTYPES,
+    compact_table,
+    memory_report,
+    read_table,
+    write_table,
+)
 
 
 def filter(args):
-    # manage arguments
-    hmmer_output_file = args.input
+    if args.memory_budget is not None:
+        if args.output is None or args.memory_report or args.top:
+            raise ValueError(
+                "--memory-budget streams the hits to --output and never holds the "
+                "whole table, it needs --output and excludes --memory-report and --top"
+            )
+        # chunked builds on the functions of this module
+        from mgyminer.chunked import filter_chunked
+
+        filter_chunked(
+            args.input,
+            args.output,
+            args.eval,
+            args.coverage,
+            args.sort,
+            args.memory_budget * 1_000_000,
+            args.output_format,
+            args.compact,
+            where=args.where,
+        )
+        return
+
+    dom_tbl, alignment_dict = load_search(args.input, args.compact)
+    dom_tbl = filter_hits(
+        dom_tbl,
+        alignment_dict,
+        args.eval,
+        args.coverage,
+        args.sort,
+        top=args.top,
+        sort_cache=args.input,
+        where=args.where,
+    )
+
+    if args.memory_report:
+        print(memory_report(dom_tbl), file=sys.stderr)
+    with stage("write"):
+        if args.output:
+            write_table(dom_tbl, args.output, args.output_format)
+        else:
+            print(dom_tbl.to_string())
+
+
+def load_search(hmmer_output_file, compact=False):
+    """
+    Domain table and alignments of a phmmer search. The alignments are parsed from the
+    search output once and cached in alignments.json next to it.
+    :param hmmer_output_file: Path to the phmmer output, with dom_tbl.txt next to it
+    :param compact: parse the domain table into COMPACT_DTYPES
+    :return: domain table with coverage columns, alignment dictionary
+    """
     results_basepath = hmmer_output_file.parents[0]
     dom_tbl_file = results_basepath / "dom_tbl.txt"
     # tbl_file = results_basepath / "tbl.txt"
     alignments = results_basepath / "alignments.json"
 
-    # get table
-    dom_tbl = parse_domtable(dom_tbl_file)
-    calculate_coverage(dom_tbl)
-    if alignments.is_file():
-        with open(alignments, "r") as fin:
-            aligmnent_dict = json.load(fin)
+    with stage("parse"):
+        dom_tbl = parse_domtable(dom_tbl_file, compact)
+    with stage("coverage"):
+        calculate_coverage(dom_tbl)
+    with stage("alignment load"):
+        if alignments.is_file():
+            with open(alignments, "r") as fin:
+                aligmnent_dict = json.load(fin)
 
-    else:
-        aligmnent_dict = get_alignment_consensus(hmmer_output_file)
-        with open(alignments, "w") as fout:
-            json.dump(aligmnent_dict, fout)
-    add_sim_ident(dom_tbl, aligmnent_dict)
-
-    if args.eval:
-        dom_tbl = dom_tbl[dom_tbl["e-value"] <= args.eval]
-
-    if args.coverage:
-        coverage_range = _extract_range(args.coverage)
-        dom_tbl = dom_tbl[
-            dom_tbl["coverage_query"].between(coverage_range[0], coverage_range[1])
-        ]
+        else:
+            aligmnent_dict = get_alignment_consensus(hmmer_output_file)
+            with open(alignments, "w") as fout:
+                json.dump(aligmnent_dict, fout)
+    return dom_tbl, aligmnent_dict
+
+
+def filter_hits(
+    dom_tbl,
+    alignment_dict,
+    evalue=None,
+    coverage=None,
+    sort=None,
+    table=None,
+    index=None,
+    top=None,
+    sort_cache=None,
+    where=None,
+):
+    """
+    Add similarity and identity to the search hits, filter and sort them
+    :param dom_tbl: domain table from load_search()
+    :param alignment_dict: alignments from load_search()
+    :param evalue: highest e-value kept
+    :param coverage: query coverage range in percent, e.g. "50-100"
+    :param sort: eval, coverage, similarity and/or identity
+    :param table: alignment_table() of alignment_dict, built if not given
+    :param index: alignment_index() of table
+    :param top: keep only the hits of the top best targets, see select_top()
+    :param sort_cache: phmmer output of dom_tbl. The sort order of the whole table is
+    cached next to it (see sort_cache_file()) and reused by later calls with the same
+    sort, which then skip sorting. Only a full sort without thresholds (no evalue,
+    coverage, where or top) writes the cache.
+    :param where: filter expression over the hit table columns, see filterExpression
+    :return: filtered domain table
+    """
+    with stage("sim-ident attach"):
+        table = alignment_table(alignment_dict) if table is None else table
+        mgyp = pd.Series(hit_keys(dom_tbl["target_name"], table), index=dom_tbl.index)
+        add_sim_ident(dom_tbl, alignment_dict, mgyp.to_numpy(), table, index)
+
+    unfiltered = dom_tbl
+    kept = None
+    expression = threshold_expression(evalue, coverage, where)
+    if expression is not None:
+        # all thresholds as one mask, the table is copied once
+        with stage("threshold filter"):
+            kept = expression.mask(dom_tbl)
+            dom_tbl = dom_tbl[kept]
+
+    columns, orientation = sort_order(sort)
+    positions = None
+    if columns and sort_cache is not None:
+        positions = load_sort_positions(sort_cache, sort, len(unfiltered))
+        if positions is None and not top and kept is None:
+            # only the whole table is sorted for the cache, a thresholded run sorts
+            # just the rows it keeps below
+            with stage("sort"):
+                positions = sort_positions(unfiltered, mgyp, columns, orientation)
+            save_sort_positions(sort_cache, sort, positions)
+    if positions is not None:
+        # the kept rows in the cached order, nothing is left to sort
+        with stage("cached order"):
+            if kept is not None:
+                positions = positions[kept[positions]]
+            if top:
+                rank, _ = pd.factorize(mgyp.to_numpy()[positions])
+                positions = positions[rank < top]
+            dom_tbl = unfiltered.iloc[positions]
+    elif top:
+        with stage("top selection"):
+            dom_tbl = select_top(dom_tbl, mgyp, top, columns, orientation)
+    elif columns:
+        with stage("sort"):
+            dom_tbl = dom_tbl.iloc[sort_positions(dom_tbl, mgyp, columns, orientation)]
+    return dom_tbl
+
+
+def threshold_expression(evalue=None, coverage=None, where=None):
+    """
+    The filter thresholds as one filterExpression
+    :param evalue: highest e-value kept
+    :param coverage: query coverage range in percent, e.g. "50-100"
+    :param where: filter expression, eval and coverage may stand for the e-value and
+    coverage_query columns like in the --eval and --coverage options
+    :return: conjunction of the thresholds, None without any
+    """
+    terms = []
+    if evalue:
+        terms.append(filterExpression.compare("e-value", "<=", evalue))
+    if coverage:
+        coverage_range = _extract_range(coverage)
+        terms.append(
+            filterExpression.compare("coverage_query", ">=", coverage_range[0])
+        )
+        terms.append(
+            filterExpression.compare("coverage_query", "<=", coverage_range[1])
+        )
+    if isinstance(where, str):
+        where = filterExpression.parse(where, EXPRESSION_ALIASES)
+    return filterExpression.all_of(*terms, where)
 
-    if args.sort:
-        map = {
-            "eval": "score",
-            "coverage": "coverage_query",
-            "similarity": "similarity",
-            "identity": "identity",
-        }
-        if all(filters in map.keys() for filters in args.sort):
-            columns = [map[v] for v in args.sort]
-            columns.extend(
-                ["target_name", "ndom"]
-            )  # additionally sort by name and ndom to keep entries from one
-            orientation = [
-                False for column in columns
-            ]  # protein together, ndom sort needs to be ascending to keep
-            orientation[-1] = True  # domain order
-            dom_tbl = dom_tbl.sort_values(by=columns, ascending=orientation)
-
-    if args.output:
-        dom_tbl.to_csv(args.output, index=False, sep=",")
-    else:
-        print(dom_tbl.to_string())
+
+def sort_positions(dom_tbl, mgyp, columns, orientation):
+    """
+    Row positions of a hit table in sort order
+    :param dom_tbl: hit table with similarity and identity
+    :param mgyp: target keys of the hits (see hit_keys()), indexed like dom_tbl or a
+    superset of it
+    :param columns: sort columns from sort_order()
+    :param orientation: ascending flags from sort_order()
+    :return:
+    """
+    # sort on the target keys, MGYP numbers order like the zero padded accessions.
+    # Reindexed, assigning a Series to an empty frame would adopt its index
+    sort_keys = dom_tbl[columns].assign(target_name=mgyp.reindex(dom_tbl.index))
+    sort_keys.index = pd.RangeIndex(len(sort_keys))
+    return sort_keys.sort_values(by=columns, ascending=orientation).index.to_numpy()
+
+
+def select_top(dom_tbl, mgyp, top, columns=None, orientation=None):
+    """
+    Hits of the top best targets with all their domains, in sort order. A target ranks
+    by its best domain. Instead of sorting all hits, the best value of the first sort
+    column is taken per target and only the targets reaching the top-th best of these
+    (ties included) are sorted.
+    :param dom_tbl: hit table with similarity and identity
+    :param mgyp: target keys of the hits (see hit_keys()), indexed like dom_tbl or a
+    superset of it
+    :param top: number of targets
+    :param columns: sort columns from sort_order(), None to keep the order of dom_tbl
+    :param orientation: ascending flags from sort_order()
+    :return:
+    """
+    targets = mgyp.reindex(dom_tbl.index).to_numpy()
+    if columns:
+        primary = dom_tbl[columns[0]].to_numpy()
+        # smaller is better
+        primary = primary if orientation[0] else -primary
+        best = pd.Series(primary).groupby(targets).min()
+        if len(best) > top:
+            threshold = np.partition(best.to_numpy(), top - 1)[top - 1]
+            candidates = best.index[best.to_numpy() <= threshold]
+            dom_tbl = dom_tbl[np.isin(targets, candidates)]
+        dom_tbl = dom_tbl.iloc[sort_positions(dom_tbl, mgyp, columns, orientation)]
+        targets = mgyp.reindex(dom_tbl.index).to_numpy()
+    # targets numbered in the order they first appear
+    rank, _ = pd.factorize(targets)
+    return dom_tbl[rank < top]
+
+
+def sort_cache_file(hmmer_output_file, sort):
+    """File caching the sort order of a search, next to its alignments.json"""
+    return Path(hmmer_output_file).parent / f"sort_{'-'.join(sort)}.npz"
+
+
+def _sort_signature(hmmer_output_file):
+    # identity and similarity come from the search output, the other keys from dom_tbl
+    files = [Path(hmmer_output_file), Path(hmmer_output_file).parent / "dom_tbl.txt"]
+    return np.array(
+        [
+            value
+            for file in files
+            for value in (file.stat().st_size, file.stat().st_mtime_ns)
+        ],
+        dtype=np.int64,
+    )
+
+
+def load_sort_positions(hmmer_output_file, sort, rows):
+    """
+    Cached sort order of the domain table of a search
+    :param hmmer_output_file: Path to the phmmer output
+    :param sort: filter --sort keys
+    :param rows: rows of the domain table
+    :return: row positions in sort order, None if not cached or out of date
+    """
+    file = sort_cache_file(hmmer_output_file, sort)
+    if not file.is_file():
+        return None
+    with np.load(file) as data:
+        if len(data["positions"]) != rows or not np.array_equal(
+            data["signature"], _sort_signature(hmmer_output_file)
+        ):
+            return None
+        return data["positions"]
+
+
+def save_sort_positions(hmmer_output_file, sort, positions):
+    file = sort_cache_file(hmmer_output_file, sort)
+    # written next to the cache and renamed, readers (e.g. serve threads) never see a
+    # partial file
+    fd, partial = tempfile.mkstemp(dir=file.parent, prefix=f".{file.name}.")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            np.savez(
+                fout,
+                positions=positions,
+                signature=_sort_signature(hmmer_output_file),
+            )
+        os.replace(partial, file)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+# short column names of filter expressions, as in the --eval and --coverage options
+EXPRESSION_ALIASES = {"eval": "e-value", "coverage": "coverage_query"}
+
+SORT_COLUMNS = {
+    "eval": "score",
+    "coverage": "coverage_query",
+    "similarity": "similarity",
+    "identity": "identity",
+}
+
+
+def sort_order(sort):
+    """
+    Sort columns of the filter --sort options
+    :param sort: eval, coverage, similarity and/or identity
+    :return: columns and their ascending flags, (None, None) if the hits stay unsorted
+    """
+    if not sort or not all(filters in SORT_COLUMNS for filters in sort):
+        return None, None
+    columns = [SORT_COLUMNS[v] for v in sort]
+    # additionally sort by name and ndom to keep entries from one protein together,
+    # ndom sort needs to be ascending to keep domain order
+    columns.extend(["target_name", "ndom"])
+    orientation = [False for column in columns]
+    orientation[-1] = True
+    return columns, orientation
 
 
 def residue_filter(args):
@@ -71,68 +340,104 @@ def residue_filter(args):
     alignments = results_basepath / "alignments.json"
 
     # read input files
-    results_table = pd.read_csv(results_file)
-    results_table["hmm_from"].astype(int)
-    results_table["hmm_to"].astype(int)
-    with open(alignments, "r") as fin:
-        alignment_dict = json.load(fin)
+    with stage("read"):
+        results_table = read_table(
+            results_file,
+            compact=args.compact,
+            where=threshold_expression(where=args.where),
+        )
+    with stage("alignment load"):
+        with open(alignments, "r") as fin:
+            alignment_dict = json.load(fin)
 
-    filters = args.residue
+    results_table = residue_hits(results_table, alignment_dict, args.residue)
+
+    if args.memory_report:
+        print(memory_report(results_table), file=sys.stderr)
+    with stage("write"):
+        if args.output:
+            write_table(results_table, args.output, args.output_format)
+        else:
+            print(results_table.to_string())
+
+
+def residue_hits(results_table, alignment_dict, filters, table=None):
+    """
+    Keep the hits passing all residue filters, with a column per filter holding the hit
+    residue aligned to the query residue
+    :param results_table: filtered hits
+    :param alignment_dict: alignments of the search
+    :param filters: [residue coordinate, include/exclude, residues...] lists
+    :param table: alignment_table() of alignment_dict, built if not given
+    :return:
+    """
+    results_table = results_table.copy()
+    with stage("alignment table"):
+        table = alignment_table(alignment_dict) if table is None else table
+        mgyp = pd.Series(
+            hit_keys(results_table["target_name"], table), index=results_table.index
+        )
     for filter in filters:
-        selection = overlapping_targets(filter, results_table)
-        hits = check_residue(selection, alignment_dict, filter)
-        filter_name = "_".join(filter)
-        results_table[filter_name] = results_table["target_name"].map(hits)
-        results_table.dropna(inplace=True)
-
-    if args.output:
-        results_table.to_csv(args.output, index=False, sep=",")
-    else:
-        print(results_table.to_string())
+        filter = [str(item) for item in filter]
+        with stage("residue check"):
+            selection = overlapping_targets(filter, results_table)
+            hits = check_residue(selection, alignment_dict, filter, table)
+            filter_name = "_".join(filter)
+            results_table[filter_name] = mgyp[results_table.index].map(hits)
+            results_table.dropna(inplace=True)
+    return results_table
 
 
 def overlapping_targets(args, results_table):
     """
-    returns a list of target proteins whos alignment overlaps with the query residue
+    returns the hits whos alignment overlaps with the query residue
     :param args:
     :param results_table:
-    :return:
+    :return: DataFrame with target_name, ali_from and ali_to columns
     """
     residue_coordinate = int(args[0])
-    selection = (
-        results_table.loc[
-            (results_table["hmm_from"] <= residue_coordinate)
-            & (results_table["hmm_to"] >= residue_coordinate),
-            ["target_name", "ali_from", "ali_to"],
-        ]
-        .to_string(header=False, index=False, index_names=False)
-        .split("\n")
-    )
-    selection = [element.split() for element in selection]
-
-    return selection
+    return results_table.loc[
+        (results_table["hmm_from"] <= residue_coordinate)
+        & (results_table["hmm_to"] >= residue_coordinate),
+        ["target_name", "ali_from", "ali_to"],
+    ]
 
 
-def check_residue(selection, alignment_dict, filter):
+def check_residue(selection, alignment_dict, filter, table=None):
+    """
+    Residues of the selected hits aligned to the query residue
+    :param selection: hits from overlapping_targets()
+    :param alignment_dict: alignments from get_alignment_consensus()
+    :param filter: residue coordinate, include/exclude and the residues
+    :param table: alignment_table() of alignment_dict, built if not given
+    :return: {target key (see hit_keys()): residue} of the hits passing the filter
+    """
     residue_coordinate = int(filter[0])
     ex_inc = filter[1]
     residues = [residue.upper() for residue in filter[2:]]
 
+    table = alignment_table(alignment_dict) if table is None else table
+    entries = list(alignment_dict.values())
+    mgyp = hit_keys(selection["target_name"], table)
+    positions = alignment_positions(
+        table, mgyp, selection["ali_from"], selection["ali_to"]
+    )
+
     matches = {}
 
-    for element in selection:
-        entry = alignment_dict["-".join(element)]
+    for target, position in zip(mgyp.tolist(), positions.tolist()):
+        entry = entries[position]
         relative_coordinate = residue_coordinate - int(entry["query_start"])
         target_index = index_on_target(relative_coordinate, entry["query_seq"])
         residue = entry["target_seq"][target_index]
         if ex_inc == "include":
             if residue in residues:
-                matches[element[0]] = residue
+                matches[target] = residue
             else:
                 continue
         if ex_inc == "exclude":
             if residue not in residues:
-                matches[element[0]] = residue
+                matches[target] = residue
     return matches
 
 
@@ -147,8 +452,24 @@ def index_on_target(pos, query_seq):
     return index
 
 
-def parse_domtable(file):
+def parse_domtable(file, compact=False):
+    """
+    Read a --domtblout domain table
+    :param file: Path or open file
+    :param compact: use COMPACT_DTYPES instead of object strings, int64 and float64
+    :return:
+    """
+    return next(domtable_chunks(file, compact=compact))
+
 
+def domtable_chunks(file, chunk_size=None, compact=False):
+    """
+    Read a --domtblout domain table in chunks of rows, for tables larger than memory
+    :param file: Path or open file
+    :param chunk_size: rows per chunk, all rows in one chunk if None
+    :param compact: use COMPACT_DTYPES instead of object strings, int64 and float64
+    :return: generator of DataFrames, at least one even if the table is empty
+    """
     column_names = [
         "target_name",
         "target_accession",
@@ -201,6 +522,13 @@ def parse_domtable(file):
         "description": str,
     }
 
+    if compact:
+        convert_dict.update(
+            (column, dtype)
+            for column, dtype in COMPACT_DTYPES.items()
+            if column in convert_dict
+        )
+
     closeit = False
     if isinstance(file, str):
         file = Path(file)
@@ -210,18 +538,31 @@ def parse_domtable(file):
         closeit = True
 
     rows = []
-    for line in csv.reader(decomment(file), delimiter=" ", skipinitialspace=True):
-        row = [item for item in line]
-        row[22] = " ".join(row[22:])
-        del row[23:]
-        rows.append(row)
-
-    if closeit:
-        file.close()
-
-    dom_table_df = pd.DataFrame(rows, columns=column_names)
-    dom_table_df = dom_table_df.astype(convert_dict)
-    return dom_table_df
+    start = 0
+    try:
+        for line in csv.reader(decomment(file), delimiter=" ", skipinitialspace=True):
+            row = [item for item in line]
+            row[22] = " ".join(row[22:])
+            del row[23:]
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield _domtable_frame(rows, column_names, convert_dict, start)
+                start += len(rows)
+                rows = []
+    finally:
+        if closeit:
+            file.close()
+
+    if rows or start == 0:
+        yield _domtable_frame(rows, column_names, convert_dict, start)
+
+
+def _domtable_frame(rows, column_names, convert_dict, start):
+    # chunks continue the row index, as if the table had been read in one piece
+    dom_table_df = pd.DataFrame(
+        rows, columns=column_names, index=pd.RangeIndex(start, start + len(rows))
+    )
+    return dom_table_df.astype(convert_dict)
 
 
 def decomment(rows):
@@ -283,7 +624,15 @@ def end_of_column(string):
 
 
 def get_alignment_consensus(file):
-    alignments_dict = {}
+    return dict(alignment_entries(file))
+
+
+def alignment_entries(file):
+    """
+    Parse the domain alignments of a phmmer output one at a time
+    :param file: Path to the phmmer output
+    :return: generator of ("<target>-<target_start>-<target_end>", alignment) tuples
+    """
     for alignment in alignments(file):
         # get the start index of the comsensus sequence.
         # problem: amount of leading whitespaces is dependend on the length of query or target sequence but needs to
@@ -297,7 +646,7 @@ def get_alignment_consensus(file):
         target_id, target_start, target_seq, target_end = alignment[2].split()
         key = f"{target_id}-{target_start}-{target_end}"
         perc_ident, perc_sim = calculate_identity_similarity(consensus)
-        alignments_dict[key] = {
+        yield key, {
             "consensus": consensus,
             "target_start": target_start,
             "target_end": target_end,
@@ -308,7 +657,6 @@ def get_alignment_consensus(file):
             "perc_ident": perc_ident,
             "perc_sim": perc_sim,
         }
-    return alignments_dict
 
 
 def calculate_identity_similarity(consensus):
@@ -328,30 +676,129 @@ def calculate_identity_similarity(consensus):
     return percent_identity, percent_similarity
 
 
-def add_sim_ident(df, alignment_dict):
-    df["similarity"] = (
-        df["target_name"]
-        + "-"
-        + df["ali_from"].astype(str)
-        + "-"
-        + df["ali_to"].astype(str)
+ALIGNMENT_KEY = ["MGYP", "target_start", "target_end"]
+
+
+def alignment_targets(keys):
+    """
+    Target keys (see target_keys()) of "<target>-<target_start>-<target_end>" alignment
+    keys
+    :param keys: alignment dictionary keys
+    :return:
+    """
+    keys = pd.Series(keys, dtype=str)
+    if keys.str.match(MGYP_ACCESSION + "-").all():
+        # accessions are MGYP followed by 12 digits
+        return mgyp_numbers(keys.str[:16])
+    return target_keys(keys.str.rsplit("-", n=2).str[0], numeric=False)
+
+
+def hit_keys(names, table):
+    """
+    Target keys of hits, of the same kind as the keys of their alignment_table(): MGYP
+    numbers if all alignments of the search are of MGnify proteins, else the names
+    :param names: target names of the hits
+    :param table: alignment_table() of the search
+    :return:
+    """
+    return target_keys(names, None if table["MGYP"].dtype.kind in "iu" else False)
+
+
+def alignment_table(alignment_dict):
+    """
+    Table of the alignments keyed by target and target coordinates, replacing lookups by
+    "<target>-<target_start>-<target_end>" strings. Targets are MGYP numbers, or their
+    names in searches against other sequence databases (see target_keys()).
+    :param alignment_dict: alignments from get_alignment_consensus()
+    :return: DataFrame in dict order with MGYP, target_start, target_end, perc_ident and
+    perc_sim columns
+    """
+    keys = list(alignment_dict)
+    entries = list(alignment_dict.values())
+
+    def column(field, dtype):
+        return np.array([entry[field] for entry in entries], dtype=dtype)
+
+    return pd.DataFrame(
+        {
+            "MGYP": alignment_targets(keys),
+            "target_start": column("target_start", np.int64),
+            "target_end": column("target_end", np.int64),
+            "perc_ident": column("perc_ident", np.float64),
+            "perc_sim": column("perc_sim", np.float64),
+        }
     )
-    df["identity"] = df["similarity"]
-    df["similarity"] = df["similarity"].apply(lambda x: alignment_dict[x]["perc_sim"])
-    df["identity"] = df["identity"].apply(lambda x: alignment_dict[x]["perc_ident"])
 
 
-def plot_residue_histogram(args):
-    results_file = args.input
-    results_basepath = results_file.parents[0]
-    alignments = results_basepath / "alignments.json"
-    residue = int(args.residue)
-    plotwidth = args.plotwidth
+def alignment_index(table):
+    """
+    Index of the ALIGNMENT_KEY of an alignment_table(), for repeated lookups of hits in
+    the same table, e.g. chunk by chunk
+    :param table: alignment_table()
+    :return: pandas MultiIndex in table order
+    """
+    return pd.MultiIndex.from_frame(table[ALIGNMENT_KEY])
 
-    with open(alignments, "r") as fin:
-        alignment_dict = json.load(fin)
 
-    # Get residue counts data
+def alignment_positions(table, mgyp, ali_from, ali_to, index=None):
+    """
+    Rows of the alignments of hits in an alignment_table()
+    :param table: alignment_table()
+    :param mgyp: target keys of the hits, see hit_keys()
+    :param ali_from: alignment start of the hits
+    :param ali_to: alignment end of the hits
+    :param index: alignment_index() of table. Without it each call joins the hits with
+    the whole table
+    :return: row positions in hit order
+    """
+    mgyp = np.asarray(mgyp)
+    if mgyp.dtype.kind != table["MGYP"].dtype.kind:
+        # names of other targets in an MGnify search, which have no alignment
+        table = table.assign(MGYP=target_names(table["MGYP"]))
+        index = None
+    keys = pd.DataFrame(
+        {
+            "MGYP": mgyp,
+            "target_start": np.asarray(ali_from, dtype=np.int64),
+            "target_end": np.asarray(ali_to, dtype=np.int64),
+        }
+    )
+    if index is not None:
+        positions = pd.Series(index.get_indexer(pd.MultiIndex.from_frame(keys)))
+        positions = positions.where(positions >= 0)
+    else:
+        rows = table[ALIGNMENT_KEY].assign(position=np.arange(len(table)))
+        positions = keys.merge(rows, how="left", on=ALIGNMENT_KEY)["position"]
+    missing = positions.isna().to_numpy()
+    if missing.any():
+        target, start, end = keys[missing].iloc[0]
+        raise KeyError(f"{target_names([target])[0]}-{start}-{end}")
+    return positions.to_numpy(dtype=np.int64)
+
+
+def add_sim_ident(df, alignment_dict, mgyp=None, table=None, index=None):
+    """
+    Add similarity and identity of the hit alignments
+    :param df: hit table
+    :param alignment_dict: alignments from get_alignment_consensus()
+    :param mgyp: target keys of the hits if already parsed, see hit_keys()
+    :param table: alignment_table() of alignment_dict, built if not given
+    :param index: alignment_index() of table
+    """
+    table = alignment_table(alignment_dict) if table is None else table
+    mgyp = hit_keys(df["target_name"], table) if mgyp is None else mgyp
+    positions = alignment_positions(table, mgyp, df["ali_from"], df["ali_to"], index)
+    df["similarity"] = table["perc_sim"].to_numpy()[positions]
+    df["identity"] = table["perc_ident"].to_numpy()[positions]
+
+
+def residue_counts(alignment_dict, residue):
+    """
+    Count the hit residues aligned to a query residue over all alignments
+    :param alignment_dict: alignments from get_alignment_consensus()
+    :param residue: query residue coordinate
+    :return: (residue, count) tuples, most common first
+    """
     found = []
     for key, alignment in alignment_dict.items():
         if (
@@ -361,7 +808,20 @@ def plot_residue_histogram(args):
             relative_coordinate = residue - int(alignment["query_start"])
             target_index = index_on_target(relative_coordinate, alignment["query_seq"])
             found.append(alignment["target_seq"][target_index])
-    found = Counter(found).most_common()
+    return Counter(found).most_common()
+
+
+def plot_residue_histogram(args):
+    results_file = args.input
+    results_basepath = results_file.parents[0]
+    alignments = results_basepath / "alignments.json"
+    residue = int(args.residue)
+    plotwidth = args.plotwidth
+
+    with open(alignments, "r") as fin:
+        alignment_dict = json.load(fin)
+
+    found = residue_counts(alignment_dict, residue)
 
     # Plot output
     max_value = max(count for label, count in found)
@@ -387,7 +847,8 @@ def plot_residue_histogram(args):
 class hmmerResults:
     """Class to hold HMMER search results in a pandas dataframe"""
 
-    def __init__(self, results):
+    def __init__(self, results, compact=False):
+        self.compact = compact
         self.df = results
 
     @property
@@ -484,78 +945,240 @@ class hmmerResults:
 
             calculate_coverage()
 
+        if self.compact:
+            self._df = compact_table(self._df)
+
     def save(self, outfile, sep=";", index=False, **kwargs):
         self.df.to_csv(outfile, sep=sep, index=index, **kwargs)
 
 
+# above this many hits the IDs are loaded into a temporary table instead of IN lists
+TEMP_TABLE_MIN_HITS = 10 * BATCH_SIZE
+
+
 def domain_filter(args):
-    hits = pd.read_csv(args.input)
-    if args.strict:
-        matches = strict_select(args.arch)
+    with stage("read"):
+        hits = read_table(
+            args.input,
+            compact=args.compact,
+            where=threshold_expression(where=args.where),
+        )
+        check_accessions(hits["target_name"], args.input)
+    results = domain_hits(
+        hits,
+        args.arch,
+        args.strict,
+        exclude=args.exclude,
+        strategy=args.strategy,
+        sqlite=args.sqlite,
+        local_index=args.local_index,
+        db_metrics=args.db_metrics,
+    )
+    if args.compact:
+        results = compact_table(results)
+    if args.memory_report:
+        print(memory_report(results), file=sys.stderr)
+    with stage("write"):
+        if args.output:
+            write_table(results, args.output, args.output_format)
+        else:
+            print(results.to_string())
+
+
+def domain_hits(
+    hits,
+    arch,
+    strict=False,
+    exclude=(),
+    strategy="auto",
+    sqlite=None,
+    local_index=None,
+    db_metrics=False,
+    db=None,
+    index=None,
+):
+    """
+    Keep the hits whose protein architecture contains all (strict) or any of the Pfams
+    and add the Pfams and domain_names columns
+    :param hits: filter output
+    :param arch: Pfam accessions
+    :param strict: require all Pfams instead of any
+    :param exclude: Pfam accessions that must not be part of the architecture
+    :param strategy: one of DOMAIN_STRATEGIES
+    :param sqlite: local SQLite database to use instead of the MySQL server
+    :param local_index: local index from domain_index, or its directory, used instead
+    of any database
+    :param db_metrics: print query counts and timings to stderr
+    :param db: open proteinDB to use instead of sqlite or the shared database
+    :param index: architectureIndex of the database, loaded from its cache by default
+    :return:
+    """
+    if local_index is not None:
+        # pyroaring is an optional dependency, only needed for local indexes
+        from mgyminer.localindex import localArchitectureIndex
+
+        with stage("architecture query"):
+            if not isinstance(local_index, localArchitectureIndex):
+                local_index = localArchitectureIndex(local_index)
+            matches = local_index.select_architectures(
+                arch, strict, hits["target_name"], exclude, numeric_ids=True
+            )
     else:
-        matches = loose_select(args.arch)
-    results = pd.merge(matches, hits, left_on="MGYP", right_on="target_name")
-    results = results[
-        [column for column in results if column not in ["Pfams", "domain_names"]]
-        + ["Pfams", "domain_names"]
-    ]
-    del results["MGYP"]
-    if args.output:
-        results.to_csv(args.output, index=False, sep=",")
+        if db is not None:
+            database = nullcontext(db)
+        elif sqlite is not None:
+            database = proteinDB(sqlite=sqlite)
+        else:
+            database = nullcontext(shared_database())
+        with database as db, stage("architecture query"):
+            matches = select_architectures(
+                arch,
+                strict,
+                hits["target_name"],
+                strategy,
+                db,
+                index=index,
+                exclude=exclude,
+                numeric_ids=True,
+            )
+            if db_metrics:
+                print(db.report(), file=sys.stderr)
+    with stage("merge"):
+        hits = hits.assign(MGYP=mgyp_numbers(hits["target_name"]))
+        results = pd.merge(matches, hits, on="MGYP")
+        results = results[
+            [column for column in results if column not in ["Pfams", "domain_names"]]
+            + ["Pfams", "domain_names"]
+        ]
+        del results["MGYP"]
+    return results
+
+
+def plan_domain_query(n_hits, n_matches):
+    """
+    Choose how to match hits to architectures
+    :param n_hits: number of distinct hit proteins
+    :param n_matches: number of proteins with a matching architecture
+    :return: fetch if the matching proteins are not more than the hits, otherwise in for
+    hit sets that fit in a few IN lists and temp for larger ones
+    """
+    if n_matches <= n_hits:
+        return "fetch"
+    if n_hits <= TEMP_TABLE_MIN_HITS:
+        return "in"
+    return "temp"
+
+
+def select_architectures(
+    pfams,
+    strict,
+    targets=None,
+    strategy="auto",
+    db=None,
+    index=None,
+    exclude=(),
+    numeric_ids=False,
+):
+    """
+    Proteins whose architecture contains all (strict) or any of the Pfams. Rows are
+    streamed from the database and reduced to the matching targets chunk by chunk, so
+    memory is bounded by the result rather than by the rows scanned.
+    :param pfams: Pfam accessions
+    :param strict: require all Pfams instead of any
+    :param targets: MGYP accessions of the hits, only these proteins are returned
+    when given
+    :param strategy: one of DOMAIN_STRATEGIES. fetch scans every protein with a
+    matching architecture, in and temp send the hit IDs to the database in IN lists or a
+    temporary table. auto picks one with plan_domain_query()
+    :param db: proteinDB, the shared database by default
+    :param index: architectureIndex of db, loaded from its cache by default
+    :param exclude: Pfam accessions that must not be part of the architecture
+    :param numeric_ids: return MGYP numbers instead of accessions, for integer joins
+    :return: DataFrame with MGYP, Pfams and domain_names columns
+    """
+    db = shared_database() if db is None else db
+    if strategy not in DOMAIN_STRATEGIES:
+        raise ValueError(f"Invalid strategy. Expected one of: {DOMAIN_STRATEGIES}")
+    index = architectureIndex.load(db) if index is None else index
+    matching = index.select(pfams, strict, exclude)
+    arch_ids = index.ids[matching].tolist()
+    label = "strict_select" if strict else "loose_select"
+    ids = None
+    if targets is not None:
+        ids = np.unique(mgyp_numbers(targets))
+    if targets is None:
+        strategy = "fetch"
+    elif strategy == "auto":
+        counts = db.execute_in_batches(
+            "SELECT COUNT(*) FROM protein_arch WHERE arch_id IN ({ids})",
+            arch_ids,
+            label="count_matches",
+        )
+        strategy = plan_domain_query(len(ids), sum(count for count, in counts))
+
+    if strategy == "fetch":
+        chunks = db.stream_in_batches(
+            "SELECT id, arch_id FROM protein_arch WHERE arch_id IN ({ids})",
+            arch_ids,
+            label=label,
+        )
+    elif strategy == "in":
+        chunks = db.stream_in_batches(
+            "SELECT id, arch_id FROM protein_arch"
+            " WHERE id IN ({ids}) AND arch_id IS NOT NULL",
+            ids.tolist(),
+            label=label,
+        )
     else:
-        print(results.to_string())
-
-
-def connect_database():
-    config_root = Path(__file__).parents[1]
-    with open(config_root / "config.yaml") as configfile:
-        cfg = yaml.load(configfile, Loader=yaml.CLoader)
-    proteindb = mysql.connector.connect(**cfg["mysql"])
-    return proteindb
-
-
-def strict_select(pfams):
-    config_root = Path(__file__).parents[1]
-    with open(config_root / "config.yaml") as configfile:
-        cfg = yaml.load(configfile, Loader=yaml.CLoader)
-    proteindb = mysql.connector.connect(**cfg["mysql"])
-    cursor = proteindb.cursor()
-    conditions = f"pfams LIKE '%{pfams[0]}%'"
-    for pfam in pfams[1:]:
-        conditions += f" AND pfams LIKE '%{pfam}%'"
-    statement = (
-        f"SELECT pa.id, ar.pfams, ar.names FROM architecture ar LEFT JOIN protein_arch pa ON"
-        f" ar.id = pa.arch_id WHERE {conditions}"
-    )
-    cursor.execute(statement)
-    hits = pd.DataFrame(cursor.fetchall(), columns=["MGYP", "Pfams", "domain_names"])
-    hits = hits.dropna()
-    hits["MGYP"] = hits["MGYP"].astype(np.int64)
-    if hits.empty:
-        return hits
-    hits["MGYP"] = hits["MGYP"].astype(int).apply(lambda x: f"MGYP{x:012d}")
-    cursor.close()
-    return hits
-
-
-def loose_select(pfams):
-    config_root = Path(__file__).parents[1]
-    with open(config_root / "config.yaml") as configfile:
-        cfg = yaml.load(configfile, Loader=yaml.CLoader)
-    proteindb = mysql.connector.connect(**cfg["mysql"])
-    cursor = proteindb.cursor()
-    regex = "|".join(pfams)
-    statement = (
-        f"SELECT pa.id, ar.pfams, ar.names FROM architecture ar LEFT JOIN protein_arch pa ON"
-        f" ar.id = pa.arch_id WHERE pfams REGEXP '{regex}'"
+        chunks = db.stream_with_id_table(
+            "SELECT pa.id, pa.arch_id FROM hit_ids h JOIN protein_arch pa"
+            " ON pa.id = h.id WHERE pa.arch_id IS NOT NULL",
+            ids.tolist(),
+            label=label,
+        )
+
+    mgyp = [np.empty(0, dtype=np.int64)]
+    arch_rows = [np.empty(0, dtype=np.int64)]
+    for rows in chunks:
+        chunk = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        positions = index.rows_of(chunk[:, 1])
+        keep = np.isin(positions, matching)
+        if ids is not None and strategy == "fetch":
+            keep &= np.isin(chunk[:, 0], ids)
+        mgyp.append(chunk[keep, 0])
+        arch_rows.append(positions[keep])
+    mgyp = np.concatenate(mgyp)
+    arch_rows = np.concatenate(arch_rows)
+    return pd.DataFrame(
+        {
+            "MGYP": mgyp if numeric_ids else mgyp_accessions(mgyp),
+            "Pfams": index.pfams[arch_rows].astype(object),
+            "domain_names": index.names[arch_rows].astype(object),
+        }
     )
-    cursor.execute(statement)
-    hits = pd.DataFrame(cursor.fetchall(), columns=["MGYP", "Pfams", "domain_names"])
-    hits = hits.dropna()
-    hits["MGYP"] = hits["MGYP"].astype(np.int64)
-    cursor.close()
-    if hits.empty:
-        return hits
+
+
+def export_domain_index(args):
+    # pyroaring is an optional dependency, only needed for local indexes
+    from mgyminer.localindex import localArchitectureIndex
+
+    if args.sqlite is not None:
+        database = proteinDB(sqlite=args.sqlite)
     else:
-        hits["MGYP"] = hits["MGYP"].astype(int).apply(lambda x: f"MGYP{x:012d}")
-        return hits
+        database = nullcontext(shared_database())
+    with database as db:
+        index = localArchitectureIndex.export(db, args.output)
+        if args.db_metrics:
+            print(db.report(), file=sys.stderr)
+    print(
+        f"Exported {len(index)} proteins with {len(index.architectures)} architectures"
+        f" and {len(index.tokens)} Pfams to {args.output}"
+    )
+
+
+def strict_select(pfams, db=None):
+    return select_architectures(pfams, True, strategy="fetch", db=db)
+
+
+def loose_select(pfams, db=None):
+    return select_architectures(pfams, False, strategy="fetch", db=db)
@@ -0,0 +1,181 @@
+from pathlib import Path
+from typing import Sequence, Union
+
+import numpy as np
+import pandas as pd
+from pyroaring import BitMap, FrozenBitMap
+
+from mgyminer.annotation import mgyp_accessions, mgyp_numbers
+from mgyminer.archindex import architectureIndex
+from mgyminer.database import proteinDB
+
+
+class localArchitectureIndex:
+    """
+    Offline copy of the architecture database in a directory:
+    mgyp.npy           sorted MGYP numbers of all proteins with an architecture
+    arch.npy           architecture id of each protein, aligned with mgyp.npy
+    architectures.npz  architectureIndex with Pfams and domain names
+    pfams.npz          Pfam accessions and byte offsets of their bitmaps in bitmaps.bin
+    bitmaps.bin        serialized roaring bitmaps of the protein row positions per Pfam
+    The arrays and bitmaps are memory mapped, only the bitmaps of the queried Pfams and
+    the rows of the hits are read.
+    """
+
+    def __init__(self, directory: Union[Path, str]) -> None:
+        self.directory = Path(directory)
+        self.mgyp = np.load(self.directory / "mgyp.npy", mmap_mode="r")
+        self.arch = np.load(self.directory / "arch.npy", mmap_mode="r")
+        self.architectures = architectureIndex.read(
+            self.directory / "architectures.npz"
+        )
+        with np.load(self.directory / "pfams.npz") as data:
+            self.tokens = data["tokens"]
+            self.offsets = data["offsets"]
+        self._bitmaps = np.memmap(self.directory / "bitmaps.bin", mode="r")
+
+    @classmethod
+    def export(
+        cls,
+        db: proteinDB,
+        directory: Union[Path, str],
+        batch_size: int = 1000000,
+    ):
+        """
+        Export architecture and protein_arch of a database into a local index
+        :param db: database to export
+        :param directory: output directory, created if missing
+        :param batch_size: protein_arch rows processed at once
+        :return: the exported index
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        architectures = architectureIndex.load(db, directory / "architectures.npz")
+        arch_offsets, arch_tokens = architectures.token_lists()
+        n = db.execute(
+            "SELECT COUNT(*) FROM protein_arch WHERE arch_id IS NOT NULL",
+            label="count_proteins",
+        )[0][0]
+        if n >= 1 << 32:
+            raise ValueError(f"{n} proteins exceed the 32 bit bitmap row positions")
+
+        mgyp = np.lib.format.open_memmap(
+            directory / "mgyp.npy", mode="w+", dtype=np.int64, shape=(n,)
+        )
+        arch = np.lib.format.open_memmap(
+            directory / "arch.npy", mode="w+", dtype=np.int64, shape=(n,)
+        )
+        bitmaps = [BitMap() for _ in architectures.tokens]
+        start = 0
+        for rows in db.stream(
+            "SELECT id, arch_id FROM protein_arch WHERE arch_id IS NOT NULL"
+            " ORDER BY id",
+            label="export_proteins",
+            batch_size=batch_size,
+        ):
+            chunk = np.array(rows, dtype=np.int64).reshape(-1, 2)
+            stop = start + len(chunk)
+            mgyp[start:stop] = chunk[:, 0]
+            arch[start:stop] = chunk[:, 1]
+            # one (token, row position) pair per Pfam of each protein's architecture
+            arch_rows = architectures.rows_of(chunk[:, 1])
+            known = arch_rows >= 0
+            positions = np.arange(start, stop)[known]
+            arch_rows = arch_rows[known]
+            counts = arch_offsets[arch_rows + 1] - arch_offsets[arch_rows]
+            pair_positions = np.repeat(positions, counts)
+            token_positions = np.repeat(arch_offsets[arch_rows], counts) + (
+                np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            )
+            tokens = arch_tokens[token_positions]
+            order = np.argsort(tokens, kind="stable")
+            tokens, pair_positions = tokens[order], pair_positions[order]
+            bounds = np.flatnonzero(np.diff(tokens)) + 1
+            for token, segment in zip(
+                tokens[np.concatenate([[0], bounds])] if len(tokens) else [],
+                np.split(pair_positions, bounds),
+            ):
+                bitmaps[token].update(segment.astype(np.uint32))
+            start = stop
+        mgyp.flush()
+        arch.flush()
+        del mgyp, arch
+
+        offsets = [0]
+        with open(directory / "bitmaps.bin", "wb") as fout:
+            for bitmap in bitmaps:
+                bitmap.run_optimize()
+                offsets.append(offsets[-1] + fout.write(bitmap.serialize()))
+        np.savez(
+            directory / "pfams.npz",
+            tokens=architectures.tokens,
+            offsets=np.array(offsets, dtype=np.int64),
+        )
+        return cls(directory)
+
+    def __len__(self) -> int:
+        return len(self.mgyp)
+
+    def bitmap(self, pfam: str) -> FrozenBitMap:
+        """Row positions of the proteins whose architecture contains pfam"""
+        i = np.searchsorted(self.tokens, pfam)
+        if i == len(self.tokens) or self.tokens[i] != pfam:
+            return FrozenBitMap()
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return FrozenBitMap.deserialize(bytes(self._bitmaps[start:stop]))
+
+    def select(
+        self, pfams: Sequence[str], strict: bool, exclude: Sequence[str] = ()
+    ) -> BitMap:
+        """
+        Row positions of the proteins with all (strict) or any of the pfams and none of
+        the excluded ones
+        """
+        if not pfams:
+            return BitMap()
+        combine = BitMap.intersection if strict else BitMap.union
+        selected = combine(*[self.bitmap(pfam) for pfam in pfams])
+        for pfam in exclude:
+            selected -= self.bitmap(pfam)
+        return selected
+
+    def rows_of(self, mgyp: np.ndarray) -> np.ndarray:
+        """Row positions of MGYP numbers, -1 for proteins without an architecture"""
+        if not len(self):
+            return np.full(len(mgyp), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.mgyp, mgyp), len(self) - 1)
+        return np.where(self.mgyp[positions] == mgyp, positions, -1)
+
+    def select_architectures(
+        self,
+        pfams: Sequence[str],
+        strict: bool,
+        targets,
+        exclude: Sequence[str] = (),
+        numeric_ids: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Architectures of the target proteins that contain all (strict) or any of the
+        pfams and none of the excluded ones
+        :param pfams: Pfam accessions
+        :param strict: require all Pfams instead of any
+        :param targets: MGYP accessions of the hits
+        :param exclude: Pfam accessions that must not be part of the architecture
+        :param numeric_ids: return MGYP numbers instead of accessions, for integer joins
+        :return: DataFrame with MGYP, Pfams and domain_names columns
+        """
+        rows = self.rows_of(np.unique(mgyp_numbers(targets)))
+        found = rows >= 0
+        hits = BitMap(rows[found].astype(np.uint32)) & self.select(
+            pfams, strict, exclude
+        )
+        positions = np.frombuffer(hits.to_array(), dtype=np.uint32)
+        arch_rows = self.architectures.rows_of(np.asarray(self.arch[positions]))
+        mgyp = np.asarray(self.mgyp[positions])
+        return pd.DataFrame(
+            {
+                "MGYP": mgyp if numeric_ids else mgyp_accessions(mgyp),
+                "Pfams": self.architectures.pfams[arch_rows].astype(object),
+                "domain_names": self.architectures.names[arch_rows].astype(object),
+            }
+        )
@@ -0,0 +1,201 @@
+import re
+from pathlib import Path
+from typing import Iterator, List, Optional, TextIO, Union
+
+import numpy as np
+
+# Newick tokens: structure characters, comments, quoted labels and unquoted labels/numbers
+_TOKEN = re.compile(r"\s*(\(|\)|,|;|:|\[[^\]]*\]|'(?:[^']|'')*'|[^\s(),;:\[\]']+)")
+
+
+def _tokens(handle: TextIO, chunksize: int = 1 << 20) -> Iterator[str]:
+    """
+    Stream Newick tokens from a file handle without reading the whole file into memory.
+    A token touching the end of the buffer might continue in the next chunk, so it is
+    held back until more data is read.
+    """
+    buffer = ""
+    eof = False
+    while not eof:
+        chunk = handle.read(chunksize)
+        eof = not chunk
+        buffer += chunk
+        position = 0
+        while True:
+            match = _TOKEN.match(buffer, position)
+            if match is None or (match.end() == len(buffer) and not eof):
+                break
+            position = match.end()
+            yield match.group(1)
+        buffer = buffer[position:]
+        if eof and buffer.strip():
+            raise ValueError(f"Unexpected characters in newick tree: {buffer[:50]}")
+
+
+def _is_number(label: str) -> bool:
+    try:
+        float(label)
+        return True
+    except ValueError:
+        return False
+
+
+class arrayTree:
+    """
+    Compact tree representation. Nodes are numbered in preorder, so every parent comes
+    before its children and every subtree is a contiguous index range.
+    parent, first_child and next_sibling hold node indices (-1 for none).
+    """
+
+    def __init__(
+        self,
+        parent: np.ndarray,
+        first_child: np.ndarray,
+        next_sibling: np.ndarray,
+        branch_length: np.ndarray,
+        names: List[Optional[str]],
+    ) -> None:
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.branch_length = branch_length
+        self.names = names
+
+    @classmethod
+    def read(cls, file: Union[Path, str, TextIO]):
+        """
+        Parse the first tree of a Newick file.
+        Numeric labels of internal nodes are support values and are not used as names,
+        like Bio.Phylo does.
+        :param file: Path or handle to Newick file
+        :return:
+        """
+        closeit = False
+        if isinstance(file, (str, Path)):
+            file = open(file, "r")
+            closeit = True
+
+        parent = []
+        branch_length = []
+        names = []
+        stack = []
+        current = -1  # node the next label or branch length belongs to
+        closed = False  # current node was closed by ")", a label is an internal name
+        # a child (or the root) was started by "(" or "," and has no node yet. It is a
+        # leaf, unnamed if ":", "," or ")" follows instead of a label
+        pending = True
+        expect_length = False
+
+        def new_node():
+            parent.append(stack[-1] if stack else -1)
+            branch_length.append(0.0)
+            names.append(None)
+            return len(parent) - 1
+
+        try:
+            for token in _tokens(file):
+                if token.startswith("["):
+                    continue
+                elif expect_length:
+                    branch_length[current] = float(token)
+                    expect_length = False
+                elif token == "(":
+                    current = new_node()
+                    stack.append(current)
+                    closed = False
+                    pending = True
+                elif token == ";":
+                    break
+                elif token in (")", ",", ":"):
+                    if pending:
+                        current = new_node()
+                    pending = False
+                    if token == ")":
+                        if not stack:
+                            raise ValueError("Unbalanced parentheses in newick tree")
+                        current = stack.pop()
+                        closed = True
+                    elif token == ",":
+                        closed = False
+                        pending = True
+                    else:
+                        expect_length = True
+                else:
+                    if token.startswith("'"):
+                        token = token[1:-1].replace("''", "'")
+                    if closed:
+                        if not _is_number(token):
+                            names[current] = token
+                    else:
+                        current = new_node()
+                        names[current] = token
+                    pending = False
+        finally:
+            if closeit:
+                file.close()
+
+        if stack:
+            raise ValueError("Unbalanced parentheses in newick tree")
+        if not parent:
+            raise ValueError("Empty newick tree")
+
+        n = len(parent)
+        first_child = [-1] * n
+        next_sibling = [-1] * n
+        last_seen = [-1] * n
+        # in preorder the children of a node appear in increasing index order
+        for node in range(1, n):
+            p = parent[node]
+            if first_child[p] == -1:
+                first_child[p] = node
+            else:
+                next_sibling[last_seen[p]] = node
+            last_seen[p] = node
+        return cls(
+            np.array(parent, dtype=np.int64),
+            np.array(first_child, dtype=np.int64),
+            np.array(next_sibling, dtype=np.int64),
+            np.array(branch_length, dtype=np.float64),
+            names,
+        )
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    @property
+    def is_leaf(self) -> np.ndarray:
+        return self.first_child == -1
+
+    @property
+    def leaves(self) -> np.ndarray:
+        """Leaf node indices in preorder, the order of Bio.Phylo's get_terminals()"""
+        return np.flatnonzero(self.is_leaf)
+
+    @property
+    def last_child(self) -> np.ndarray:
+        last_child = np.full(len(self), -1, dtype=np.int64)
+        np.maximum.at(last_child, self.parent[1:], np.arange(1, len(self)))
+        return last_child
+
+    def depths(self, unit_branch_lengths: bool = False) -> np.ndarray:
+        """
+        Distance of every node to the root
+        :param unit_branch_lengths: count edges instead of summing branch lengths
+        :return:
+        """
+        depth = (
+            [1.0] * len(self) if unit_branch_lengths else self.branch_length.tolist()
+        )
+        # like Bio.Phylo, the root starts at its own branch length
+        depth[0] = float(self.branch_length[0])
+        parent = self.parent.tolist()
+        for node in range(1, len(self)):
+            depth[node] += depth[parent[node]]
+        return np.array(depth)
+
+    def find(self, name: str) -> int:
+        """Index of the first node with this name"""
+        try:
+            return self.names.index(name)
+        except ValueError:
+            raise KeyError(f"{name} is not a node of the tree")
@@ -0,0 +1,6 @@
+# Choices of command line options. Kept free of third party imports so that the parser
+# can be built without loading the modules of the commands.
+
+COLLAPSE_MODES = ["depth", "size", "distance"]
+DOMAIN_STRATEGIES = ["auto", "fetch", "in", "temp"]
+TABLE_FORMATS = ["csv", "parquet", "arrow"]
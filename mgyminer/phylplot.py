@@ -1,22 +1,27 @@
 import math
+from pathlib import Path
+from typing import Union
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from Bio import Phylo
 
+from mgyminer.annotation import annotate_nodes, dom_accessions, domain_maps
+from mgyminer.collapse import clade_aggregates, collapsed_clades, visible_nodes
+from mgyminer.newick import arrayTree
+from mgyminer.profiling import stage
+from mgyminer.tables import read_table
+from mgyminer.treeindex import file_digest, frame_digest, lcaIndex
 
-def get_x_coordinates(tree):
-    # Associates to  each clade a x-coord.
-    # returns a dict {clade: x-coord}, i.e the key is a clade, and x-coord its value
 
+def get_x_coordinates(tree):
+    # Associates to each node a x-coord, the distance from the root by branch length.
+    # returns an array of x-coords in node order
     xcoords = tree.depths()
-    # tree.depth() maps tree clades to depths (by branch length).
-    # returns a dict {clade: depth} where clade runs over all Clade instances of the tree,
-    # and depth is the distance from root to clade
 
     # If there are no branch lengths, assign unit branch lengths
-    if not max(xcoords.values()):
+    if not xcoords.max():
         xcoords = tree.depths(unit_branch_lengths=True)
     return xcoords
 
@@ -25,24 +30,23 @@ def get_y_coordinates(tree, dist=1.3):
     # y-coordinates are   multiple of dist (i*dist below);
     # dist: vertical distance between two consecutive leafs; it is chosen such that to get a tree of
     # reasonable height
-    # returns  a dict {clade: y-coord}
+    # returns an array of y-coords in node order
 
-    maxheight = tree.count_terminals()  # Counts the number of tree leafs.
-
-    ycoords = dict(
-        (leaf, maxheight - i * dist)
-        for i, leaf in enumerate(reversed(tree.get_terminals()))
-    )
+    leaves = tree.leaves
+    maxheight = len(leaves)  # Counts the number of tree leafs.
 
-    def calc_row(clade):
-        for subclade in clade:
-            if subclade not in ycoords:
-                calc_row(subclade)
-        ycoords[clade] = (ycoords[clade.clades[0]] + ycoords[clade.clades[-1]]) / 2
+    ycoords = np.zeros(len(tree))
+    ycoords[leaves[::-1]] = maxheight - np.arange(len(leaves)) * dist
 
-    if tree.root.clades:
-        calc_row(tree.root)
-    return ycoords
+    # Internal nodes sit in the middle of their first and last child. Walking the
+    # preorder backwards visits all children before their parent.
+    first_child = tree.first_child.tolist()
+    last_child = tree.last_child.tolist()
+    y = ycoords.tolist()
+    for node in range(len(tree) - 1, -1, -1):
+        if first_child[node] != -1:
+            y[node] = (y[first_child[node]] + y[last_child[node]]) / 2
+    return np.array(y)
 
 
 def get_clade_lines(
@@ -73,80 +77,90 @@ def get_clade_lines(
 def draw_clade(
     x_coords,
     y_coords,
-    clade,
-    x_start,
+    tree,
     line_shapes,
     line_color="rgb(15,15,15)",
     line_width=1,
 ):
-    # defines recursively  the tree  lines (branches), starting from the argument clade
-
-    x_curr = x_coords[clade]
-    y_curr = y_coords[clade]
-
-    # Draw a horizontal line
-    branch_line = get_clade_lines(
-        orientation="horizontal",
-        y_curr=y_curr,
-        x_start=x_start,
-        x_curr=x_curr,
-        line_color=line_color,
-        line_width=line_width,
-    )
-
-    line_shapes.append(branch_line)
+    # defines the tree lines (branches) for all nodes of the tree
 
-    if clade.clades:
-        # Draw a vertical line connecting all children
-        y_top = y_coords[clade.clades[0]]
-        y_bot = y_coords[clade.clades[-1]]
+    parent = tree.parent.tolist()
+    first_child = tree.first_child.tolist()
+    last_child = tree.last_child.tolist()
+    x = x_coords.tolist()
+    y = y_coords.tolist()
 
+    for node in range(len(tree)):
+        x_start = x[parent[node]] if parent[node] != -1 else 0
+        # Draw a horizontal line
         line_shapes.append(
             get_clade_lines(
-                orientation="vertical",
-                x_curr=x_curr,
-                y_bot=y_bot,
-                y_top=y_top,
+                orientation="horizontal",
+                y_curr=y[node],
+                x_start=x_start,
+                x_curr=x[node],
                 line_color=line_color,
                 line_width=line_width,
             )
         )
 
-        # Draw descendants
-        for child in clade:
-            draw_clade(x_coords, y_coords, child, x_curr, line_shapes)
+        if first_child[node] != -1:
+            # Draw a vertical line connecting all children
+            line_shapes.append(
+                get_clade_lines(
+                    orientation="vertical",
+                    x_curr=x[node],
+                    y_bot=y[last_child[node]],
+                    y_top=y[first_child[node]],
+                    line_color=line_color,
+                    line_width=line_width,
+                )
+            )
 
 
 def distances(tree, target):
-    if isinstance(target, str):
-        target = [i for i in tree.find_elements(target)][0]
-    closest = {
-        terminal.name: tree.distance(target, terminal)
-        for terminal in tree.get_terminals()
-    }
-    closest = {k: v for k, v in sorted(closest.items(), key=lambda item: item[1])}
-    return closest
+    """
+    Tree distance from target to every leaf in a single pass over the tree.
+    The distance between two nodes is depth(a) + depth(b) - 2 * depth(lca(a, b)), and the
+    lowest common ancestor of the target and any node is the closest ancestor of that
+    node lying on the path from the root to the target.
+    :param tree: arrayTree
+    :param target: target node index or name
+    :return: array of leaf names and array of distances, both in leaf order
+    """
+    parent = tree.parent.tolist()
+    depth = tree.depths()
+    target_index = tree.find(target) if isinstance(target, str) else target
+
+    on_path = [False] * len(tree)
+    node = target_index
+    while node != -1:
+        on_path[node] = True
+        node = parent[node]
+
+    lca = list(range(len(tree)))
+    for index in range(1, len(tree)):
+        if not on_path[index]:
+            lca[index] = lca[parent[index]]
 
+    leaves = tree.leaves
+    names = np.array(tree.names, dtype=object)[leaves]
+    leaf_distances = depth[target_index] + depth - 2 * depth[np.array(lca)]
+    return names, leaf_distances[leaves]
 
-def _in_thresholds(paramdict, threshold_min=0, threshold_max=math.inf):
+
+def _in_thresholds(keys, values, threshold_min=0, threshold_max=math.inf):
     """
-    Return all dictionary entries, which have a values between threshold_min and threshold_max
-    :param paramdict:
+    Return all keys, which have a value between threshold_min and threshold_max
+    :param keys: array of keys
+    :param values: array of values aligned to keys
     :param threshold_min:
     :param threshold_max:
-    :return:
+    :return: set of keys
     """
-    x = [
-        key
-        for key, value in paramdict.items()
-        if value > threshold_min and value < threshold_max
-    ]
-    return x
-
-
-def _filter_dict(metadata, parameter):
-    """Efficient way to make a dict from two dataframe columns https://stackoverflow.com/questions/17426292/"""
-    return pd.Series(list(metadata[parameter]), index=metadata["dom_acc"]).to_dict()
+    keys = np.asarray(keys)
+    values = np.asarray(values, dtype=np.float64)
+    return set(keys[(values > threshold_min) & (values < threshold_max)])
 
 
 def domain_colors(domains):
@@ -167,7 +181,7 @@ def domain_colors(domains):
 
 
 def domain_start(x_coords):
-    return max(x_coords.values()) + 0.5
+    return x_coords.max() + 0.5
 
 
 def smallest_y_dist(protein_ys):
@@ -182,216 +196,583 @@ def smallest_y_dist(protein_ys):
     return smallest_dist
 
 
-def plot_tree(args):
-    metadata = pd.read_csv(args.filter)
-    tree = Phylo.read(args.tree, "newick")
+def domain_geometry(
+    protein_ys, pfams, query, baseline, domain_width, x_gab, half_height
+):
+    """
+    Place the domain glyphs of every protein in line with its leaf
+    :param protein_ys: {protein: y-coord}
+    :param pfams: {protein: [Pfam accessions]}
+    :param query: name of the query, which gets no domains
+    :return: dict with columns x0, x1, y0, y1, domain, protein of the domain rectangles and
+    dict with columns x0, x1, y, protein of the lines connecting the domains of a protein
+    """
+    rects = {"x0": [], "x1": [], "y0": [], "y1": [], "domain": [], "protein": []}
+    connectors = {"x0": [], "x1": [], "y": [], "protein": []}
+    for protein, y in protein_ys.items():
+        if protein == query:
+            continue
+        start = baseline
+        # Draw domain by domain
+        for domain in pfams[protein]:
+            rects["x0"].append(start)
+            rects["x1"].append(start + domain_width)
+            rects["y0"].append(y - half_height)
+            rects["y1"].append(y + half_height)
+            rects["domain"].append(domain)
+            rects["protein"].append(protein)
+            start = start + domain_width + x_gab
+        # Add a straight line to conncect domains
+        connectors["x0"].append(baseline + x_gab)
+        connectors["x1"].append(start - (domain_width + x_gab))
+        connectors["y"].append(y)
+        connectors["protein"].append(protein)
+    return rects, connectors
+
+
+def domain_shapes(rects, connectors, pfam_colors):
+    """One layout shape per domain and per connecting line"""
+    shapes = [
+        go.layout.Shape(
+            type="rect",
+            x0=x0,
+            x1=x1,
+            y0=y0,
+            y1=y1,
+            fillcolor=pfam_colors[domain],
+            opacity=1,
+            layer="above",
+            line_width=0,
+        )
+        for x0, x1, y0, y1, domain in zip(
+            rects["x0"], rects["x1"], rects["y0"], rects["y1"], rects["domain"]
+        )
+    ]
+    shapes.extend(
+        go.layout.Shape(
+            type="rect",
+            x0=x0,
+            x1=x1,
+            y0=y,
+            y1=y,
+            fillcolor="black",
+            opacity=1,
+            layer="below",
+            line_width=5,  # Might need to be variable
+        )
+        for x0, x1, y in zip(connectors["x0"], connectors["x1"], connectors["y"])
+    )
+    return shapes
 
-    def _idpluscoords(row):
-        if row["ndom"] > 1:
-            domain = "_" + str(row["ndom"])
-        else:
-            domain = ""
-        return f"{row['target_name']}{domain}/{row['env_from']}-{row['env_to']}"
 
-    metadata["dom_acc"] = metadata.apply(lambda row: _idpluscoords(row), axis=1)
-    query = metadata["query_name"][0]
+def domain_hover_traces(rects, pfam_colors, acc_to_name):
+    """One invisible glyph per domain to show hover info"""
+    return [
+        go.Scatter(
+            x=[x0, x1, x1, x0, x0],
+            y=[y0, y0, y1, y1, y0],
+            fill="toself",
+            mode="lines",
+            name="",
+            text=f"<br>Pfam Accession: {domain} <br>Name: {acc_to_name[domain]}",
+            opacity=0,
+            fillcolor=pfam_colors[domain],
+        )
+        for x0, x1, y0, y1, domain in zip(
+            rects["x0"], rects["x1"], rects["y0"], rects["y1"], rects["domain"]
+        )
+    ]
 
-    minimum = 0 if args.min is None else args.min
-    maximum = math.inf if args.max is None else args.max
 
-    if args.param is not None:
-        # if parameter is specified find proteins that match filter for parameter
-        filter_dict = _filter_dict(metadata, args.param)
-        of_interest = _in_thresholds(filter_dict, minimum, maximum)
-    else:
-        # if no parameter is given take the tree distance
-        filter_dict = distances(tree, query)
-        of_interest = _in_thresholds(filter_dict, minimum, maximum)
-
-    x_coords = get_x_coordinates(tree)
-    y_coords = get_y_coordinates(tree)
-
-    line_shapes = []
-    draw_clade(
-        x_coords,
-        y_coords,
-        tree.root,
-        0,
-        line_shapes,
-        line_color="rgb(25,25,25)",
-        line_width=1,
+def _segments(x0, x1, y0, y1):
+    """Interleave line segments into NaN separated coordinate arrays for a single trace"""
+    gaps = np.full(len(x0), np.nan)
+    x = np.column_stack([x0, x1, gaps]).ravel()
+    y = np.column_stack([y0, y1, gaps]).ravel()
+    return x, y
+
+
+def branch_segments(x_coords, y_coords, tree, visible=None, collapsed=None):
+    """
+    Coordinates of all branches as NaN separated line segments
+    :param visible: optional mask of the nodes to draw
+    :param collapsed: optional mask of collapsed clade roots, which get no vertical line
+    :return: x and y arrays
+    """
+    visible = np.ones(len(tree), dtype=bool) if visible is None else visible
+    collapsed = np.zeros(len(tree), dtype=bool) if collapsed is None else collapsed
+    shown = np.flatnonzero(visible)
+    x_start = np.where(tree.parent == -1, 0, x_coords[tree.parent])
+    internal = np.flatnonzero(visible & ~tree.is_leaf & ~collapsed)
+    # horizontal lines from the parent to each node
+    x_h, y_h = _segments(
+        x_start[shown], x_coords[shown], y_coords[shown], y_coords[shown]
+    )
+    # vertical lines connecting all children of internal nodes
+    x_v, y_v = _segments(
+        x_coords[internal],
+        x_coords[internal],
+        y_coords[tree.last_child[internal]],
+        y_coords[tree.first_child[internal]],
+    )
+    return np.concatenate([x_h, x_v]), np.concatenate([y_h, y_v])
+
+
+def branch_trace(segments, line_color, line_width=1):
+    """
+    All branches of the tree as a single NaN separated WebGL line trace
+    :param segments: x and y arrays from branch_segments()
+    :return:
+    """
+    return go.Scattergl(
+        x=segments[0],
+        y=segments[1],
+        mode="lines",
+        line=dict(color=line_color, width=line_width),
+        hoverinfo="skip",
     )
 
-    my_tree_clades = x_coords.keys()
-    X = []  # list of nodes x-coordinates
-    Y = []  # list of nodes y-coords
-    text = []  # list of text to be displayed on hover over nodes
-
-    for cl in my_tree_clades:
-        X.append(x_coords[cl])
-        Y.append(y_coords[cl])
-        text.append(cl.name)
-
-    intermediate_node_color = "rgb(100,100,100)"
-    color = [intermediate_node_color] * len(X)
-
-    for index, row in metadata.iterrows():
-        i = text.index(f"{row['dom_acc']}")
-        if text[i] in of_interest:
-            color[i] = "rgb(0, 200, 20)"
-        text[i] = (
-            text[i]
-            + f"<br>Hit Coverage: {row['coverage_hit']}\
-                              <br>Query Coverage: {row['coverage_query']}\
-                              <br>Similarity: {row['similarity']}\
-                              <br>Identity: {row['identity']}"
-        )
 
-    # color query in red
-    i = text.index(query)
-    color[i] = "rgb(200,0,0)"
-
-    nodes = dict(
-        type="scatter",
-        x=X,
-        y=Y,
-        mode="markers",
-        marker=dict(color=color, size=9),
-        opacity=1.0,
-        text=text,
-        hoverinfo="text",
+def domain_traces(rects, connectors, pfam_colors, acc_to_name, proteins=None):
+    """
+    Domains as one filled trace per Pfam and the connecting lines as a single WebGL line
+    trace, so the number of traces depends on the number of distinct Pfams, not domains.
+    :param proteins: optional set of proteins to draw domains for
+    :return: list of traces
+    """
+    if proteins is not None:
+        rects = pd.DataFrame(rects)
+        rects = rects[rects["protein"].isin(proteins)]
+        connectors = pd.DataFrame(connectors)
+        connectors = connectors[connectors["protein"].isin(proteins)]
+    x, y = _segments(
+        connectors["x0"], connectors["x1"], connectors["y"], connectors["y"]
     )
+    traces = [
+        go.Scattergl(
+            x=x, y=y, mode="lines", line=dict(color="black", width=5), hoverinfo="skip"
+        )
+    ]
+    rect_df = pd.DataFrame(rects)
+    for domain, group in rect_df.groupby("domain"):
+        gaps = np.full(len(group), np.nan)
+        x = np.column_stack(
+            [group["x0"], group["x1"], group["x1"], group["x0"], group["x0"], gaps]
+        ).ravel()
+        y = np.column_stack(
+            [group["y0"], group["y0"], group["y1"], group["y1"], group["y0"], gaps]
+        ).ravel()
+        traces.append(
+            go.Scatter(
+                x=x,
+                y=y,
+                fill="toself",
+                mode="lines",
+                line_width=0,
+                fillcolor=pfam_colors[domain],
+                name=f"Pfam Accession: {domain} <br>Name: {acc_to_name[domain]}",
+                hoveron="fills",
+                hoverinfo="name",
+            )
+        )
+    return traces
 
-    if "Pfams" in metadata.columns:
-        # Choose color scheme for protein domains
-        protein_ys = {}
-
-        for node in range(0, len(nodes["x"])):
-            if nodes["text"][node]:
-                protein_ys[nodes["text"][node].split("<br>")[0]] = nodes["y"][node]
-
-        smallest_y_dist(protein_ys)
-
-        shapedata = {
-            "type": [],
-            "x0": [],
-            "y0": [],
-            "x1": [],
-            "y1": [],
-            "fillcolor": [],
-            "layer": [],
-            "line_width": [],
-        }
-
-        dom_hover_x = []
-        dom_hover_y = []
-        dom_hover_fill = []
-        dom_hover_text = []
-
-        # Build mapping of Pfam accs to domain name
-        dom_names = [
-            name
-            for arch in metadata["domain_names"].tolist()
-            for name in arch.split("~")
-        ]
-        dom_accs = [
-            name for arch in metadata["Pfams"].tolist() for name in arch.split("-")
+
+def webgl_traces(layout, text, color, domains=None, visible=None, collapsed=None):
+    """
+    Batched WebGL traces for the branches, nodes and domains of the visible nodes
+    :param layout: treeLayout
+    :param text: hover text array in node order
+    :param color: node color array in node order
+    :param domains: optional (rects, connectors, pfam_colors, acc_to_name) tuple
+    :param visible: optional mask of the nodes to draw
+    :param collapsed: optional mask of collapsed clade roots
+    :return: list of traces
+    """
+    tree, x_coords, y_coords = layout.tree, layout.x, layout.y
+    if visible is None:
+        visible = np.ones(len(tree), dtype=bool)
+        segments = layout.segments
+    else:
+        segments = branch_segments(x_coords, y_coords, tree, visible, collapsed)
+    shown = np.flatnonzero(visible)
+    traces = [
+        branch_trace(segments, "rgb(25,25,25)", line_width=1),
+        go.Scattergl(
+            x=x_coords[shown],
+            y=y_coords[shown],
+            mode="markers",
+            marker=dict(color=color[shown], size=9),
+            opacity=1.0,
+            text=text[shown],
+            hoverinfo="text",
+        ),
+    ]
+    if domains is not None:
+        proteins = None
+        if not visible.all():
+            proteins = {tree.names[node] for node in shown if tree.names[node]}
+        traces.extend(domain_traces(*domains, proteins=proteins))
+    return traces
+
+
+def clade_glyph_trace(tree, x_coords, y_coords, aggregates, collapsed):
+    """
+    Collapsed clades as triangles spanning from the clade root to its deepest leaf and
+    over the rows of its leaves, all in one filled trace
+    :return:
+    """
+    roots = np.flatnonzero(collapsed)
+    leaves = tree.leaves
+    size = aggregates["size"].to_numpy()[roots]
+    first_leaf = leaves[np.searchsorted(leaves, roots)]
+    last_leaf = leaves[np.searchsorted(leaves, roots + size - 1, side="right") - 1]
+    tip = x_coords[roots] + aggregates["height"].to_numpy()[roots]
+    gaps = np.full(len(roots), np.nan)
+    x = np.column_stack([x_coords[roots], tip, tip, x_coords[roots], gaps]).ravel()
+    y = np.column_stack(
+        [
+            y_coords[roots],
+            y_coords[first_leaf],
+            y_coords[last_leaf],
+            y_coords[roots],
+            gaps,
         ]
-        acc_to_name = dict(zip(dom_accs, dom_names))
+    ).ravel()
+    return go.Scatter(
+        x=x,
+        y=y,
+        fill="toself",
+        mode="lines",
+        line=dict(color="rgb(25,25,25)", width=1),
+        fillcolor="rgba(70,70,180,0.4)",
+        hoverinfo="skip",
+    )
+
+
+def clade_summaries(aggregates):
+    """Hover text of collapsed clades: leaf count, identity range and dominant architecture"""
+    return (
+        aggregates["leaves"].astype(str)
+        + " leaves<br>Identity: "
+        + aggregates["min_identity"].astype(str)
+        + " - "
+        + aggregates["max_identity"].astype(str)
+        + "<br>Architecture: "
+        + aggregates["architecture"].fillna("none").astype(str)
+    ).to_numpy(dtype=object)
 
-        # Dict with protein and its domains
-        pfams = _filter_dict(metadata, "Pfams")
-        pfams = {k: v.split("-") for k, v in pfams.items()}
 
-        # Get unique pfam domains in all hits
-        unique_domains = set(
-            [domain for domains in list(pfams.values()) for domain in domains]
+def collapsed_views(layout, text, color, aggregates, mode, thresholds, domains=None):
+    """
+    One set of traces per collapse threshold plus a dropdown to switch between them in
+    the browser. All levels share the layout and the aggregate table.
+    :return: list of traces, plotly updatemenus
+    """
+    tree, x_coords, y_coords = layout.tree, layout.x, layout.y
+    summaries = clade_summaries(aggregates)
+    traces = []
+    levels = []
+    for threshold in thresholds:
+        collapsed = collapsed_clades(tree, aggregates, mode, threshold)
+        visible = visible_nodes(aggregates, collapsed)
+        level_text = text.copy()
+        level_text[collapsed] = summaries[collapsed]
+        level_color = color.copy()
+        level_color[collapsed] = "rgb(70,70,180)"
+        level = webgl_traces(
+            layout,
+            level_text,
+            level_color,
+            domains=domains,
+            visible=visible,
+            collapsed=collapsed,
         )
+        level.append(clade_glyph_trace(tree, x_coords, y_coords, aggregates, collapsed))
+        levels.append((len(traces), len(traces) + len(level)))
+        traces.extend(level)
+
+    buttons = []
+    for threshold, (start, stop) in zip(thresholds, levels):
+        visibility = [start <= i < stop for i in range(len(traces))]
+        buttons.append(
+            dict(
+                label=f"collapse {mode} {threshold:g}",
+                method="update",
+                args=[{"visible": visibility}],
+            )
+        )
+    for i, trace in enumerate(traces):
+        trace.visible = buttons[0]["args"][0]["visible"][i]
+    updatemenus = [dict(buttons=buttons, direction="down", x=0, y=1.1)]
+    return traces, updatemenus if len(buttons) > 1 else []
 
-        baseline = domain_start(x_coords)
-        smallest_y = smallest_y_dist(protein_ys)
-        y_gap = smallest_y / 10
-        half_height = (smallest_y - y_gap) / 2
 
-        # domain section shouldnt take more than 1/3 of the plot size,
-        # assuming we dont find more than 10 domains for a normal protein
-        domain_width = (baseline / 3) / 10
-        x_gab = domain_width / 2
+def domain_layout(tree, x_coords, y_coords, metadata, query):
+    """
+    Geometry of the domain tracks next to the leaves
+    :return: rects and connectors as from domain_geometry() and {Pfam accession: name}
+    """
+    named = [node for node, name in enumerate(tree.names) if name]
+    protein_ys = dict(zip([tree.names[node] for node in named], y_coords[named]))
 
-        # dict with distinc color for each unique pfam
-        pfam_colors = domain_colors(unique_domains)
-
-        for protein in protein_ys.keys():
-            start = baseline
-            if protein == query:
-                pass
-            else:
-                # Draw domain by domain
-                for domain in pfams[protein]:
-                    # Draw shape
-                    x0 = start
-                    x1 = start + domain_width
-                    y0 = protein_ys[protein] - half_height
-                    y1 = protein_ys[protein] + half_height
-                    shapedata["type"].append("rect")
-                    shapedata["x0"].append(x0)
-                    shapedata["y0"].append(y0)
-                    shapedata["x1"].append(x1)
-                    shapedata["y1"].append(y1)
-                    shapedata["fillcolor"].append(pfam_colors[domain])
-                    shapedata["layer"].append("above")
-                    shapedata["line_width"].append(0)
-
-                    # Draw invisible glyph for hover info
-                    dom_hover_x.append([x0, x1, x1, x0, x0])
-                    dom_hover_y.append([y0, y0, y1, y1, y0])
-                    dom_hover_fill.append(pfam_colors[domain])
-                    dom_hover_text.append(
-                        f"<br>Pfam Accession: {domain} <br>Name: {acc_to_name[domain]}"
-                    )
+    # Dict with protein and its domains and mapping of Pfam accs to domain name
+    pfams, acc_to_name = domain_maps(metadata)
+
+    baseline = domain_start(x_coords)
+    smallest_y = smallest_y_dist(protein_ys)
+    y_gap = smallest_y / 10
+    half_height = (smallest_y - y_gap) / 2
+
+    # domain section shouldnt take more than 1/3 of the plot size,
+    # assuming we dont find more than 10 domains for a normal protein
+    domain_width = (baseline / 3) / 10
+    x_gab = domain_width / 2
 
-                    start = start + domain_width + x_gab
-                # Add a straight line to conncect domains
-                shapedata["type"].append("rect")
-                shapedata["x0"].append(baseline + x_gab)
-                shapedata["y0"].append(protein_ys[protein])
-                shapedata["x1"].append(start - (domain_width + x_gab))
-                shapedata["y1"].append(protein_ys[protein])
-                shapedata["fillcolor"].append("black")
-                shapedata["layer"].append("below")
-                shapedata["line_width"].append(5)  # Might need to be variable
-
-        domain_shapes = [
-            go.layout.Shape(
-                type=shapedata["type"][i],
-                x0=shapedata["x0"][i],
-                x1=shapedata["x1"][i],
-                y0=shapedata["y0"][i],
-                y1=shapedata["y1"][i],
-                fillcolor=shapedata["fillcolor"][i],
-                opacity=1,
-                layer=shapedata["layer"][i],
-                line_width=shapedata["line_width"][i],
+    rects, connectors = domain_geometry(
+        protein_ys, pfams, query, baseline, domain_width, x_gab, half_height
+    )
+    return rects, connectors, acc_to_name
+
+
+class treeLayout:
+    """
+    Everything of a tree_vis plot that only depends on the tree (and for the domain
+    tracks on the filter file): the tree arrays, node coordinates, branch segments and
+    domain track geometry. It is cached in a compressed sidecar next to the tree, keyed on
+    the content of the tree and filter files, so later runs only recompute colors and
+    highlight masks.
+    """
+
+    _tree_arrays = ["parent", "first_child", "next_sibling", "branch_length"]
+    _rect_columns = ["x0", "x1", "y0", "y1", "domain", "protein"]
+    _connector_columns = ["x0", "x1", "y", "protein"]
+
+    def __init__(self, tree, x, y, segments, digest="", domains=None, filter_digest=""):
+        self.tree = tree
+        self.x = x
+        self.y = y
+        self.segments = segments
+        self.digest = digest
+        self.domains = domains
+        self.filter_digest = filter_digest
+
+    @classmethod
+    def compute(cls, tree_file, digest=""):
+        tree = arrayTree.read(tree_file)
+        x_coords = get_x_coordinates(tree)
+        y_coords = get_y_coordinates(tree)
+        segments = branch_segments(x_coords, y_coords, tree)
+        return cls(tree, x_coords, y_coords, segments, digest=digest)
+
+    @staticmethod
+    def cache_file(tree_file: Union[Path, str]) -> Path:
+        tree_file = Path(tree_file)
+        return tree_file.with_name(tree_file.name + ".layout.npz")
+
+    @classmethod
+    def load(
+        cls, tree_file, filter_file=None, metadata=None, query=None, filter_digest=None
+    ):
+        """
+        Load the layout from its sidecar, or compute and save it. Domain tracks are only
+        (re)computed if a filter file with Pfams is given and differs from the cached one.
+        :param tree_file: Path to newick tree
+        :param filter_file: Path to domain filter output, None for no domain tracks
+        :param metadata: the parsed filter file with dom_acc column
+        :param query: name of the query, which gets no domain track
+        :param filter_digest: digest of metadata when it has no filter file, see
+        frame_digest()
+        :return:
+        """
+        cache = cls.cache_file(tree_file)
+        digest = file_digest(tree_file)
+        layout = None
+        if cache.is_file():
+            with np.load(cache) as data:
+                if str(data["digest"]) == digest:
+                    layout = cls._from_npz(data)
+        changed = layout is None
+        if changed:
+            with stage("tree layout"):
+                layout = cls.compute(tree_file, digest=digest)
+
+        if filter_file is not None:
+            filter_digest = file_digest(filter_file)
+        if filter_digest is not None:
+            if layout.domains is None or layout.filter_digest != filter_digest:
+                with stage("domain layout"):
+                    layout.domains = domain_layout(
+                        layout.tree, layout.x, layout.y, metadata, query
+                    )
+                layout.filter_digest = filter_digest
+                changed = True
+        if changed:
+            with stage("layout cache write"):
+                layout.save(cache)
+        return layout
+
+    @classmethod
+    def _from_npz(cls, data):
+        names = [name if name else None for name in data["names"].tolist()]
+        tree = arrayTree(*[data[array] for array in cls._tree_arrays], names)
+        domains = None
+        if str(data["filter_digest"]):
+            rects = {
+                column: data[f"rect_{column}"].tolist() for column in cls._rect_columns
+            }
+            connectors = {
+                column: data[f"connector_{column}"].tolist()
+                for column in cls._connector_columns
+            }
+            acc_to_name = dict(
+                zip(data["pfam_accessions"].tolist(), data["pfam_names"].tolist())
             )
-            for i in range(len(shapedata["x0"]))
-        ]
-        shapes = line_shapes + domain_shapes
+            domains = (rects, connectors, acc_to_name)
+        return cls(
+            tree,
+            data["x"],
+            data["y"],
+            (data["segments_x"], data["segments_y"]),
+            digest=str(data["digest"]),
+            domains=domains,
+            filter_digest=str(data["filter_digest"]),
+        )
 
-        dom_hover_data = dict(
-            type="scatter",
-            fill="toself",
-            x=dom_hover_x,
-            y=dom_hover_y,
-            mode="lines",
-            name="",
-            opacity=1,
-            fillcolor=dom_hover_fill,
-            text=dom_hover_text,
-            hoverinfo="text",
+    def save(self, file: Union[Path, str]) -> None:
+        arrays = {array: getattr(self.tree, array) for array in self._tree_arrays}
+        arrays["names"] = np.array([name or "" for name in self.tree.names], dtype=str)
+        arrays.update(
+            x=self.x,
+            y=self.y,
+            segments_x=self.segments[0],
+            segments_y=self.segments[1],
+            digest=np.array(self.digest),
+            filter_digest=np.array(self.filter_digest if self.domains else ""),
         )
+        if self.domains is not None:
+            rects, connectors, acc_to_name = self.domains
+            for column in self._rect_columns:
+                arrays[f"rect_{column}"] = np.array(rects[column])
+            for column in self._connector_columns:
+                arrays[f"connector_{column}"] = np.array(connectors[column])
+            arrays["pfam_accessions"] = np.array(list(acc_to_name.keys()), dtype=str)
+            arrays["pfam_names"] = np.array(list(acc_to_name.values()), dtype=str)
+        with open(file, "wb") as fout:
+            np.savez_compressed(fout, **arrays)
+
+
+def plot_tree(args, metadata=None):
+    """
+    :param args: tree_vis arguments
+    :param metadata: filter output already in memory, read from args.filter if not given
+    """
+    with stage("read metadata"):
+        if metadata is None:
+            metadata = read_table(args.filter)
+            filter_digest = None
+        else:
+            filter_digest = frame_digest(metadata)
+        metadata["dom_acc"] = dom_accessions(metadata)
+        query = metadata["query_name"].iloc[0]
+
+    has_domains = "Pfams" in metadata.columns
+    with stage("layout"):
+        tree_layout = treeLayout.load(
+            args.tree,
+            filter_file=args.filter if has_domains and filter_digest is None else None,
+            metadata=metadata,
+            query=query,
+            filter_digest=filter_digest if has_domains else None,
+        )
+    tree = tree_layout.tree
 
-    else:
-        shapes = line_shapes
+    with stage("highlight"):
+        minimum = 0 if args.min is None else args.min
+        maximum = math.inf if args.max is None else args.max
+
+        if args.param is not None:
+            # if parameter is specified find proteins that match filter for parameter
+            of_interest = _in_thresholds(
+                metadata["dom_acc"], metadata[args.param], minimum, maximum
+            )
+        elif args.reference is not None:
+            # distance to a chosen reference sequence, answered by the cached lca index
+            index = lcaIndex.load(args.tree)
+            names, reference_distances = index.distances_from(args.reference)
+            of_interest = _in_thresholds(names, reference_distances, minimum, maximum)
+        else:
+            # if no parameter is given take the tree distance
+            names, query_distances = distances(tree, query)
+            of_interest = _in_thresholds(names, query_distances, minimum, maximum)
+
+        if args.clade is not None:
+            # only highlight leaves inside the smallest clade containing all given sequences
+            index = lcaIndex.load(args.tree)
+            of_interest &= set(index.clade_members(args.clade))
+
+    x_coords = tree_layout.x
+    y_coords = tree_layout.y
+
+    # text to be displayed on hover over nodes and node colors
+    with stage("annotate"):
+        text, color = annotate_nodes(tree.names, metadata, of_interest, query)
+
+    domains = None
+    if has_domains:
+        rects, connectors, acc_to_name = tree_layout.domains
+        # dict with distinc color for each unique pfam
+        pfam_colors = domain_colors(rects["domain"])
+        domains = (rects, connectors, pfam_colors, acc_to_name)
+
+    with stage("traces"):
+        shapes = []
+        updatemenus = []
+        if args.collapse is not None:
+            # level of detail views, only available with batched WebGL traces
+            aggregates = clade_aggregates(tree, metadata)
+            traces, updatemenus = collapsed_views(
+                tree_layout,
+                np.array(text, dtype=object),
+                color,
+                aggregates,
+                args.collapse,
+                args.collapse_threshold,
+                domains=domains,
+            )
+        elif args.webgl:
+            traces = webgl_traces(
+                tree_layout,
+                np.array(text, dtype=object),
+                color,
+                domains=domains,
+            )
+        else:
+            line_shapes = []
+            draw_clade(
+                x_coords,
+                y_coords,
+                tree,
+                line_shapes,
+                line_color="rgb(25,25,25)",
+                line_width=1,
+            )
+            nodes = dict(
+                type="scatter",
+                x=x_coords.tolist(),
+                y=y_coords.tolist(),
+                mode="markers",
+                marker=dict(color=color.tolist(), size=9),
+                opacity=1.0,
+                text=text,
+                hoverinfo="text",
+            )
+            traces = [nodes]
+            shapes = line_shapes
+            if domains is not None:
+                rects, connectors, pfam_colors, acc_to_name = domains
+                shapes = shapes + domain_shapes(rects, connectors, pfam_colors)
+                traces.extend(domain_hover_traces(rects, pfam_colors, acc_to_name))
 
     layout = dict(
         title=f"Phylogeny of {query} against MGnify proteins",
@@ -413,22 +794,8 @@ def plot_tree(args):
         plot_bgcolor="rgb(250,250,250)",
         margin=dict(l=10),
         shapes=shapes,  # lines for tree branches
+        updatemenus=updatemenus,
     )
-    f = go.Figure(data=[nodes], layout=layout)
-
-    if "Pfams" in metadata.columns:
-        for i in range(len(dom_hover_data["text"])):
-            f.add_trace(
-                go.Scatter(
-                    x=dom_hover_data["x"][i],
-                    y=dom_hover_data["y"][i],
-                    fill="toself",
-                    mode="lines",
-                    name="",
-                    text=dom_hover_data["text"][i],
-                    opacity=0,
-                    fillcolor=dom_hover_data["fillcolor"][i],
-                )
-            )
-
-    f.write_html("tree_vis.html")
+    with stage("write html"):
+        f = go.Figure(data=traces, layout=layout)
+        f.write_html(args.output)
@@ -1,11 +1,20 @@
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Callable, List, Optional, Union
 
+import numpy as np
 import pandas as pd
+from Bio import Phylo
+from Bio.Phylo.Newick import Clade
+
+from mgyminer.annotation import DOM_ACCESSION_COLUMNS, dom_accessions
+from mgyminer.profiling import stage
+from mgyminer.scheduler import coreScheduler
+from mgyminer.tables import read_table
 
 
 class runner:
@@ -51,27 +60,25 @@ class runner:
 
     def _run(self, command: List, stdout_file: Optional[Path] = None, **kwargs) -> bool:
         """Help function for run(). Distinguishes between tools that natively give output to stdout and
-        tools that give output piles per default
+        tools that give output piles per default. Raises RuntimeError if the program fails,
+        so that the steps depending on its output do not run.
         """
-        if stdout_file:
-            try:
-                with open(stdout_file, "w") as fout:
-                    subprocess.run(command, stdout=fout, check=True, **kwargs)
-                return True
-            except subprocess.CalledProcessError as e:
-                print(f"an error occurred while executing {self.program}")
-                print(e.output)
-                return False
-        else:
-            # Capture program stdout in debug mode, else discard
-            print_stdout = subprocess.DEVNULL if self.verbose is False else None
+        # timed as a stage named after the program, e.g. hmmalign
+        with stage(Path(str(command[0])).name):
             try:
-                subprocess.run(command, check=True, stdout=print_stdout, **kwargs)
-                return True
+                if stdout_file:
+                    with open(stdout_file, "w") as fout:
+                        subprocess.run(command, stdout=fout, check=True, **kwargs)
+                else:
+                    # Capture program stdout in debug mode, else discard
+                    print_stdout = subprocess.DEVNULL if self.verbose is False else None
+                    subprocess.run(command, check=True, stdout=print_stdout, **kwargs)
             except subprocess.CalledProcessError as e:
-                print(f"an error occurred while executing {self.program}")
-                print(e.output)
-                return False
+                raise RuntimeError(
+                    f"an error occurred while executing {self.program} "
+                    f"(exit status {e.returncode})"
+                ) from e
+        return True
 
 
 class esl_sfetcher(runner):
@@ -119,10 +126,11 @@ class hmmbuilder(runner):
         :param single_seq: flag to activate single sequence mode, default=True
         :return:
         """
-        args = args.append("--singlemx") if args is not None else ["--singlemx"]
+        args = list(args) if args is not None else []
+        if single_seq:
+            args.append("--singlemx")
         command = [self.program]
-        if args is not None:
-            command.extend(args)
+        command.extend(args)
         command.extend([hmmfile, msafile])
         return self._run(command)
 
@@ -157,7 +165,7 @@ class hmmaligner(runner):
         if args is not None:
             command.extend(args)
         command.extend([hmmfile, seqfile])
-        self._run(command)
+        return self._run(command)
 
 
 class esl_reformater(runner):
@@ -186,7 +194,7 @@ class esl_reformater(runner):
         if args is not None:
             command.extend(args)
         command.extend([format, seqfile])
-        self._run(command)
+        return self._run(command)
 
 
 class fastTree(runner):
@@ -200,8 +208,8 @@ class fastTree(runner):
         args: Optional[List] = None,
         threads: int = 3,
     ):
-        env_vars = os.environ
-        env_vars["OMP_NUM_THREADS"] = str(threads)
+        # Copy the environment so concurrent runs can use different thread counts
+        env_vars = dict(os.environ, OMP_NUM_THREADS=str(threads))
 
         command = [self.program, "-out", outfile]
         if args is not None:
@@ -211,55 +219,260 @@ class fastTree(runner):
 
 
 class treebuilder:
-    def __init__(self, args) -> None:
-        self.inputfile = args.input
+    def __init__(
+        self,
+        inputfile: Path,
+        query: Path,
+        tree: Optional[Path] = None,
+        alignment: Optional[Path] = None,
+        hits: Optional[pd.DataFrame] = None,
+    ) -> None:
+        """
+        :param inputfile: Path to filter output with the hits
+        :param query: Path to query sequence
+        :param tree: Path of the tree, next to inputfile by default
+        :param alignment: Path of the alignment, next to inputfile by default
+        :param hits: filter output already in memory, read from inputfile if not given
+        """
+        self.inputfile = inputfile
+        self.hits = hits
         self.fetcher = esl_sfetcher()
         self.aligner = hmmaligner()
         self.hmmbuilder = hmmbuilder()
-        self.query = args.query
+        self.reformater = esl_reformater()
+        self.query = query
         self.tree = (
-            args.output
-            if args.output
-            else Path(str(args.input).replace(args.input.suffix, ".tree"))
+            tree if tree else Path(str(inputfile).replace(inputfile.suffix, ".tree"))
         )
         self.alignment = (
-            args.alignment
-            if args.alignment
-            else Path(str(args.input).replace(args.input.suffix, ".afa"))
+            alignment
+            if alignment
+            else Path(str(inputfile).replace(inputfile.suffix, ".afa"))
+        )
+        # Stockholm copy of the alignment. Keeps the reference annotation that
+        # incremental updates need to map new sequences onto the existing columns
+        self.stockholm = self.alignment.with_suffix(".sto")
+
+    def _read_hits(self) -> pd.DataFrame:
+        if self.hits is not None:
+            return self.hits[DOM_ACCESSION_COLUMNS].copy()
+        return read_table(self.inputfile, columns=DOM_ACCESSION_COLUMNS)
+
+    def _fetch_sequences(self, seq_df: pd.DataFrame, keyfile: Path, sequences: Path):
+        seq_df["dom_acc"] = dom_accessions(seq_df)
+        seq_df[["dom_acc", "env_from", "env_to", "target_name"]].to_csv(
+            keyfile, index=False, header=False, sep=" "
         )
+        self.fetcher.run("testSeqDB.fa", keyfile, sequences, args=["-Cf"])
 
-    def make_alignment(self: Union[Path, str]) -> Path:
+    def make_alignment(self: Union[Path, str], threads: int = 1) -> Path:
         with tempfile.TemporaryDirectory() as tmpdir:
             keyfile = Path(tmpdir) / "keyfile"
             sequences = Path(tmpdir) / "sequences"
             hmm = Path(tmpdir) / "hmm"
-            seq_df = pd.read_csv(self.inputfile)
-
-            def _idpluscoords(row):
-                if row["ndom"] > 1:
-                    domain = "_" + str(row["ndom"])
-                else:
-                    domain = ""
-                return f"{row['target_name']}{domain}/{row['env_from']}-{row['env_to']}"
-
-            seq_df["dom_acc"] = seq_df.apply(lambda row: _idpluscoords(row), axis=1)
-            seq_df[["dom_acc", "env_from", "env_to", "target_name"]].to_csv(
-                keyfile, index=False, header=False, sep=" "
-            )
-            self.fetcher.run("testSeqDB.fa", keyfile, sequences, args=["-Cf"])
-            self.hmmbuilder.run(hmm, self.query)
+            with stage("read hits"):
+                seq_df = self._read_hits()
+            self._fetch_sequences(seq_df, keyfile, sequences)
+            self.hmmbuilder.run(hmm, self.query, args=["--cpu", str(threads)])
             # Append query sequence to the alignment to add it to the tree
             with open(sequences, "at") as fout, open(self.query, "rt") as fin:
                 fout.write(fin.read())
-            self.aligner.run(hmm, self.alignment, sequences, outformat="afa")
+            self.aligner.run(hmm, self.stockholm, sequences, outformat="stockholm")
+            self.reformater.run(self.stockholm, self.alignment, "afa")
+
+    def update_alignment(self, threads: int = 1) -> List[str]:
+        """
+        Align the hits that are not yet part of the existing alignment and merge them into it.
+        The profile is built from the existing alignment with its reference columns (--hand),
+        so hmmalign --mapali can keep the previously aligned sequences untouched.
+        :return: names of the newly aligned sequences
+        """
+        existing = set(read_fasta(self.alignment).keys())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            keyfile = Path(tmpdir) / "keyfile"
+            sequences = Path(tmpdir) / "sequences"
+            hmm = Path(tmpdir) / "hmm"
+            updated = Path(tmpdir) / "updated.sto"
+            with stage("read hits"):
+                seq_df = self._read_hits()
+            self._fetch_sequences(seq_df, keyfile, sequences)
+            new_seqs = {
+                name: seq
+                for name, seq in read_fasta(sequences).items()
+                if name not in existing
+            }
+            if not new_seqs:
+                return []
+            with open(sequences, "wt") as fout:
+                for name, seq in new_seqs.items():
+                    fout.write(f">{name}\n{seq}\n")
+            self.hmmbuilder.run(
+                hmm,
+                self.stockholm,
+                args=["--hand", "--cpu", str(threads)],
+                single_seq=False,
+            )
+            self.aligner.run(
+                hmm,
+                updated,
+                sequences,
+                outformat="stockholm",
+                args=["--mapali", self.stockholm],
+            )
+            shutil.move(updated, self.stockholm)
+            self.reformater.run(self.stockholm, self.alignment, "afa")
+        return list(new_seqs.keys())
 
-    def build_tree(self) -> Path:
+    def build_tree(self, threads: int = 3) -> Path:
         ft = fastTree()
         print(self.alignment, self.tree)
-        ft.run(self.alignment, self.tree)
+        ft.run(self.alignment, self.tree, threads=threads)
+
+    def update_tree(self, new_sequences: List[str], threads: int = 3) -> Path:
+        """
+        Place the new sequences next to their closest relative in the existing tree and use
+        the result as starting tree for FastTree, which then only refines the topology.
+        :param new_sequences: names of the sequences that are missing from the existing tree
+        """
+        ft = fastTree()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            start_tree = Path(tmpdir) / "start.tree"
+            with stage("placement"):
+                place_sequences(self.tree, self.alignment, new_sequences, start_tree)
+            ft.run(
+                self.alignment, self.tree, args=["-intree", start_tree], threads=threads
+            )
+
+
+def read_fasta(file: Union[Path, str]) -> dict:
+    """
+    Read a (aligned) FASTA file into a {name: sequence} dictionary
+    :param file: Path to FASTA file
+    :return:
+    """
+    sequences = {}
+    name = None
+    with open(file, "rt") as fin:
+        for line in fin:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                sequences[name] = []
+            elif name is not None:
+                sequences[name].append(line)
+    return {name: "".join(seq) for name, seq in sequences.items()}
+
+
+def place_sequences(
+    tree_file: Union[Path, str],
+    alignment_file: Union[Path, str],
+    new_sequences: List[str],
+    outfile: Union[Path, str],
+    chunksize: int = 2048,
+):
+    """
+    Attach each new sequence as sister of the leaf with the smallest p-distance over the
+    aligned columns both sequences cover. Placed sequences become leaves the following
+    ones can be placed next to, so closely related new sequences end up together.
+    :param tree_file: Path to existing newick tree
+    :param alignment_file: Path to aligned FASTA containing the old and new sequences
+    :param new_sequences: names of the sequences to place
+    :param outfile: Path to output newick tree
+    :param chunksize: number of leaves compared at once
+    :return:
+    """
+    tree = Phylo.read(tree_file, "newick")
+    alignment = read_fasta(alignment_file)
+    leaves = {leaf.name: leaf for leaf in tree.get_terminals()}
+    names = [name for name in leaves if name in alignment]
+
+    def encoded(name):
+        return np.frombuffer(alignment[name].upper().encode(), dtype=np.uint8)
+
+    # rows for the new sequences are filled as they are placed
+    reference = np.empty(
+        (len(names) + len(new_sequences), len(alignment[names[0]])), dtype=np.uint8
+    )
+    for row, name in enumerate(names):
+        reference[row] = encoded(name)
+    gap = np.frombuffer(b"-", dtype=np.uint8)[0]
+    reference_gaps = reference == gap
+
+    for new in new_sequences:
+        seq = encoded(new)
+        distances = np.empty(len(names))
+        for start in range(0, len(names), chunksize):
+            stop = min(start + chunksize, len(names))
+            block = reference[start:stop]
+            covered = ~(reference_gaps[start:stop] | (seq == gap))
+            mismatches = ((block != seq) & covered).sum(axis=1)
+            distances[start:stop] = mismatches / np.maximum(covered.sum(axis=1), 1)
+        closest = int(np.argmin(distances))
+        leaf = leaves[names[closest]]
+        half = distances[closest] / 2
+        leaf.clades = [
+            Clade(branch_length=half, name=leaf.name),
+            Clade(branch_length=half, name=new),
+        ]
+        leaf.name = None
+        leaves[names[closest]] = leaf.clades[0]
+        leaves[new] = leaf.clades[1]
+        reference[len(names)] = seq
+        reference_gaps[len(names)] = seq == gap
+        names.append(new)
+    Phylo.write(tree, outfile, "newick")
+
+
+def _tree_job(t: treebuilder, update: bool, tree_threads: int) -> Callable:
+    """
+    Wrap alignment and tree inference of one input into a job for the core scheduler.
+    hmmbuild/hmmalign run on a single core, FastTree gets tree_threads cores.
+    """
+
+    def job(stage):
+        if update and t.tree.is_file() and t.stockholm.is_file():
+            with stage("alignment update", 1) as threads:
+                new_sequences = t.update_alignment(threads)
+            if not new_sequences:
+                print(f"No new sequences for {t.tree}")
+                return
+            with stage(
+                f"placing {len(new_sequences)} new sequences", tree_threads
+            ) as threads:
+                t.update_tree(new_sequences, threads)
+            return
+        if update:
+            print(
+                f"No existing alignment/tree for {t.inputfile}, building from scratch"
+            )
+        with stage("alignment", 1) as threads:
+            t.make_alignment(threads)
+        with stage("tree", tree_threads) as threads:
+            t.build_tree(threads)
+
+    return job
 
 
 def build_tree(args):
-    t = treebuilder(args)
-    t.make_alignment()
-    t.build_tree()
+    inputs = args.input
+    queries = args.query
+    if len(queries) not in (1, len(inputs)):
+        raise ValueError("Give either one query or one query per input file")
+    if len(inputs) > 1 and (args.output or args.alignment):
+        raise ValueError(
+            "--output and --alignment can only be used with a single input file"
+        )
+    if len(queries) == 1:
+        queries = queries * len(inputs)
+
+    scheduler = coreScheduler(args.threads)
+    tree_threads = max(1, scheduler.cores // len(inputs))
+    jobs = {}
+    for inputfile, query in zip(inputs, queries):
+        t = treebuilder(inputfile, query, tree=args.output, alignment=args.alignment)
+        jobs[str(inputfile)] = _tree_job(t, args.update, tree_threads)
+    results = scheduler.run(jobs)
+    failed = [name for name, success in results.items() if not success]
+    if failed:
+        # the other inputs are finished, the command still fails for scripted batches
+        raise RuntimeError(f"Tree building failed for: {', '.join(failed)}")
@@ -0,0 +1,258 @@
+import time
+from argparse import Namespace
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+import yaml
+
+from mgyminer.filter import (
+    alignment_table,
+    domain_hits,
+    filter_hits,
+    load_search,
+    residue_hits,
+)
+from mgyminer.phmmer import phmmer
+from mgyminer.phylplot import plot_tree
+from mgyminer.phyltree import _tree_job, treebuilder
+from mgyminer.profiling import stage as timed_stage
+from mgyminer.scheduler import coreScheduler
+from mgyminer.tables import FORMAT_SUFFIXES, compact_table, write_table
+
+PIPELINE_STAGES = ["phmmer", "filter", "residue", "domain", "tree", "tree_vis"]
+# stages whose hit table can be written with write
+HIT_STAGES = ["filter", "residue", "domain"]
+
+# options of the stages that are not required, with the defaults of the subcommands
+STAGE_DEFAULTS = {
+    "phmmer": {},
+    "filter": {
+        "eval": None,
+        "coverage": None,
+        "sort": None,
+        "top": None,
+        "where": None,
+    },
+    "residue": {"residue": []},
+    "domain": {
+        "arch": [],
+        "strict": False,
+        "exclude": [],
+        "strategy": "auto",
+        "sqlite": None,
+        "local_index": None,
+        "db_metrics": False,
+    },
+    "tree": {"threads": 3, "update": False},
+    "tree_vis": {
+        "min": None,
+        "max": None,
+        "param": None,
+        "reference": None,
+        "clade": None,
+        "webgl": False,
+        "collapse": None,
+        "collapse_threshold": [10],
+        "output": "tree_vis.html",
+    },
+}
+
+EXAMPLE_CONFIG = """\
+# paths are relative to this file
+query: query.fasta
+target: mgnify_proteins.fasta   # only needed for the phmmer stage
+output: results                 # directory for all artifacts
+# search: results/phmmer.out    # existing search output, replaces the phmmer stage
+write: [filter, domain]         # stage results saved as <stage>.csv in output
+output_format: csv              # or parquet / arrow for <stage>.parquet / .arrow
+compact: false                  # categorical/int32/float32 hit table, see --compact
+stages:
+  phmmer: {}
+  filter: {eval: 0.001, coverage: "50-100", sort: [identity]}
+  residue: {residue: [[155, include, D, E]]}
+  domain: {arch: [PF00001], strict: false}
+  tree: {threads: 4}
+  tree_vis: {webgl: true, output: tree_vis.html}
+"""
+
+
+def load_config(file: Union[Path, str]) -> dict:
+    """
+    Read and validate a pipeline config, see EXAMPLE_CONFIG. Relative paths are
+    resolved against the directory of the config file.
+    :param file: Path to YAML config
+    :return:
+    """
+    file = Path(file)
+    with open(file) as configfile:
+        config = yaml.load(configfile, Loader=yaml.CSafeLoader) or {}
+    stages = config.get("stages") or {}
+    unknown = [stage for stage in stages if stage not in PIPELINE_STAGES]
+    if unknown:
+        raise ValueError(
+            f"Unknown pipeline stage(s) {unknown}. Expected some of: {PIPELINE_STAGES}"
+        )
+    for stage, options in stages.items():
+        options = options or {}
+        invalid = [option for option in options if option not in STAGE_DEFAULTS[stage]]
+        if invalid:
+            raise ValueError(f"Unknown option(s) {invalid} for stage {stage}")
+        stages[stage] = {**STAGE_DEFAULTS[stage], **options}
+    config["stages"] = stages
+    unknown = [
+        stage
+        for stage in config.get("write", [])
+        if stage not in stages or stage not in HIT_STAGES
+    ]
+    if unknown:
+        raise ValueError(
+            f"write lists stage(s) {unknown} that are not configured or produce no "
+            f"hit table. Expected some of: {HIT_STAGES}"
+        )
+
+    output_format = config.setdefault("output_format", "csv")
+    if output_format not in FORMAT_SUFFIXES:
+        raise ValueError(
+            f"Invalid output_format {output_format}. Expected one of: "
+            f"{list(FORMAT_SUFFIXES)}"
+        )
+
+    root = file.parent
+    for key in ["query", "target", "search"]:
+        if config.get(key) is not None:
+            config[key] = root / config[key]
+    config["output"] = root / config.get("output", ".")
+    for option in ["sqlite", "local_index"]:
+        if stages.get("domain", {}).get(option) is not None:
+            stages["domain"][option] = root / stages["domain"][option]
+    if "tree_vis" in stages:
+        stages["tree_vis"]["output"] = config["output"] / stages["tree_vis"]["output"]
+    return config
+
+
+class searchPipeline:
+    """
+    Runs the configured stages of phmmer -> filter -> residue -> domain -> tree ->
+    tree_vis in one process. The hit table and the alignments stay in memory between
+    the stages, only the artifacts of the external tools (search output, alignment,
+    tree, HTML) and the stage results listed under write are written to the output
+    directory.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.stages = config["stages"]
+        self.output = Path(config["output"])
+        self.search = config.get("search")
+        self.hits: Optional[pd.DataFrame] = None
+        self.alignment_dict = None
+        self.alignment_table = None
+        self.tree = None
+        self.timings = {}
+
+    def run(self) -> pd.DataFrame:
+        """
+        Run all configured stages
+        :return: the hit table after the last stage that produces one
+        """
+        self.output.mkdir(parents=True, exist_ok=True)
+        if "phmmer" not in self.stages and self.search is None:
+            raise ValueError("Configure either the phmmer stage or a search output")
+        for stage in PIPELINE_STAGES:
+            if stage not in self.stages:
+                continue
+            start = time.perf_counter()
+            with timed_stage(stage):
+                getattr(self, f"_{stage}")(Namespace(**self.stages[stage]))
+            self.timings[stage] = time.perf_counter() - start
+            if self.config.get("compact") and self.hits is not None:
+                # keeps the columns added by the stage (e.g. Pfams) compact as well
+                self.hits = compact_table(self.hits)
+            rows = "" if self.hits is None else f", {len(self.hits)} hits"
+            print(f"[pipeline] {stage} finished after {self.timings[stage]:.2f}s{rows}")
+            if stage in self.config.get("write", []):
+                fmt = self.config.get("output_format", "csv")
+                file = self.output / f"{stage}{FORMAT_SUFFIXES[fmt]}"
+                write_table(self.hits, file, fmt)
+        return self.hits
+
+    def _load_search(self) -> None:
+        if self.alignment_dict is None:
+            dom_tbl, self.alignment_dict = load_search(
+                self.search, self.config.get("compact", False)
+            )
+            self.alignment_table = alignment_table(self.alignment_dict)
+            self.hits = dom_tbl
+
+    def _phmmer(self, options: Namespace) -> None:
+        self.search = self.output / "phmmer.out"
+        phmmer(
+            Namespace(
+                query=self.config["query"],
+                target=self.config["target"],
+                output=self.search,
+            )
+        )
+
+    def _filter(self, options: Namespace) -> None:
+        self._load_search()
+        self.hits = filter_hits(
+            self.hits,
+            self.alignment_dict,
+            options.eval,
+            options.coverage,
+            options.sort,
+            table=self.alignment_table,
+            top=options.top,
+            sort_cache=self.search,
+            where=options.where,
+        )
+
+    def _residue(self, options: Namespace) -> None:
+        self._load_search()
+        self.hits = residue_hits(
+            self.hits, self.alignment_dict, options.residue, self.alignment_table
+        )
+
+    def _domain(self, options: Namespace) -> None:
+        self._load_search()
+        self.hits = domain_hits(
+            self.hits,
+            options.arch,
+            options.strict,
+            exclude=options.exclude,
+            strategy=options.strategy,
+            sqlite=options.sqlite,
+            local_index=options.local_index,
+            db_metrics=options.db_metrics,
+        )
+
+    def _tree(self, options: Namespace) -> None:
+        self._load_search()
+        self.tree = self.output / "tree.nwk"
+        t = treebuilder(
+            None,
+            self.config["query"],
+            tree=self.tree,
+            alignment=self.output / "alignment.afa",
+            hits=self.hits,
+        )
+        scheduler = coreScheduler(options.threads)
+        results = scheduler.run({"tree": _tree_job(t, options.update, options.threads)})
+        if not results["tree"]:
+            raise RuntimeError("Tree building failed")
+
+    def _tree_vis(self, options: Namespace) -> None:
+        self._load_search()
+        tree = self.tree if self.tree is not None else self.output / "tree.nwk"
+        plot_tree(Namespace(tree=tree, filter=None, **vars(options)), self.hits.copy())
+
+
+def run_pipeline(args):
+    if args.example:
+        print(EXAMPLE_CONFIG, end="")
+        return
+    if args.config is None:
+        raise ValueError("--config is required unless --example is given")
+    searchPipeline(load_config(args.config)).run()
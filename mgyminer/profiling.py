@@ -0,0 +1,179 @@
+import cProfile
+import io
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Union
+
+PROFILERS = ["cprofile", "sample"]
+
+
+class stageTimer:
+    """
+    Process wide wall clock timers of named stages (parse, coverage, sort, ...). Stages
+    opened inside another stage of the same thread are recorded as "outer/inner", so the
+    breakdown shows where the time of a stage went. Timing a stage costs two
+    perf_counter() calls, the timers are always on and only printed on request.
+    """
+
+    def __init__(self) -> None:
+        self.timings = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(name)
+        label = "/".join(stack)
+        with self._lock:
+            # listed in the order the stages are entered, outer before inner ones
+            self.timings[label]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.timings[label]["calls"] += 1
+                self.timings[label]["seconds"] += elapsed
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timings.clear()
+            self.start = time.perf_counter()
+
+    def report(self) -> str:
+        """Stage breakdown in the order the stages were first entered"""
+        total = time.perf_counter() - self.start
+        lines = [f"{'stage':<40}{'calls':>7}{'seconds':>10}{'%':>7}"]
+        for label, timing in list(self.timings.items()):
+            depth = label.count("/")
+            name = "  " * depth + label.rpartition("/")[2]
+            lines.append(
+                f"{name:<40}{timing['calls']:>7}{timing['seconds']:>10.3f}"
+                f"{100 * timing['seconds'] / total:>7.1f}"
+            )
+        lines.append(f"{'total':<40}{'':>7}{total:>10.3f}{100:>7.1f}")
+        return "\n".join(lines)
+
+
+timer = stageTimer()
+
+
+def stage(name: str):
+    """
+    Time a block as a named stage of the running command
+    :param name: stage name, e.g. "parse"
+    :return: context manager
+    """
+    return timer.stage(name)
+
+
+class stackSampler:
+    """
+    Sampling profiler: a background thread records the Python stack of every thread at a
+    fixed interval. Unlike cProfile it covers all threads (e.g. the scheduler's tree
+    jobs) and adds almost no overhead to the profiled code. Samples are saved as
+    collapsed stacks ("outer;inner;leaf count" lines), which flamegraph.pl, speedscope
+    and similar tools read.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({Path(code.co_filename).name}:"
+                        f"{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, file: Union[Path, str]) -> None:
+        with open(file, "w") as fout:
+            for stack, count in self.samples.most_common():
+                fout.write(f"{stack} {count}\n")
+
+    def report(self, limit: int = 15) -> str:
+        """Functions with the most samples on top of the stack"""
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rpartition(";")[2]] += count
+        total = max(sum(leaves.values()), 1)
+        lines = [f"{'samples':>8}{'%':>7}  function"]
+        for function, count in leaves.most_common(limit):
+            lines.append(f"{count:>8}{100 * count / total:>7.1f}  {function}")
+        return "\n".join(lines)
+
+
+def default_output(command: str, profiler: str) -> Path:
+    return Path(f"mgyminer_{command}.{'prof' if profiler == 'cprofile' else 'folded'}")
+
+
+@contextmanager
+def profiled(command: str, profiler: str, output: Optional[Union[Path, str]] = None):
+    """
+    Profile a command run, then print the stage breakdown and the hottest functions to
+    stderr and save the raw profile
+    :param command: subcommand name, used for the default output file
+    :param profiler: cprofile (deterministic, the calling thread only; open the saved
+    file with pstats or snakeviz) or sample (stackSampler, all threads)
+    :param output: file for the raw profile, mgyminer_<command>.prof/.folded by default
+    :return:
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(f"Invalid profiler. Expected one of: {PROFILERS}")
+    output = default_output(command, profiler) if output is None else Path(output)
+    timer.reset()
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+    else:
+        profile = stackSampler()
+        profile.start()
+    try:
+        yield
+    finally:
+        if profiler == "cprofile":
+            # only needed for the report, kept out of the CLI startup (see bench_cli_startup)
+            import pstats
+
+            profile.disable()
+            profile.dump_stats(output)
+            summary = io.StringIO()
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats("cumulative").print_stats(15)
+            hottest = summary.getvalue().strip()
+        else:
+            profile.stop()
+            profile.save(output)
+            hottest = profile.report()
+        print(f"\n{timer.report()}\n\n{hottest}", file=sys.stderr)
+        print(f"\nRaw profile saved to {output}", file=sys.stderr)
@@ -0,0 +1,79 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+
+class coreScheduler:
+    """
+    Run jobs concurrently without ever reserving more than a fixed number of cores.
+    A job is a callable that gets a stage(label, cores) context manager. Each stage
+    reserves cores for one step of the job (e.g. an alignment or a tree inference),
+    yields the number of granted cores and reports its progress.
+    """
+
+    def __init__(self, cores: int) -> None:
+        self.cores = max(1, cores)
+        self._free = self.cores
+        self._condition = threading.Condition()
+        self._print_lock = threading.Lock()
+
+    def _print(self, message: str) -> None:
+        with self._print_lock:
+            print(message, flush=True)
+
+    @contextmanager
+    def reserve(self, cores: int):
+        """
+        Block until the requested number of cores is free and hold them until the context exits
+        :param cores: number of cores, clipped to the size of the budget
+        :return:
+        """
+        cores = min(max(1, cores), self.cores)
+        with self._condition:
+            self._condition.wait_for(lambda: self._free >= cores)
+            self._free -= cores
+        try:
+            yield cores
+        finally:
+            with self._condition:
+                self._free += cores
+                self._condition.notify_all()
+
+    def run(self, jobs: Dict[str, Callable]) -> Dict[str, bool]:
+        """
+        Run all jobs and report per job progress
+        :param jobs: {job name: job callable}
+        :return: {job name: True if the job finished without raising}
+        """
+        total = len(jobs)
+        done = []
+
+        def _run_job(name: str, job: Callable) -> bool:
+            @contextmanager
+            def stage(label: str, cores: int):
+                with self.reserve(cores) as granted:
+                    self._print(f"[{name}] {label} started on {granted} core(s)")
+                    start = time.perf_counter()
+                    yield granted
+                    elapsed = time.perf_counter() - start
+                    self._print(f"[{name}] {label} finished after {elapsed:.1f}s")
+
+            try:
+                job(stage)
+                success = True
+            except Exception as e:
+                self._print(f"[{name}] failed: {e}")
+                success = False
+            done.append(name)
+            self._print(f"{len(done)}/{total} jobs done")
+            return success
+
+        if not jobs:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.cores, total)) as pool:
+            futures = {
+                name: pool.submit(_run_job, name, job) for name, job in jobs.items()
+            }
+        return {name: future.result() for name, future in futures.items()}
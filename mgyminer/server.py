@@ -0,0 +1,607 @@
+import hmac
+import http.client
+import json
+import os
+import secrets
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from mgyminer.archindex import architectureIndex
+from mgyminer.database import CONFIG_FILE, proteinDB
+from mgyminer.filter import (
+    alignment_table,
+    domain_hits,
+    filter_hits,
+    load_search,
+    residue_counts,
+    residue_hits,
+    threshold_expression,
+)
+from mgyminer.tables import read_table, write_table
+
+if TYPE_CHECKING:
+    from mgyminer.localindex import localArchitectureIndex
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def token_file(port: int = DEFAULT_PORT) -> Path:
+    """File a TCP server writes its access token to, readable only by its user"""
+    return Path.home() / f".mgyminer_serve_{port}.token"
+
+
+def write_token(file: Union[Path, str], token: str) -> None:
+    # created with mode 600, never readable by other users, not even briefly
+    file = Path(file)
+    file.unlink(missing_ok=True)
+    fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as fout:
+        fout.write(token)
+
+
+def frame_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def alignment_bytes(alignment_dict: dict) -> int:
+    """Estimated size of an alignment dictionary with its keys, entries and values"""
+    size = sys.getsizeof(alignment_dict)
+    for key, entry in alignment_dict.items():
+        size += sys.getsizeof(key) + sys.getsizeof(entry)
+        size += sum(sys.getsizeof(value) for value in entry.values())
+    return size
+
+
+def array_bytes(*arrays) -> int:
+    """Size of the arrays held in memory, memory mapped arrays are not counted"""
+    return sum(array.nbytes for array in arrays if not isinstance(array, np.memmap))
+
+
+class datasetCache:
+    """
+    Resident datasets keyed by their source, e.g. ("search", path, mtime). Entries are
+    loaded once and shared by all requests. The least recently used entries are evicted
+    once the estimated size of all entries exceeds max_bytes, and entries that were not
+    used for idle_timeout seconds are evicted by sweep(). Entries of no estimated size
+    (database connections) do not count towards max_bytes and are only evicted by
+    sweep() and evict(). Evicted values with a close() method are closed.
+    """
+
+    def __init__(self, max_bytes: int, idle_timeout: float) -> None:
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        # key -> [value, estimated bytes, last use]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0}
+
+    def _touch(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[2] = time.monotonic()
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        return entry
+
+    def get(self, key: tuple, loader: Callable, size: Callable):
+        """
+        Value of key, loaded with loader() on a miss. Concurrent requests for the same
+        key wait for one load instead of loading it twice.
+        :param key: hashable key, its first item names the kind of dataset
+        :param loader: returns the value
+        :param size: estimated bytes of a loaded value
+        :return:
+        """
+        with self._lock:
+            entry = self._touch(key)
+            if entry is not None:
+                return entry[0]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                entry = self._touch(key)
+                if entry is not None:
+                    return entry[0]
+            value = loader()
+            nbytes = size(value)
+            with self._lock:
+                self._entries[key] = [value, nbytes, time.monotonic()]
+                self._loading.pop(key, None)
+                self.stats["loads"] += 1
+                evicted = self._over_limit(keep=key)
+        self._close(evicted)
+        return value
+
+    def _over_limit(self, keep=None) -> list:
+        total = sum(entry[1] for entry in self._entries.values())
+        evicted = []
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep or self._entries[key][1] == 0:
+                # evicting an entry of no estimated size frees nothing
+                continue
+            entry = self._entries.pop(key)
+            total -= entry[1]
+            evicted.append(entry[0])
+        self.stats["evictions"] += len(evicted)
+        return evicted
+
+    @staticmethod
+    def _close(values) -> None:
+        for value in values:
+            if callable(getattr(value, "close", None)):
+                value.close()
+
+    def evict(self, source: Optional[str] = None, idle: Optional[float] = None) -> int:
+        """
+        Evict entries
+        :param source: only entries loaded from this path, all entries if None
+        :param idle: only entries not used for this many seconds
+        :return: number of evicted entries
+        """
+        now = time.monotonic()
+        with self._lock:
+            keys = [
+                key
+                for key, entry in self._entries.items()
+                if (source is None or str(source) in key[1:])
+                and (idle is None or now - entry[2] > idle)
+            ]
+            evicted = [self._entries.pop(key)[0] for key in keys]
+            self.stats["evictions"] += len(evicted)
+        self._close(evicted)
+        return len(evicted)
+
+    def sweep(self) -> int:
+        """Evict the entries idle for longer than idle_timeout"""
+        return self.evict(idle=self.idle_timeout)
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            entries = [
+                {
+                    "kind": key[0],
+                    "source": str(key[1]),
+                    "mb": round(entry[1] / 1e6, 2),
+                    "idle_seconds": round(now - entry[2], 1),
+                }
+                for key, entry in self._entries.items()
+            ]
+        return {
+            "entries": entries,
+            "mb": round(sum(entry["mb"] for entry in entries), 2),
+            "limit_mb": round(self.max_bytes / 1e6, 2),
+            **self.stats,
+        }
+
+
+def _mtime(file: Path) -> float:
+    return file.stat().st_mtime if file.is_file() else 0.0
+
+
+class residentData:
+    """
+    Loaders of the datasets requests work on, all going through one datasetCache:
+    search results (domain table, alignments and their integer keyed table), filter
+    output tables, alignment stores of a results directory, databases with their
+    architecture index and local architecture indexes
+    """
+
+    def __init__(self, cache: datasetCache, compact: bool = False) -> None:
+        self.cache = cache
+        self.compact = compact
+
+    def search(self, hmmer_output_file: Union[Path, str]):
+        """Domain table with coverage, alignments and alignment_table() of a search"""
+        file = Path(hmmer_output_file).resolve()
+        dom_tbl_file = file.with_name("dom_tbl.txt")
+        key = ("search", str(file), _mtime(file), _mtime(dom_tbl_file))
+
+        def load():
+            dom_tbl, alignment_dict = load_search(file, self.compact)
+            return dom_tbl, alignment_dict, alignment_table(alignment_dict)
+
+        def size(value):
+            return (
+                frame_bytes(value[0])
+                + alignment_bytes(value[1])
+                + frame_bytes(value[2])
+            )
+
+        return self.cache.get(key, load, size)
+
+    def table(self, file: Union[Path, str]) -> pd.DataFrame:
+        """A filter output table"""
+        file = Path(file).resolve()
+        key = ("table", str(file), _mtime(file))
+        return self.cache.get(
+            key, lambda: read_table(file, compact=self.compact), frame_bytes
+        )
+
+    def alignments(self, directory: Union[Path, str]):
+        """alignments.json of a results directory and its alignment_table()"""
+        file = (Path(directory) / "alignments.json").resolve()
+        key = ("alignments", str(file), _mtime(file))
+
+        def load():
+            with open(file, "r") as fin:
+                alignment_dict = json.load(fin)
+            return alignment_dict, alignment_table(alignment_dict)
+
+        def size(value):
+            return alignment_bytes(value[0]) + frame_bytes(value[1])
+
+        return self.cache.get(key, load, size)
+
+    def database(self, sqlite: Optional[Union[Path, str]] = None):
+        """Pooled database connections and the architecture index of the database"""
+        source = str(Path(sqlite).resolve()) if sqlite is not None else str(CONFIG_FILE)
+        db = self.cache.get(
+            ("database", source),
+            lambda: proteinDB(sqlite=sqlite) if sqlite is not None else proteinDB(),
+            lambda value: 0,
+        )
+        index = self.cache.get(
+            ("architecture index", source),
+            lambda: architectureIndex.load(db),
+            lambda value: array_bytes(
+                value.ids,
+                value.pfams,
+                value.names,
+                value.tokens,
+                value.offsets,
+                value.postings,
+            ),
+        )
+        return db, index
+
+    def local_index(self, directory: Union[Path, str]) -> "localArchitectureIndex":
+        # pyroaring is an optional dependency, only needed for local indexes
+        from mgyminer.localindex import localArchitectureIndex
+
+        directory = Path(directory).resolve()
+        key = ("local index", str(directory), _mtime(directory / "mgyp.npy"))
+
+        def size(index):
+            architectures = index.architectures
+            return array_bytes(
+                index.mgyp,
+                index.arch,
+                index.tokens,
+                index.offsets,
+                architectures.ids,
+                architectures.pfams,
+                architectures.names,
+                architectures.tokens,
+                architectures.offsets,
+                architectures.postings,
+            )
+
+        return self.cache.get(key, lambda: localArchitectureIndex(directory), size)
+
+    def hits(self, request: dict):
+        """
+        Hit table and alignments a residue or domain request works on: a filter output
+        (input, with alignments.json in its directory) or a search (search) filtered
+        with the eval, coverage, where and sort options of the request
+        :return: hit table, alignment dictionary, alignment_table()
+        """
+        if request.get("input") is not None:
+            table = self.table(request["input"])
+            if request.get("where"):
+                # the resident table stays whole, only the request's view is filtered
+                table = table[threshold_expression(where=request["where"]).mask(table)]
+            alignment_dict, alignments = self.alignments(Path(request["input"]).parent)
+            return table, alignment_dict, alignments
+        if request.get("search") is None:
+            raise ValueError("Give either input (filter output) or search")
+        return self.filtered(request)
+
+    def filtered(self, request: dict):
+        dom_tbl, alignment_dict, alignments = self.search(request["search"])
+        hits = filter_hits(
+            dom_tbl.copy(),
+            alignment_dict,
+            request.get("eval"),
+            request.get("coverage"),
+            request.get("sort"),
+            table=alignments,
+            top=request.get("top"),
+            sort_cache=request["search"],
+            where=request.get("where"),
+        )
+        return hits, alignment_dict, alignments
+
+
+def _table_response(table: pd.DataFrame, request: dict) -> str:
+    if request.get("output"):
+        write_table(table, request["output"], request.get("output_format"))
+        return json.dumps({"rows": len(table), "output": str(request["output"])})
+    return (
+        f'{{"rows": {len(table)}, '
+        f'"table": {table.to_json(orient="split", index=False)}}}'
+    )
+
+
+class queryHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP. POST /filter, /residue, /residue_check and /domain take the options
+    of the subcommands as a JSON object, e.g. {"search": "results/phmmer.out",
+    "eval": 0.001, "sort": ["identity"]}, and answer with {"rows": n, "table": {columns,
+    data}} or, if output is given, write the table there in output_format. GET /status
+    lists the resident datasets, POST /evict ({"source": path} or {} for all) drops them
+    and POST /shutdown stops the server.
+
+    Requests write files and stop the server with the rights of its user, so only that
+    user's scripts are answered: POST bodies must be sent as application/json, which
+    browsers cannot send cross-origin without a preflight, requests with an Origin
+    header (from a web page) are refused, and on TCP, where any local user can connect,
+    requests must carry the server's token ("Authorization: Bearer <token>"). The Unix
+    socket is only accessible to its user and needs no token.
+    """
+
+    server_version = "MGnifyMiner"
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def _reply(self, status: int, body: str) -> None:
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, handler: Callable, request: dict) -> None:
+        try:
+            self._reply(200, handler(request))
+        except (KeyError, ValueError, TypeError, FileNotFoundError) as error:
+            self._reply(400, json.dumps({"error": f"{type(error).__name__}: {error}"}))
+        except Exception as error:
+            self._reply(500, json.dumps({"error": f"{type(error).__name__}: {error}"}))
+            raise
+
+    def _refused(self) -> bool:
+        """Reply with an error to requests not known to come from the server's user"""
+        if "Origin" in self.headers:
+            self._reply(
+                403, json.dumps({"error": "Requests from web pages are not accepted"})
+            )
+            return True
+        token = self.server.token
+        if token is not None and not hmac.compare_digest(
+            self.headers.get("Authorization", ""), f"Bearer {token}"
+        ):
+            self._reply(401, json.dumps({"error": "Missing or wrong access token"}))
+            return True
+        return False
+
+    def do_GET(self) -> None:
+        if self._refused():
+            return
+        if self.path == "/status":
+            self._dispatch(
+                lambda request: json.dumps(self.server.data.cache.status()), {}
+            )
+        else:
+            self._reply(404, json.dumps({"error": f"Unknown endpoint {self.path}"}))
+
+    def do_POST(self) -> None:
+        handlers = {
+            "/filter": self.filter,
+            "/residue": self.residue,
+            "/residue_check": self.residue_check,
+            "/domain": self.domain,
+            "/evict": self.evict,
+            "/shutdown": self.shutdown,
+        }
+        if self._refused():
+            return
+        if self.path not in handlers:
+            self._reply(404, json.dumps({"error": f"Unknown endpoint {self.path}"}))
+            return
+        if self.headers.get_content_type() != "application/json":
+            self._reply(
+                415, json.dumps({"error": "Requests must be sent as application/json"})
+            )
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as error:
+            self._reply(400, json.dumps({"error": f"Invalid JSON: {error}"}))
+            return
+        self._dispatch(handlers[self.path], request)
+
+    def filter(self, request: dict) -> str:
+        hits, _, _ = self.server.data.filtered(request)
+        return _table_response(hits, request)
+
+    def residue(self, request: dict) -> str:
+        hits, alignment_dict, alignments = self.server.data.hits(request)
+        hits = residue_hits(hits, alignment_dict, request["residue"], alignments)
+        return _table_response(hits, request)
+
+    def residue_check(self, request: dict) -> str:
+        if request.get("input") is not None:
+            alignment_dict, _ = self.server.data.alignments(
+                Path(request["input"]).parent
+            )
+        else:
+            _, alignment_dict, _ = self.server.data.search(request["search"])
+        counts = residue_counts(alignment_dict, int(request["residue"]))
+        return json.dumps({"residue": int(request["residue"]), "counts": counts})
+
+    def domain(self, request: dict) -> str:
+        hits, _, _ = self.server.data.hits(request)
+        options = dict(
+            strict=request.get("strict", False),
+            exclude=request.get("exclude", []),
+            strategy=request.get("strategy", "auto"),
+        )
+        if request.get("local_index") is not None:
+            local_index = self.server.data.local_index(request["local_index"])
+            hits = domain_hits(
+                hits, request["arch"], local_index=local_index, **options
+            )
+        else:
+            db, index = self.server.data.database(request.get("sqlite"))
+            hits = domain_hits(hits, request["arch"], db=db, index=index, **options)
+        return _table_response(hits, request)
+
+    def evict(self, request: dict) -> str:
+        evicted = self.server.data.cache.evict(request.get("source"))
+        return json.dumps({"evicted": evicted})
+
+    def shutdown(self, request: dict) -> str:
+        # shutdown() waits for serve_forever(), which waits for this request
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+        return json.dumps({"shutdown": True})
+
+
+class tcpQueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class unixQueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self) -> None:
+        # a socket file left behind by a server that was killed blocks the bind
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+def make_server(
+    data: residentData,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    unix_socket: Optional[Union[Path, str]] = None,
+    token: Optional[str] = None,
+):
+    """
+    HTTP server answering queries against the resident data, on a Unix socket if given,
+    otherwise on host:port
+    :param token: access token required on TCP, a random one if None (see
+    queryHandler). Unix socket requests need none.
+    """
+    if unix_socket is not None:
+        server = unixQueryServer(str(unix_socket), queryHandler)
+        server.token = None
+    else:
+        server = tcpQueryServer((host, port), queryHandler)
+        server.token = token if token is not None else secrets.token_urlsafe(32)
+    server.data = data
+    return server
+
+
+def serve(args):
+    cache = datasetCache(args.memory_limit * 1_000_000, args.idle_timeout)
+    server = make_server(
+        residentData(cache, args.compact), args.host, args.port, args.socket
+    )
+    tokens = None
+    if server.token is not None:
+        tokens = args.token_file or token_file(args.port)
+        write_token(tokens, server.token)
+    stop = threading.Event()
+
+    def sweep():
+        while not stop.wait(min(60.0, args.idle_timeout / 4)):
+            cache.sweep()
+
+    threading.Thread(target=sweep, daemon=True).start()
+    address = args.socket if args.socket is not None else f"{args.host}:{args.port}"
+    print(
+        f"Serving on {address}, memory limit {args.memory_limit} MB, idle datasets "
+        f"evicted after {args.idle_timeout:.0f} s",
+        file=sys.stderr,
+    )
+    if tokens is not None:
+        print(f"Access token written to {tokens}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        cache.evict()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        if tokens is not None:
+            Path(tokens).unlink(missing_ok=True)
+
+
+class _unixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def query(
+    endpoint: str,
+    request: Optional[dict] = None,
+    address: str = f"{DEFAULT_HOST}:{DEFAULT_PORT}",
+    timeout: Optional[float] = None,
+    token: Optional[str] = None,
+):
+    """
+    Send a request to a running server, for scripts that query it in a loop
+    :param endpoint: e.g. "filter", "residue", "status"
+    :param request: options of the request
+    :param address: host:port or the path of a Unix socket
+    :param timeout: seconds to wait for the answer
+    :param token: access token of a TCP server, read from token_file(port) if None
+    :return: decoded JSON answer. Tables are dicts with columns and data, see
+    pandas.DataFrame(**answer["table"])
+    """
+    headers = {}
+    if ":" in address and not os.path.exists(address):
+        host, port = address.rsplit(":", 1)
+        connection = http.client.HTTPConnection(host, int(port), timeout=timeout)
+        if token is None and token_file(int(port)).is_file():
+            token = token_file(int(port)).read_text().strip()
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+    else:
+        connection = _unixConnection(address, timeout=timeout)
+    try:
+        if endpoint == "status":
+            connection.request("GET", "/status", headers=headers)
+        else:
+            connection.request(
+                "POST",
+                f"/{endpoint}",
+                body=json.dumps(request or {}),
+                headers={**headers, "Content-Type": "application/json"},
+            )
+        response = connection.getresponse()
+        answer = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(answer.get("error", f"HTTP {response.status}"))
+    return answer
@@ -0,0 +1,246 @@
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import pandas as pd
+
+from mgyminer.expression import filterExpression
+from mgyminer.options import TABLE_FORMATS
+
+# output format chosen by the file extension when no format is given
+SUFFIX_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
+FORMAT_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+# leading bytes of Parquet files and Arrow IPC (Feather v2) files
+MAGIC = {b"PAR1": "parquet", b"ARROW1": "arrow"}
+
+# Compact schema of hit table columns. Repetitive strings become categoricals,
+# coordinates and lengths int32 (proteins are far shorter than 2**31, and signed so that
+# ali_to - ali_from cannot wrap), domain counts uint16 and scores float32. E-values
+# underflow float32 and coverage, similarity and identity are compared against user
+# thresholds at 0.01 steps, so they stay float64. target_name stays a string column, it
+# is unique per protein and used in string operations (dom_accessions, MGYP numbers).
+COMPACT_DTYPES = {
+    **dict.fromkeys(
+        [
+            "target_accession",
+            "query_name",
+            "query_accession",
+            "description",
+            "PL",
+            "UP",
+            "biome",
+            "CR",
+            "Pfams",
+            "domain_names",
+        ],
+        "category",
+    ),
+    **dict.fromkeys(
+        [
+            "tlen",
+            "qlen",
+            "hmm_from",
+            "hmm_to",
+            "ali_from",
+            "ali_to",
+            "env_from",
+            "env_to",
+        ],
+        "int32",
+    ),
+    **dict.fromkeys(["ndom", "ndom_of"], "uint16"),
+    **dict.fromkeys(["score", "bias", "dom_score", "dom_bias", "acc"], "float32"),
+}
+
+
+def table_format(file: Union[Path, str]) -> str:
+    """
+    Format of a hit table file, recognised by its leading bytes. Files that are neither
+    Parquet nor Arrow IPC are read as CSV.
+    :param file: Path to the table
+    :return: one of TABLE_FORMATS
+    """
+    with open(file, "rb") as fin:
+        head = fin.read(6)
+    for magic, fmt in MAGIC.items():
+        if head.startswith(magic):
+            return fmt
+    return "csv"
+
+
+def compact_table(table: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cast the columns of a hit table to COMPACT_DTYPES, columns without a compact dtype
+    and columns that already have it are left as they are
+    :param table: hit table
+    :return: the table with compact columns, not a copy if nothing had to be cast
+    """
+    dtypes = {
+        column: dtype
+        for column, dtype in COMPACT_DTYPES.items()
+        if column in table.columns and table[column].dtype != dtype
+    }
+    return table.astype(dtypes) if dtypes else table
+
+
+def memory_report(table: pd.DataFrame) -> str:
+    """Memory footprint of each column of a table, largest first"""
+    usage = table.memory_usage(deep=True, index=False).sort_values(ascending=False)
+    total = max(int(usage.sum()), 1)
+    lines = [f"{'column':<24}{'dtype':<16}{'MB':>10}{'%':>7}"]
+    for column, size in usage.items():
+        lines.append(
+            f"{str(column):<24}{str(table[column].dtype):<16}{size / 1e6:>10.2f}"
+            f"{100 * size / total:>7.1f}"
+        )
+    lines.append(
+        f"{'total':<24}{f'{len(table)} rows':<16}{total / 1e6:>10.2f}{100:>7.1f}"
+    )
+    return "\n".join(lines)
+
+
+def read_table(
+    file: Union[Path, str],
+    columns: Optional[Sequence[str]] = None,
+    compact: bool = False,
+    where: Optional[filterExpression] = None,
+) -> pd.DataFrame:
+    """
+    Read a hit table written by filter, residue or domain in any of TABLE_FORMATS
+    :param file: Path to the table
+    :param columns: read only these columns. Parquet and Arrow skip the other columns
+    on disk, CSV still parses every line but keeps only these columns
+    :param compact: cast to COMPACT_DTYPES. CSV is parsed into them directly, without
+    the int64/float64/object intermediate
+    :param where: keep only the rows matching this expression. Parquet and Arrow
+    evaluate it while reading, before the rows are converted to pandas, and Parquet
+    skips row groups whose column statistics rule out a match. CSV rows are filtered
+    after parsing. The index is a RangeIndex of the kept rows in all formats.
+    :return:
+    """
+    fmt = table_format(file)
+    columns = None if columns is None else list(columns)
+    read = columns
+    if where is not None and columns is not None:
+        # columns only needed by the filter are dropped again after it
+        read = columns + [column for column in where.columns if column not in columns]
+    if fmt == "csv":
+        dtype = COMPACT_DTYPES if compact else None
+        table = pd.read_csv(file, usecols=read, dtype=dtype)
+        if where is not None:
+            table = table[where.mask(table)].reset_index(drop=True)
+    elif where is None:
+        if fmt == "parquet":
+            table = pd.read_parquet(file, columns=read)
+        else:
+            table = pd.read_feather(file, columns=read)
+    else:
+        # pyarrow is an optional dependency, only needed for these formats
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(file, format="parquet" if fmt == "parquet" else "ipc")
+        table = dataset.to_table(
+            columns=read, filter=where.arrow(dataset.schema)
+        ).to_pandas()
+    if read is not columns:
+        table = table[columns]
+    return compact_table(table) if compact else table
+
+
+def _output_format(file: Union[Path, str], output_format: Optional[str]) -> str:
+    if output_format is None:
+        output_format = SUFFIX_FORMATS.get(Path(file).suffix.lower(), "csv")
+    if output_format not in TABLE_FORMATS:
+        raise ValueError(f"Invalid output format. Expected one of: {TABLE_FORMATS}")
+    return output_format
+
+
+def write_table(
+    table: pd.DataFrame, file: Union[Path, str], output_format: Optional[str] = None
+) -> None:
+    """
+    Write a hit table. Parquet and Arrow keep the column dtypes, so downstream commands
+    do not infer them from text again. Both need pyarrow.
+    :param table: hit table
+    :param file: output Path
+    :param output_format: one of TABLE_FORMATS, chosen by the extension of file if None
+    :return:
+    """
+    output_format = _output_format(file, output_format)
+    if output_format == "parquet":
+        table.to_parquet(file, index=False)
+    elif output_format == "arrow":
+        # Feather v2 is the Arrow IPC file format, it cannot store an index
+        table.reset_index(drop=True).to_feather(file)
+    else:
+        table.to_csv(file, index=False, sep=",")
+
+
+class tableWriter:
+    """
+    Write a hit table chunk by chunk, in any of TABLE_FORMATS. Parquet chunks become row
+    groups and Arrow chunks record batches of one file. Categorical columns are written
+    as plain strings there, the chunks' categories differ and the file needs one schema
+    (Parquet dictionary encodes repetitive strings on disk anyway).
+    """
+
+    def __init__(
+        self, file: Union[Path, str], output_format: Optional[str] = None
+    ) -> None:
+        self.file = file
+        self.output_format = _output_format(file, output_format)
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._header = True
+
+    def write(self, table: pd.DataFrame) -> None:
+        self.rows += len(table)
+        if self.output_format == "csv":
+            table.to_csv(
+                self.file,
+                index=False,
+                sep=",",
+                mode="w" if self._header else "a",
+                header=self._header,
+            )
+            self._header = False
+            return
+        # pyarrow is an optional dependency, only needed for these formats
+        import pyarrow as pa
+
+        plain = {
+            column: table[column].cat.categories.dtype
+            for column in table.columns
+            if isinstance(table[column].dtype, pd.CategoricalDtype)
+        }
+        batch = pa.Table.from_pandas(
+            table.astype(plain) if plain else table,
+            schema=self._schema,
+            preserve_index=False,
+        )
+        if self._writer is None:
+            self._schema = batch.schema
+            if self.output_format == "parquet":
+                import pyarrow.parquet as pq
+
+                self._writer = pq.ParquetWriter(self.file, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.file, self._schema)
+        self._writer.write_table(batch)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,219 @@
+import hashlib
+from pathlib import Path
+from typing import Iterable, Union
+
+import numpy as np
+import pandas as pd
+
+from mgyminer.newick import arrayTree
+
+# node indices and Euler tour positions, 2 * nodes - 1 fits into 32 bits
+INDEX_DTYPE = np.int32
+
+
+def file_digest(file: Union[Path, str], chunksize: int = 1 << 20) -> str:
+    """
+    sha1 hex digest of a file, used to key caches on the file content
+    :param file: Path to file
+    :param chunksize: bytes read at once
+    :return:
+    """
+    digest = hashlib.sha1()
+    with open(file, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunksize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def frame_digest(df: pd.DataFrame) -> str:
+    """
+    sha1 hex digest of a DataFrame's columns and values, keys caches on tables that only
+    exist in memory like file_digest() does for files
+    :param df: DataFrame
+    :return:
+    """
+    digest = hashlib.sha1()
+    digest.update(",".join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class lcaIndex:
+    """
+    Lowest common ancestor index over a tree (Euler tour + sparse table range minimum).
+    After an O(n log n) build, the lca and tree distance of any pair of nodes are O(1)
+    and clade membership of a leaf is a range check on its Euler tour position. The
+    cache keeps only the O(n) arrays, the sparse table is rebuilt from them on load.
+    """
+
+    def __init__(self, euler, first, last, level, depth, names, digest=""):
+        self.euler = np.asarray(euler, dtype=INDEX_DTYPE)
+        self.first = np.asarray(first, dtype=INDEX_DTYPE)
+        self.last = np.asarray(last, dtype=INDEX_DTYPE)
+        self.level = np.asarray(level, dtype=INDEX_DTYPE)
+        self.depth = depth
+        self.names = names
+        self.digest = digest
+        self.tour_level = self.level[self.euler]
+        self.sparse = self._sparse_table()
+        self.leaves = np.flatnonzero(self.first == self.last)
+        self._name_index = {
+            name: index for index, name in enumerate(self.names) if name
+        }
+
+    @classmethod
+    def from_arrays(cls, parent, depth, names, digest=""):
+        """
+        Build the index from preorder parent/depth arrays
+        :param parent: parent index of each node, -1 for the root
+        :param depth: distance of each node to the root
+        :param names: node names, empty for unnamed nodes
+        :param digest: digest of the tree file the index belongs to
+        :return:
+        """
+        n = len(parent)
+        children = [[] for _ in range(n)]
+        for node, parent_node in enumerate(parent.tolist()[1:], start=1):
+            children[parent_node].append(node)
+
+        euler = np.empty(2 * n - 1, dtype=INDEX_DTYPE)
+        first = np.empty(n, dtype=INDEX_DTYPE)
+        last = np.empty(n, dtype=INDEX_DTYPE)
+        level = np.zeros(n, dtype=INDEX_DTYPE)
+        position = 0
+        stack = [(0, 0)]
+        while stack:
+            node, child = stack.pop()
+            euler[position] = node
+            if child == 0:
+                first[node] = position
+            last[node] = position
+            position += 1
+            if child < len(children[node]):
+                stack.append((node, child + 1))
+                next_node = children[node][child]
+                level[next_node] = level[node] + 1
+                stack.append((next_node, 0))
+        names = np.array([name or "" for name in names], dtype=str)
+        return cls(euler, first, last, level, np.asarray(depth), names, digest=digest)
+
+    @classmethod
+    def from_tree(cls, tree: arrayTree, digest=""):
+        return cls.from_arrays(tree.parent, tree.depths(), tree.names, digest=digest)
+
+    @classmethod
+    def load(cls, tree_file: Union[Path, str]):
+        """
+        Load the index cached next to the tree file, build and cache it if it is missing or
+        belongs to a different version of the tree
+        :param tree_file: Path to newick tree
+        :return:
+        """
+        tree_file = Path(tree_file)
+        cache = tree_file.with_name(tree_file.name + ".lca.npz")
+        digest = file_digest(tree_file)
+        if cache.is_file():
+            with np.load(cache) as data:
+                if str(data["digest"]) == digest:
+                    return cls(
+                        data["euler"],
+                        data["first"],
+                        data["last"],
+                        data["level"],
+                        data["depth"],
+                        data["names"],
+                        digest=digest,
+                    )
+        index = cls.from_tree(arrayTree.read(tree_file), digest=digest)
+        index.save(cache)
+        return index
+
+    def save(self, file: Union[Path, str]) -> None:
+        with open(file, "wb") as fout:
+            np.savez(
+                fout,
+                euler=self.euler,
+                first=self.first,
+                last=self.last,
+                level=self.level,
+                depth=self.depth,
+                names=self.names,
+                digest=np.array(self.digest),
+            )
+
+    def _sparse_table(self):
+        """
+        sparse[k, i] is the Euler tour position with the smallest level in [i, i + 2**k)
+        """
+        tour_level = self.tour_level
+        m = len(self.euler)
+        rows = [np.arange(m, dtype=INDEX_DTYPE)]
+        span = 1
+        while 2 * span <= m:
+            previous = rows[-1]
+            cut = m - span
+            left = previous[:cut]
+            right = previous[span:]
+            row = np.where(tour_level[left] <= tour_level[right], left, right)
+            # pad so all rows have the same length, the padding is never queried
+            rows.append(np.concatenate([row, previous[cut:]]))
+            span *= 2
+        return np.vstack(rows)
+
+    def index_of(self, names) -> np.ndarray:
+        """
+        Node indices of the named nodes
+        :param names: node name or iterable of node names
+        :return:
+        """
+        if isinstance(names, str):
+            names = [names]
+        try:
+            return np.array([self._name_index[name] for name in names], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError(f"{e.args[0]} is not a node of the tree")
+
+    def lca(self, a, b) -> np.ndarray:
+        """
+        Lowest common ancestors of node pairs, vectorized over arrays of node indices
+        """
+        start = np.minimum(self.first[a], self.first[b])
+        stop = np.maximum(self.first[a], self.first[b]) + 1
+        k = np.floor(np.log2(stop - start)).astype(np.int64)
+        left = self.sparse[k, start]
+        right = self.sparse[k, stop - (1 << k)]
+        closer = self.tour_level[left] <= self.tour_level[right]
+        return self.euler[np.where(closer, left, right)]
+
+    def distance(self, a, b) -> np.ndarray:
+        """
+        Tree distance between node pairs, vectorized over arrays of node indices
+        """
+        return self.depth[a] + self.depth[b] - 2 * self.depth[self.lca(a, b)]
+
+    def distances_from(self, name: str):
+        """
+        Distance of the named node to all leaves
+        :param name: name of the reference node
+        :return: array of leaf names and array of distances, both in leaf order
+        """
+        reference = np.full(len(self.leaves), self.index_of(name)[0])
+        return self.names[self.leaves], self.distance(reference, self.leaves)
+
+    def clade_root(self, names: Iterable[str]) -> int:
+        """
+        Lowest common ancestor of a set of named nodes
+        """
+        nodes = self.index_of(list(names))
+        # the lca of a set spans the leftmost and rightmost first occurrence
+        order = self.first[nodes]
+        return int(self.lca(nodes[np.argmin(order)], nodes[np.argmax(order)]))
+
+    def clade_members(self, names: Iterable[str]) -> np.ndarray:
+        """
+        Names of all leaves in the smallest clade containing the named nodes
+        """
+        root = self.clade_root(names)
+        position = self.first[self.leaves]
+        inside = (position >= self.first[root]) & (position <= self.last[root])
+        return self.names[self.leaves[inside]]
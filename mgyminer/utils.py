@@ -2,7 +2,9 @@ import tempfile
 
 import pandas as pd
 
+from mgyminer.annotation import target_keys, target_names
 from mgyminer.phyltree import esl_sfetcher
+from mgyminer.tables import read_table
 
 
 def export_sequences(args):
@@ -12,9 +14,8 @@ def export_sequences(args):
     :return:
     """
     fetcher = esl_sfetcher()
-    results = pd.read_csv(args.filter)
+    results = read_table(args.filter, columns=["target_name"])
     with tempfile.NamedTemporaryFile() as temp:
-        results["target_name"].drop_duplicates().to_csv(
-            temp.name, index=False, header=False
-        )
+        targets = pd.unique(target_keys(results["target_name"]))
+        pd.Series(target_names(targets)).to_csv(temp.name, index=False, header=False)
         fetcher.run("testSeqDB.fa", temp.name, args.output, args=["-f"])
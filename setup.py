@@ -13,6 +13,12 @@ setup(
     description="A tool to explore the MGnify Protein Database",
     url="TODO",
     install_requires=["hmmer", "pandas"],
+    extras_require={
+        # Parquet and Arrow hit tables (--output-format)
+        "arrow": ["pyarrow"],
+        # local architecture indexes (domain_index, domain --local-index)
+        "local-index": ["pyroaring"],
+    },
     license="TODO",
     entry_points={"console_scripts": ["MGnifyMiner = mgyminer.__main__:main"]},
     classifiers=[